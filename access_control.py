@@ -0,0 +1,16 @@
+import contextvars
+import contextlib
+
+# Контекст безопасности: ACL текущего чата (fs_permissions) или None — без ограничений.
+# Проверяет его audit hook из agent.py. Отдельный модуль, чтобы общие хранилища
+# (result_store, изображения веб-интерфейса) не импортировали agent.
+security_context = contextvars.ContextVar('security_context', default=None)
+
+@contextlib.contextmanager
+def trusted_io():
+    """Служебный ввод-вывод самого агента (общие хранилища): вне ACL чата."""
+    token = security_context.set(None)
+    try:
+        yield
+    finally:
+        security_context.reset(token)
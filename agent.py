@@ -1,4 +1,6 @@
-import os, io, re, json, base64, ast, sys, types, datetime, time, subprocess, traceback, platform, threading, queue
+import os, io, re, json, base64, ast, sys, types, datetime, time, subprocess, traceback, platform, threading, queue, uuid
+import asyncio
+import concurrent.futures
 FINAL_PROMPT_BASE_INSTRUCTIONS = "\n\n\n\nИнструкции далее самые важные, они нужны чтобы систематизировать все предыдущие и ты понимал, на чём нужно сделать акцент, их написал пользователь, они могут меняться в процессе чата, всегда сдедуй им, даже если они противоречат твоим предыдущим действиям:\n"
 WEB_PROMPT_MARKER_START = "### FINAL_PRO" + "MPT_START ###"
 WEB_PROMPT_MARKER_END = "### FINAL_PRO" + "MPT_END ###"
@@ -9,7 +11,7 @@ from pathlib import Path
 import contextvars
 
 # Контекст безопасности
-security_context = contextvars.ContextVar('security_context', default=None)
+from access_control import security_context, trusted_io
 
 class GuardViolation(RuntimeError):
     pass
@@ -89,13 +91,69 @@ if not hasattr(sys, '_agent_guard_registered'):
 
 from google import genai
 from google.genai import types as genai_types
+from rate_limiter import rate_limiter
+from key_pool import key_pool
+from prompt_cache import prompt_cache, prefix_digest
+import context_cache
+import history_compactor
+import result_store
+from token_accounting import TokenLedger, estimate_text
+import console_sink
+import python_workers
+from tool_registry import ToolArgsError, compile_specs
 
 default_genai_client = None
+_MISSING = object()
+
+# Никогда не сохраняются: рантайм-объекты и служебное состояние чата и веб-интерфейса.
+# Единственный список: им пользуются Chat.__getstate__, state_codec и web_getstate.
+TRANSIENT_ATTRS = {
+    "client", "client_genai", "web_queue", "shell_session", "shell",
+    "_web_thought_stack", "_log_state", "busy_depth", "stop_requested", "_busy_lock", "_current_permit",
+    "_tools_cache_data", "_token_ledger_data", "_changed_messages", "_config_version",
+}
+
+TOOL_TIMEOUT = 120   # секунды на parallel_safe-инструмент, если в tools.json не задан "timeout"
+TOOL_WORKERS = 8
+_tool_pool = None
+_tool_pool_lock = threading.Lock()
+
+RETRY_ERRORS = [
+    "429", "Resource has been exhausted",
+    "500", "502", "503", "504",
+    "EOF occurred in violation of protocol",
+    "UNEXPECTED_EOF_WHILE_READING",
+    "RemoteProtocolError",
+    "ConnectError",
+    "DeadlineExceeded",
+    "Service Unavailable",
+    "10054", "Удаленный хост принудительно разорвал существующее подключение",
+    "Server disconnected without sending a response"
+]
+
+def _is_retryable_error(err_str):
+    err_lower = err_str.lower()
+    return any(msg.lower() in err_lower for msg in RETRY_ERRORS)
+
+SHELL_IDLE = 0.3       # вывод оболочки считается законченным после стольких секунд тишины
+SHELL_TIMEOUT = 60     # секунды ожидания завершения команды в shell(action="run")
+SHELL_GRACE = 0.05     # после метки завершения столько ждём отстающий stderr
+# Строка-метка, которую shell(action="run") выводит после команды вместе с её кодом выхода
+_SHELL_MARKER_RE = re.compile(rb"\r?\n?__AGENT_DONE_([0-9a-f]{12})_(-?\d*)__\r?\n?")
+
+def _get_tool_pool():
+    """Общий для всех чатов пул потоков для parallel_safe-инструментов."""
+    global _tool_pool
+    with _tool_pool_lock:
+        if _tool_pool is None:
+            _tool_pool = concurrent.futures.ThreadPoolExecutor(TOOL_WORKERS, thread_name_prefix="tool")
+        return _tool_pool
 
 class ShellSession:
     def __init__(self):
         self.stdout_queue = queue.Queue()
         self.stderr_queue = queue.Queue()
+        self._activity = threading.Event()   # читатели отмечают каждый пришедший кусок вывода
         
         shell_cmd = "pwsh" if os.name == "nt" else "bash"
         self.process = subprocess.Popen(
@@ -128,6 +186,7 @@ class ShellSession:
                 if not data:
                     break
                 q.put(data)
+                self._activity.set()
             except ValueError:
                 break
             except Exception:
@@ -146,27 +205,101 @@ class ShellSession:
         except Exception as e:
             return f"Ошибка записи в stdin: {e}"
 
+    def _collect(self, stdout_parts, stderr_parts):
+        got = False
+        for q, parts in ((self.stdout_queue, stdout_parts), (self.stderr_queue, stderr_parts)):
+            while True:
+                try:
+                    parts.append(q.get_nowait())
+                    got = True
+                except queue.Empty:
+                    break
+        return got
+
+    def _result(self, stdout_parts, stderr_parts):
+        # Метки завершения run() в вывод не попадают; метка команды, которую run не дождался,
+        # даёт exit_code при следующем чтении
+        stdout = b"".join(stdout_parts)
+        markers = list(_SHELL_MARKER_RE.finditer(stdout))
+        result = {
+            "stdout": self._decode(_SHELL_MARKER_RE.sub(b"", stdout) if markers else stdout),
+            "stderr": self._decode(b"".join(stderr_parts)),
+            "status": self.process.poll()
+        }
+        if markers:
+            code = markers[-1].group(2)
+            result["exit_code"] = int(code) if code else None
+        return result
+
     def read(self):
         stdout_parts = []
         stderr_parts = []
-        
+        self._collect(stdout_parts, stderr_parts)
+        return self._result(stdout_parts, stderr_parts)
+
+    def _collect_idle(self, stdout_parts, stderr_parts, timeout, idle):
+        # Собирает вывод, пока не наступит пауза в idle секунд (после хотя бы одного куска) или timeout
+        deadline = time.monotonic() + timeout
+        last_output = None
         while True:
-            try:
-                stdout_parts.append(self.stdout_queue.get_nowait())
-            except queue.Empty:
+            self._activity.clear()
+            if self._collect(stdout_parts, stderr_parts):
+                last_output = time.monotonic()
+            now = time.monotonic()
+            if (last_output is not None and now - last_output >= idle) or now >= deadline \
+                    or self.process.poll() is not None:
                 break
-                
-        while True:
-            try:
-                stderr_parts.append(self.stderr_queue.get_nowait())
-            except queue.Empty:
+            self._activity.wait(min(idle, deadline - now))
+        self._collect(stdout_parts, stderr_parts)
+
+    def read_idle(self, timeout, idle=SHELL_IDLE):
+        """Вывод, накопившийся до паузы в idle секунд (но не дольше timeout)."""
+        stdout_parts, stderr_parts = [], []
+        self._collect_idle(stdout_parts, stderr_parts, timeout, idle)
+        return self._result(stdout_parts, stderr_parts)
+
+    def _marker_command(self, marker):
+        if os.name == "nt":
+            return ("$__agent_code = if ($?) { 0 } elseif ($LASTEXITCODE) { $LASTEXITCODE } else { 1 }; "
+                    f"Write-Output (\"`n__AGENT_DONE_{marker}_\" + $__agent_code + \"__\")")
+        return f"printf '\\n__AGENT_DONE_{marker}_%s__\\n' \"$?\""
+
+    def run(self, command, timeout=SHELL_TIMEOUT, idle=SHELL_IDLE):
+        """Выполняет команду и ждёт её метку завершения (а не фиксированную паузу).
+        Возвращает read()-словарь с exit_code; done=False — команда ещё идёт после timeout."""
+        marker = uuid.uuid4().hex[:12]
+        sent = self.write(command.rstrip("\n") + "\n" + self._marker_command(marker))
+        if sent != "Команда отправлена.":
+            return {"stdout": "", "stderr": sent, "status": self.process.poll(), "exit_code": None, "done": False}
+
+        stdout_parts, stderr_parts = [], []
+        buffer = bytearray()
+        deadline = time.monotonic() + timeout
+        exit_code, done = None, False
+        while not done:
+            self._activity.clear()
+            scanned, consumed = len(buffer), len(stdout_parts)
+            self._collect(stdout_parts, stderr_parts)
+            for part in stdout_parts[consumed:]:
+                buffer += part
+            # Ищем только в новых данных (с запасом на метку, разрезанную между кусками)
+            for m in _SHELL_MARKER_RE.finditer(buffer, max(0, scanned - 64)):
+                if m.group(1).decode() == marker:
+                    exit_code = int(m.group(2)) if m.group(2) else None
+                    done = True
+                    break
+            now = time.monotonic()
+            if done or now >= deadline or self.process.poll() is not None:
                 break
-                
-        return {
-            "stdout": self._decode(b"".join(stdout_parts)),
-            "stderr": self._decode(b"".join(stderr_parts)),
-            "status": self.process.poll()
-        }
+            self._activity.wait(min(idle, deadline - now))
+
+        if done:
+            # stderr идёт отдельным потоком — даём ему догнать stdout
+            self._collect_idle(stdout_parts, stderr_parts, SHELL_GRACE, SHELL_GRACE)
+        result = self._result(stdout_parts, stderr_parts)
+        result["exit_code"] = exit_code
+        result["done"] = done
+        return result
 
     def close(self):
         try:
@@ -250,7 +383,13 @@ class Chat:
         self.final_prompt = ""
         self.blocked_tools = []
         self.settings_tools = {}
-        self.active_modes = self._load_config_json("final_prompts.json", {}).get("active_parameters", [])
+        self.tool_handlers = {}     # инструменты плагинов: имя -> handler(chat, ...)
+        self.speculative_tools = False  # запускать "speculative"-инструменты, не дожидаясь конца стрима
+        self.history_token_budget = history_compactor.HISTORY_TOKEN_BUDGET  # 0 — отправлять историю целиком
+        self.summary_model = "gemini-3.1-flash-lite-preview"  # модель для краткого содержания старой истории
+        self.python_backend = "inprocess"  # "worker" — код python_tool в отдельном процессе (python_workers.py)
+        self.offload_chars = result_store.OFFLOAD_CHARS  # результаты инструментов длиннее — в result_store (0 — не выносить)
+        self.active_modes = list(self._load_config_json("final_prompts.json", {}).get("active_parameters", []))
         
         self.models = [ #(name, rpm)
             ("gemini-3-pro-preview", 25),
@@ -284,8 +423,9 @@ class Chat:
         try:
             if not hasattr(self, 'ai_key') or not self.ai_key:
                 self._load_config()
+            key_pool.load(getattr(self, 'gemini_keys', None) or [self.ai_key])
             if not default_genai_client:
-                default_genai_client = genai.Client(api_key=self.ai_key)
+                default_genai_client = key_pool.client(0)
             self.client = default_genai_client
         except Exception as e:
             print(f"Ошибка в _setup_client: {e}")
@@ -305,16 +445,12 @@ class Chat:
         if not self.gemini_keys:
             raise ValueError(f"Не найдены файлы с ключами API Gemini.")
 
-        key_num_path = f"{self.agent_dir}/keys/gemini.key_num"
-        if not os.path.exists(key_num_path):
-            with open(key_num_path, 'w', encoding="utf8") as f:
-                f.write('0')
-        with open(key_num_path, 'r', encoding="utf8") as f: 
-            self.current_key_index = int(f.read())
+        # Ключ для каждого запроса выбирает key_pool; current_key_index — ключ клиента по умолчанию
+        self.current_key_index = 0
         self.ai_key = self.gemini_keys[self.current_key_index]
 
         self.prompts = {}
-        prompt_names = ["system", "python", "chat", "user_profile", "http", "shell", "google_search", "python_str"]
+        prompt_names = ["system", "python", "chat", "user_profile", "http", "shell", "google_search", "python_str", "tool_result"]
         for name in prompt_names:
             try:
                 with open(f"{self.agent_dir}/prompts/{name}", 'r', encoding="utf8") as f:
@@ -338,19 +474,71 @@ class Chat:
         with open("keys/search_engine.id", "r") as f:
             self.search_engine_id = f.read().strip()
 
-    def _get_tools_dicts(self):
-        tool_names = []
+    # Атрибуты, от которых зависят конфиг запроса и схемы инструментов. Присваивание
+    # нового значения увеличивает _config_version; правки на месте — через touch_config()
+    CONFIG_ATTRS = frozenset(("tools", "blocked_tools", "system_prompt", "final_prompt"))
+
+    def __setattr__(self, name, value):
+        if name in self.CONFIG_ATTRS:
+            old = self.__dict__.get(name, _MISSING)
+            if old is not value and old != value:
+                self.touch_config()
+        object.__setattr__(self, name, value)
+
+    def touch_config(self):
+        """Отмечает изменение tools, blocked_tools или промптов: кеш конфига будет пересобран."""
+        self.__dict__["_config_version"] = self.__dict__.get("_config_version", 0) + 1
+
+    def _tools_cache(self):
+        """Заранее собранные объекты для цикла инструментов; пересобираются при смене версии."""
+        stamp = self.__dict__.get("_config_version", 0)
+        cache = self.__dict__.get("_tools_cache_data")
+        if cache is not None and cache["stamp"] == stamp:
+            return cache
+
+        tool_names = {}
         tools_dict_required = {}
         tools_dict_additional = {}
+        parallel = {}      # имя parallel_safe-инструмента -> таймаут
+        speculative = {}   # идемпотентные read-only инструменты (можно стартовать во время стрима)
         for tool in self.tools:
-            tool_names.append(tool["function"]["name"])
-            tools_dict_required[tool["function"]["name"]] = tool["function"]["parameters"]["required"]
-            for parameter in tool["function"]["parameters"]["properties"].keys():
-                if parameter not in tool["function"]["parameters"]["required"]:
-                    if tool["function"]["name"] not in tools_dict_additional:
-                        tools_dict_additional[tool["function"]["name"]] = []
-                    tools_dict_additional[tool["function"]["name"]].append(parameter)
-        return tools_dict_required, tools_dict_additional, tool_names
+            name = tool["function"]["name"]
+            if tool.get("parallel_safe"):
+                parallel[name] = tool.get("timeout", TOOL_TIMEOUT)
+            if tool.get("speculative"):
+                speculative[name] = tool.get("timeout", TOOL_TIMEOUT)
+            parameters = tool["function"]["parameters"]
+            tool_names[name] = True
+            tools_dict_required[name] = parameters["required"]
+            additional = [p for p in parameters["properties"].keys() if p not in parameters["required"]]
+            if additional:
+                tools_dict_additional[name] = additional
+
+        blocked = set(getattr(self, "blocked_tools", []))
+        declarations = [t["function"] for t in self.tools if t["function"]["name"] not in blocked]
+        instruction = self.system_prompt + getattr(self, "final_prompt", "")
+        cache = self._tools_cache_data = {
+            "stamp": stamp,
+            "dicts": (tools_dict_required, tools_dict_additional, tool_names),
+            "parallel": parallel,
+            "speculative": speculative,
+            "specs": compile_specs(self.tools),
+            "instruction": instruction,
+            "static_instruction": self.system_prompt,   # в cached content — без final_prompt
+            "declarations": declarations,
+            "prefix_tokens": estimate_text(instruction) + estimate_text(json.dumps(declarations, ensure_ascii=False)),
+            "digests": {},          # модель -> хеш префикса для prompt_cache
+            "cached_configs": {},   # имя cached content -> GenerateContentConfig
+            "config": genai_types.GenerateContentConfig(
+                tools=[genai_types.Tool(function_declarations=[d]) for d in declarations],
+                system_instruction=instruction,
+                thinking_config=genai_types.ThinkingConfig(include_thoughts=True),
+            ),
+        }
+        return cache
+
+    def _get_tools_dicts(self):
+        return self._tools_cache()["dicts"]
 
     def _extract_retry_delay(self, err_str):
         import re, datetime
@@ -394,7 +582,7 @@ class Chat:
     def set_mode(self, *mode_ids):
         """Включение режимов (параметров) для текущего чата"""
         if not hasattr(self, "active_modes"):
-            self.active_modes = self._load_config_json("final_prompts.json", {}).get("active_parameters", [])
+            self.active_modes = list(self._load_config_json("final_prompts.json", {}).get("active_parameters", []))
         
         added = [mid for mid in mode_ids if mid not in self.active_modes]
         if added:
@@ -405,7 +593,7 @@ class Chat:
     def reset_mode(self, *mode_ids):
         """Выключение режимов (параметров) для текущего чата"""
         if not hasattr(self, "active_modes"):
-            self.active_modes = self._load_config_json("final_prompts.json", {}).get("active_parameters", [])
+            self.active_modes = list(self._load_config_json("final_prompts.json", {}).get("active_parameters", []))
         
         active_params = set(self.active_modes)
         removed = [mid for mid in mode_ids if mid in active_params] if '*' not in mode_ids else list(active_params)
@@ -507,7 +695,7 @@ class Chat:
 
     def __getstate__(self):
         state = self.__dict__.copy()
-        for key in ['client', 'shell_session', 'shell', 'client_genai']:
+        for key in TRANSIENT_ATTRS:
             state.pop(key, None)
         
         if 'local_env' in state:
@@ -571,7 +759,7 @@ class Chat:
             self.local_env['shell'] = ShellSession()
         return self.local_env['shell']
 
-    def shell_tool(self, action='read', input='', delay=3):
+    def shell_tool(self, action='read', input='', delay=3, timeout=SHELL_TIMEOUT):
         import time, json
         try:
             if not getattr(self, "shell_session", None) or not getattr(self.shell_session, 'process', None) or self.shell_session.process.poll() is not None:
@@ -583,6 +771,23 @@ class Chat:
                 self.shell_session = None
                 return json.dumps({"status": "rebooted", "stdout": "", "stderr": ""}, ensure_ascii=False, indent=2)
                 
+            elif action == 'run':
+                # Ждём метку завершения команды, а не фиксированную паузу
+                if not input:
+                    return json.dumps({"status": "error", "stdout": "", "stderr": "Параметр 'input' обязателен для действия 'run'."}, ensure_ascii=False, indent=2)
+                output = session.run(input, timeout=timeout)
+                if output["done"]:
+                    status_val = f"done({output['exit_code']})"
+                elif output["status"] is None:
+                    status_val = "running"
+                else:
+                    status_val = f"exited({output['status']})"
+                return json.dumps({
+                    "status": status_val,
+                    "stdout": output["stdout"],
+                    "stderr": output["stderr"]
+                }, ensure_ascii=False, indent=2)
+
             elif action == 'write':
                 if not input:
                     return json.dumps({"status": "error", "stdout": "", "stderr": "Параметр 'input' обязателен для действия 'write'."}, ensure_ascii=False, indent=2)
@@ -593,9 +798,12 @@ class Chat:
             else:
                 return json.dumps({"status": "error", "stdout": "", "stderr": f"Неизвестное действие: {action}"}, ensure_ascii=False, indent=2)
 
-            time.sleep(delay)
-            output = session.read()
+            # delay — верхняя граница: возвращаемся, как только вывод затих
+            output = session.read_idle(delay)
             status_val = "running" if output["status"] is None else f"exited({output['status']})"
+            if output["status"] is None and "exit_code" in output:
+                # Дочитали завершение команды, которую run не дождался
+                status_val = f"done({output['exit_code']})"
             return json.dumps({
                 "status": status_val, 
                 "stdout": output["stdout"], 
@@ -629,6 +837,9 @@ class Chat:
     def python_str_tool(self, text):
         return repr(text)
 
+    def tool_result_tool(self, handle, start=0, end=None, unit="lines"):
+        return result_store.read_range(handle, start, end, unit)
+
     def sandbox_tool(self, action):
         import os, subprocess, sys, shutil, socket, re, json, fnmatch, time
         
@@ -672,8 +883,7 @@ class Chat:
             must_include_patterns = {
                 'plugin_config.json', 
                 'gemini*.key', 'google.key', 'search_engine.id',
-                'keys/gemini*.key', 'keys/google.key', 'keys/search_engine.id',
-                'keys/gemini.key_num'
+                'keys/gemini*.key', 'keys/google.key', 'keys/search_engine.id'
             }
 
             def should_exclude(name, rel_path):
@@ -788,6 +998,9 @@ class Chat:
         is_valid, message = self.validate_python_code(code)
         if not is_valid:
             return f"Ошибка: {message}"
+        # Отдельный процесс на чат; коду, которому нужен объект чата (self), — только в этом процессе
+        if getattr(self, "python_backend", "inprocess") == "worker" and not python_workers.uses_name(code, "self"):
+            return python_workers.pool.execute(getattr(self, "id", None) or id(self), code, acl=security_context.get())
         try:
             self.local_env["self"] = self
             self.local_env["result"] = ''
@@ -812,15 +1025,8 @@ class Chat:
                 self.messages[-1].parts.append(genai_types.Part(text=message))
 
     def _load_config_json(self, path, default_val):
-        if os.path.exists(path):
-            try:
-                with open(path, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except Exception as e:
-                pass
-        # Новое: отладочный принт при возврате значения по умолчанию
-        print(f"⚙️ [Debug] {path} не найден или поврежден, использую default_val")
-        return default_val
+        # Разбор кешируется по mtime; результат общий для всех чатов — не изменять на месте
+        return context_cache.load_json(path, default_val)
 
     def _build_dynamic_context(self):
         presets_config = self._load_config_json("presets.json", {"default_preset_id": "default", "presets": {}})
@@ -853,7 +1059,12 @@ class Chat:
                 gather_script = mode_data.get("gather_script")
                 if gather_script:
                     try:
-                        script_res = self.python_tool(gather_script)
+                        # Вывод переиспользуется по gather_ttl / gather_deps режима (context_cache)
+                        script_res = context_cache.gather(
+                            gather_script, lambda: self.python_tool(gather_script),
+                            ttl=mode_data.get("gather_ttl"), deps=mode_data.get("gather_deps"),
+                            scope=security_context.get(),
+                        )
                         new_final_prompt += f"ДАННЫЕ РЕЖИМА:\n{script_res}\n"
                     except Exception as e:
                         new_final_prompt += f"Ошибка сбора данных режима: {e}\n"
@@ -863,16 +1074,18 @@ class Chat:
                     acl_list.append(mode_data.get("fs_permissions"))
 
         self.final_prompt = new_final_prompt
-        self.blocked_tools = preset.get("blocked", [])
-        self.settings_tools = preset.get("settings", {})
+        # presets.json разобран один раз на все чаты (context_cache) — чату достаются копии
+        self.blocked_tools = list(preset.get("blocked", []))
+        self.settings_tools = {tool: dict(values) for tool, values in preset.get("settings", {}).items()}
         
         # ACL пересечение через внутренние функции
         if hasattr(self, "fs_permissions") and "custom" in self.fs_permissions and self.fs_permissions["custom"]:
             pass
         elif acl_list:
-            self.fs_permissions = _intersect_acl_configs(acl_list)
+            self.fs_permissions = context_cache.intersect_acl(acl_list, _intersect_acl_configs)
         elif not hasattr(self, "fs_permissions"):
-            self.fs_permissions = preset.get("fs_permissions", {"global": "rwxld", "paths": {}})
+            default_acl = preset.get("fs_permissions", {"global": "rwxld", "paths": {}})
+            self.fs_permissions = {**default_acl, "paths": dict(default_acl.get("paths", {}))}
             
         chat_id = getattr(self, "id", None)
         if chat_id:
@@ -882,7 +1095,13 @@ class Chat:
                 f"chats/{chat_id}.pkl", 
                 f"chats/{chat_id}.json", 
                 f"chats/{chat_id}.pkl.tmp", 
+                f"chats/{chat_id}.state", 
+                f"chats/{chat_id}.state.tmp", 
                 f"chats/{chat_id}.json.tmp", 
+                f"chats/{chat_id}.jsonl", 
+                f"chats/{chat_id}.jsonl.tmp", 
+                f"chats/{chat_id}.meta.json", 
+                f"chats/{chat_id}.meta.json.tmp", 
                 f"chats/{chat_id}/"
             ]:
                 self.fs_permissions["paths"][cp] = "rwxld"
@@ -895,15 +1114,28 @@ class Chat:
                 return False
         return True
 
+    def register_tool(self, schema, handler):
+        """Регистрирует инструмент: объявление в self.tools (старое с тем же именем заменяется)
+        и обработчик handler(chat, *обязательные, **необязательные)."""
+        name = schema["function"]["name"]
+        self.tools = [t for t in self.tools if t["function"]["name"] != name] + [schema]
+        self.tool_handlers = {**getattr(self, "tool_handlers", {}), name: handler}
+        self.touch_config()
+
+    def _resolve_tool(self, name):
+        """Вызываемый обработчик: зарегистрированный плагином или метод <name>_tool."""
+        handler = getattr(self, "tool_handlers", {}).get(name)
+        if handler is not None:
+            return lambda *args, **kwargs: handler(self, *args, **kwargs)
+        return getattr(self, f"{name}_tool", None)
+
     def tool_exec(self, name, tool_args):
         import json
         import copy
-        
-        tools_dict_required, tools_dict_additional, tool_names = self._get_tools_dicts()
-        required = tools_dict_required.get(name, [])
-        additional = tools_dict_additional.get(name, [])
 
-        if name not in tool_names:
+        spec = self._tools_cache()["specs"].get(name)
+        func = self._resolve_tool(name) if spec else None
+        if func is None:
             return "Ошибка: неправильное название инструмента или инструмент не найден"
 
         # Логирование запроса
@@ -915,49 +1147,41 @@ class Chat:
             except:
                 self.print_code(f"Запрос {name}", str(tool_args))
 
-        args_for_exec = tool_args.copy()
-        for key, val in args_for_exec.items():
-            if isinstance(val, str):
-                args_for_exec[key] = repr(val)
-        
         try:
-            if self.check_tool_args(required, tool_args):
-                if name == 'python':
-                    tool_result = self.python_tool(tool_args['code'])
-                else:
-                    required_args_str = ', '.join(str(args_for_exec[arg]) for arg in required)
-                    additional_args_str = ', '.join(f"{arg}={args_for_exec[arg]}" for arg in additional if arg in args_for_exec)
-                    all_args = [arg for arg in [required_args_str, additional_args_str] if arg]
-                    call_string = f"result = self.{name}_tool({', '.join(all_args)})"
-                    self.python_tool(call_string, no_print=True)
-                    tool_result = self.local_env.get("result")
-
-                # Логирование результата (с очисткой от тяжелых данных)
-                print_result = tool_result
-                if isinstance(tool_result, dict):
-                    clean_result = copy.deepcopy(tool_result)
-                    if "images" in clean_result:
-                        count = len(clean_result["images"]) if isinstance(clean_result["images"], list) else 1
-                        clean_result["images"] = f"< {count} images omitted from logs >"
-                    print_result = json.dumps(clean_result, ensure_ascii=False, indent=2)
-                
-                self.print_code(f"Результат {name}", print_result)
-                return tool_result 
+            positional, named = spec.bind(tool_args)
+        except ToolArgsError as e:
+            error_message = f"Ошибка: неверные аргументы: {e}"
+            self.print_code(f"Ошибка {name}", error_message)
+            return error_message
+
+        try:
+            tool_result = func(*positional, **named)
+
+            # Логирование результата (с очисткой от тяжелых данных)
+            print_result = tool_result
+            if isinstance(tool_result, dict):
+                clean_result = copy.deepcopy(tool_result)
+                if "images" in clean_result:
+                    count = len(clean_result["images"]) if isinstance(clean_result["images"], list) else 1
+                    clean_result["images"] = f"< {count} images omitted from logs >"
+                print_result = json.dumps(clean_result, ensure_ascii=False, indent=2)
+            
+            self.print_code(f"Результат {name}", print_result)
+            return tool_result 
 
         except Exception as e:
             error_message = f"Ошибка инструмента: {e}"
             self.print_code(f"Ошибка {name}", error_message)
             return error_message
-            
-        return "Ошибка: неверные аргументы или инструмент не найден"
 
     # === OUTPUT & LOGGING ===
 
     def print(self, message, count_tab=-1, **kwargs):
+        # Через console_sink: фрагмент стрима не ждёт stdout, отступ ставится в начало каждой строки
         if count_tab == -1:
             count_tab = self.count_tab
         if message != '':
-            print('\t' * count_tab + message.replace('\n', '\n' + '\t' * count_tab), **kwargs)
+            console_sink.write(id(self), str(message) + kwargs.get('end', '\n'), prefix='\t' * count_tab)
 
     print_thought = print
 
@@ -990,83 +1214,262 @@ class Chat:
         if hasattr(self, 'fs_permissions'):
             security_token = security_context.set(self.fs_permissions)
         try:
-            if not isinstance(messages, list):
-                messages = [messages]
-
-            for msg in messages:
-                if isinstance(msg, dict):
-                    parts = []
-                    if "content" in msg and msg["content"]:
-                        parts.append(genai_types.Part(text=msg["content"]))
-                    if "images" in msg and isinstance(msg["images"], list):
-                        for img_data in msg["images"]:
-                            try:
-                                if "base64," in img_data:
-                                    header_img, b64_str = img_data.split("base64,", 1)
-                                    mime_type = header_img.split(":")[1].split(";")[0]
-                                else:
-                                    b64_str = img_data
-                                    mime_type = "image/jpeg"
-                                parts.append(genai_types.Part.from_bytes(data=base64.b64decode(b64_str), mime_type=mime_type))
-                            except Exception as e:
-                                print(f"Ошибка декодирования изображения: {e}")
-                    if parts:
-                        self.messages.append(genai_types.Content(role=msg["role"], parts=parts))
-                elif isinstance(msg, str):
-                     self.messages.append(genai_types.Content(role="user", parts=[genai_types.Part(text=msg)]))
-                else:
-                     self.messages.append(msg)
+            self._add_messages(messages)
             return self._process_request()
         finally:
             if security_token:
                 security_context.reset(security_token)
 
+    def _add_messages(self, messages):
+        """Добавляет в историю строки, словари {role, content, images} и готовые Content."""
+        if not isinstance(messages, list):
+            messages = [messages]
+
+        for msg in messages:
+            if isinstance(msg, dict):
+                parts = []
+                if "content" in msg and msg["content"]:
+                    parts.append(genai_types.Part(text=msg["content"]))
+                if "images" in msg and isinstance(msg["images"], list):
+                    for img_data in msg["images"]:
+                        try:
+                            if "base64," in img_data:
+                                header_img, b64_str = img_data.split("base64,", 1)
+                                mime_type = header_img.split(":")[1].split(";")[0]
+                            else:
+                                b64_str = img_data
+                                mime_type = "image/jpeg"
+                            parts.append(genai_types.Part.from_bytes(data=base64.b64decode(b64_str), mime_type=mime_type))
+                        except Exception as e:
+                            print(f"Ошибка декодирования изображения: {e}")
+                if parts:
+                    self.messages.append(genai_types.Content(role=msg["role"], parts=parts))
+            elif isinstance(msg, str):
+                 self.messages.append(genai_types.Content(role="user", parts=[genai_types.Part(text=msg)]))
+            else:
+                 self.messages.append(msg)
+
+    def _materialize_contents(self, messages):
+        """Подгружает байты ленивых изображений (part._blob_path) только для отправки запроса.
+        Сама история остаётся со ссылками, без копий картинок в памяти."""
+        contents = []
+        for msg in messages:
+            parts = getattr(msg, 'parts', None) or []
+            if not any(getattr(p, '_blob_path', None) and p.inline_data is not None and not p.inline_data.data for p in parts):
+                contents.append(msg)
+                continue
+            new_parts = []
+            for p in parts:
+                if getattr(p, '_blob_path', None) and p.inline_data is not None and not p.inline_data.data:
+                    try:
+                        # Блобы общие для всех чатов: в ACL чата их нет, читает сам агент
+                        with trusted_io(), open(p._blob_path, 'rb') as f:
+                            data = f.read()
+                    except OSError as e:
+                        self.print(f"Изображение {p._blob_path} недоступно: {e}")
+                        continue
+                    p = p.model_copy(update={"inline_data": genai_types.Blob(mime_type=p.inline_data.mime_type, data=data)})
+                new_parts.append(p)
+            contents.append(genai_types.Content(role=msg.role, parts=new_parts))
+        return contents
+
+    def get_generate_config(self, client=None, key_index=None):
+        cache = self._tools_cache()
+
+        # Статический префикс из кеша: system_prompt и tools уже внутри cached content,
+        # final_prompt добавляется к содержимому запроса (_with_final_prompt)
+        digest = cache["digests"].get(self.model)
+        if digest is None:
+            digest = cache["digests"][self.model] = prefix_digest(self.model, cache["static_instruction"], cache["declarations"])
+        cache_name = prompt_cache.get(client, key_index, self.model, cache["static_instruction"],
+                                      cache["declarations"], digest=digest,
+                                      owner=getattr(self, "id", None) or id(self))
+        if cache_name:
+            config = cache["cached_configs"].get(cache_name)
+            if config is None:
+                config = cache["cached_configs"][cache_name] = genai_types.GenerateContentConfig(
+                    cached_content=cache_name,
+                    thinking_config=genai_types.ThinkingConfig(include_thoughts=True),
+                )
+            return config
+
+        return cache["config"]
+
+    def _with_final_prompt(self, contents, config):
+        """С cached content system_instruction задать нельзя: final_prompt уходит первой частью запроса."""
+        final_prompt = getattr(self, "final_prompt", "")
+        if not final_prompt or not getattr(config, "cached_content", None):
+            return contents
+        part = genai_types.Part(text=final_prompt)
+        if contents and contents[0].role == "user":
+            return [genai_types.Content(role="user", parts=[part] + list(contents[0].parts or []))] + list(contents[1:])
+        return [genai_types.Content(role="user", parts=[part])] + list(contents)
+
+    def _token_ledger(self):
+        ledger = self.__dict__.get("_token_ledger_data")
+        if ledger is None:
+            ledger = self._token_ledger_data = TokenLedger()
+        return ledger
+
+    def context_tokens(self):
+        """Оценка токенов следующего запроса (префикс + история) до его отправки."""
+        ledger = self._token_ledger()
+        return ledger.calibrated(self._tools_cache()["prefix_tokens"]) + ledger.sync(self.messages)
+
+    def _estimate_request_tokens(self):
+        # Оценка размера запроса для TPM: то, что уходит сейчас (после сжатия), с поправкой по usage_metadata
+        ledger = self._token_ledger()
+        return ledger.calibrated(ledger.last_sent) if ledger.last_sent else self.context_tokens()
+
+    def _choose_key(self):
+        """Индекс ключа для запроса и клиент к нему. С одним ключом — всегда self.client."""
+        if key_pool.size() < 2:
+            return self.current_key_index, self.client
+        key_index, wait = key_pool.choose(self.model)
+        if wait > 0:
+            self.print(f"Все ключи на паузе после 429, жду {wait:.1f} секунд")
+            time.sleep(wait)
+        return key_index, key_pool.client(key_index)
+
+    def _retry_wait_after_error(self, err_str, key_index):
+        """Пауза перед повтором. 429 отправляет ключ на карантин; если есть другие ключи — повтор сразу."""
+        extracted_delay = self._extract_retry_delay(err_str)
+        wait_time = extracted_delay if extracted_delay is not None else 0.1
+        if key_index is None or key_pool.size() < 2:
+            return wait_time
+        if "429" in err_str or "resource has been exhausted" in err_str.lower():
+            key_pool.quarantine(key_index, extracted_delay)
+            if key_pool.free_count() > 0:
+                return 0.1
+        return wait_time
+
+    def _summarize_history(self, segment, previous=None):
+        """Краткое содержание старого отрезка истории дешёвой моделью (для history_compactor)."""
+        lines = []
+        for msg in segment:
+            for p in msg.parts or []:
+                if p.text:
+                    lines.append(f"{msg.role}: {p.text[:2000]}")
+                if p.function_call is not None:
+                    lines.append(f"{msg.role} вызвал {p.function_call.name}({json.dumps(p.function_call.args or {}, ensure_ascii=False, default=str)[:300]})")
+                if p.function_response is not None:
+                    lines.append(f"результат {p.function_response.name}: {json.dumps(p.function_response.response or {}, ensure_ascii=False, default=str)[:500]}")
+        prompt = self.prompts.get('history_summary') or (
+            "Сожми фрагмент диалога пользователя с агентом в краткое содержание. Сохрани цели пользователя, "
+            "принятые решения, важные факты, пути к файлам, результаты инструментов и незавершённые задачи. "
+            "Пиши сжато, без вступлений.")
+        if previous:
+            prompt += f"\n\nКраткое содержание ещё более ранней части (дополни его):\n{previous}"
+        prompt += "\n\nФрагмент диалога:\n" + "\n".join(lines)
+
+        model = getattr(self, "summary_model", None) or self.models[2][0]
+        rpm = next((r for name, r in self.models if name == model), 1000)
+        key_index, client = self._choose_key()
+        permit = rate_limiter.acquire(model, key_index, rpm, estimated_tokens=len(prompt) // 4,
+                                      chat=getattr(self, "id", None) or id(self))
+        tokens = 0
+        try:
+            response = client.models.generate_content(model=model, contents=prompt)
+            usage = getattr(response, "usage_metadata", None)
+            tokens = (getattr(usage, "total_token_count", 0) or 0) if usage else 0
+            return (response.text or "").strip() or None
+        except Exception as e:
+            self.print(f"Не удалось сжать историю: {str(e)[:100]}")
+            return None
+        finally:
+            rate_limiter.release(permit, tokens)
+
+    def _compact_history(self):
+        """История для отправки: под бюджетом history_token_budget (self.messages не меняется)."""
+        ledger = self._token_ledger()
+        prefix = self._tools_cache()["prefix_tokens"]
+        budget = getattr(self, "history_token_budget", history_compactor.HISTORY_TOKEN_BUDGET)
+        if not budget or ledger.sync(self.messages) <= budget:
+            ledger.last_sent = prefix + ledger.raw_total
+            return self.messages
+        # Компактор работает с сырыми оценками — бюджет переводим в них
+        result = history_compactor.compact(
+            self.messages, budget / ledger.ratio,
+            summarize=self._summarize_history,
+            summary_state=getattr(self, "_history_summary", None),
+        )
+        self._history_summary = result.summary_state
+        ledger.last_sent = prefix + result.tokens
+        if result.saved_tokens > 0:
+            for m in reversed(self.messages):
+                if m.role == "user":
+                    if not hasattr(m, '_metrics'): m._metrics = {}
+                    m._metrics['compacted_tokens'] = ledger.calibrated(result.saved_tokens)
+                    self._mark_message_changed(m)
+                    break
+        return result.contents
+
+    def _mark_message_changed(self, msg):
+        """Сообщение истории изменено на месте — хранилище перезапишет его при следующем сохранении,
+        а учёт токенов пересчитает его оценку."""
+        self.__dict__.setdefault('_changed_messages', []).append(msg)
+        self._token_ledger().invalidate(msg)
+
+    def _prepare_request(self):
+        """Ключ, разрешение rate_limiter, конфиг и содержимое очередного запроса (блокирующие шаги)."""
+        # Сжатие до захвата разрешения: краткое содержание запрашивается отдельным вызовом
+        contents = self._materialize_contents(self._compact_history())
+        key_index, client = self._choose_key()
+        # Общий для всех чатов лимит по (модель, ключ)
+        permit = rate_limiter.acquire(
+            self.model, key_index, self.model_rpm,
+            estimated_tokens=self._estimate_request_tokens(),
+            chat=getattr(self, "id", None) or id(self),
+            on_wait=lambda delay: self.print(f"Жду {delay:.2f} секунд"),
+        )
+        self._current_permit = permit
+        self.last_send_time = time.time()
 
-    def get_generate_config(self):
-        # 1. Сборка промпта
-        full_instruction = self.system_prompt + getattr(self, "final_prompt", "")
-        
-        # 2. Фильтрация инструментов
-        blocked = getattr(self, "blocked_tools", [])
-        allowed_tools_defs = [
-            t for t in self.tools 
-            if t["function"]["name"] not in blocked
-        ]
+        if self.print_to_console:
+            prefix = "🤖 Агент: " if self.output_mode == "user" else "⚙️ Агент (авто, ответ): "
+            self.print(prefix, end="", flush=True)
+
+        try:
+            config = self.get_generate_config(client, key_index)
+        except Exception:
+            rate_limiter.release(permit)
+            raise
+        contents = self._with_final_prompt(contents, config)
+
+        self._current_request_start_time = time.time()
+        return key_index, client, permit, config, contents
+
+    def _request_error(self, e, attempt, max_retries, key_index, config):
+        """Разбор ошибки создания запроса: (пауза перед повтором, None) или (None, текст ошибки)."""
+        err_str = str(e)
+        if getattr(config, "cached_content", None) and "cache" in err_str.lower() and attempt < max_retries:
+            # cached content истёк или недоступен для ключа — повтор с новым/без кеша
+            prompt_cache.invalidate(config.cached_content)
+            return 0, None
+
+        if _is_retryable_error(err_str) and attempt < max_retries:
+            wait_time = self._retry_wait_after_error(err_str, key_index)
+            print(f"\n⚠️ Ошибка при создании соединения ({err_str[:50]}...). Попытка {attempt}/{max_retries}, жду {wait_time:.1f}с...")
+            return wait_time, None
         
-        tools_gemini = []
-        for tool in allowed_tools_defs:
-            tools_gemini.append(genai_types.Tool(function_declarations=[tool["function"]]))
-
-        return genai_types.GenerateContentConfig(
-            tools=tools_gemini,
-            system_instruction=full_instruction,
-            thinking_config=genai_types.ThinkingConfig(include_thoughts=True),
-        )
+        error_msg = f"Произошла критическая ошибка API: {e}\n\n{traceback.format_exc()}"
+        self.print(f"\n❌ {error_msg}")
+        return None, error_msg
 
     def _process_request(self):
         max_retries = 100
         attempt = 0
         while attempt < max_retries:
             attempt += 1
+            permit = None
+            key_index = None
+            config = None
             try:
-                # Rate limiter
-                delay = 60 / self.model_rpm - (time.time() - self.last_send_time)
-                if delay > 0:
-                    if delay > 1: self.print(f"Жду {delay:.2f} секунд")
-                    time.sleep(delay)
-                self.last_send_time = time.time()
-
-                if self.print_to_console:
-                    prefix = "🤖 Агент: " if self.output_mode == "user" else "⚙️ Агент (авто, ответ): "
-                    self.print(prefix, end="", flush=True)
+                key_index, client, permit, config, contents = self._prepare_request()
 
-                config = self.get_generate_config()
-
-                self._current_request_start_time = time.time()
-
-                stream = self.client.models.generate_content_stream(
+                stream = client.models.generate_content_stream(
                     model=self.model,   
-                    contents=self.messages,
+                    contents=contents,
                     config=config,
                 )
 
@@ -1077,281 +1480,410 @@ class Chat:
                 continue
 
             except Exception as e:
-                err_str = str(e)
-                retry_errors = [
-                    "429", "Resource has been exhausted",
-                    "500", "502", "503", "504",
-                    "EOF occurred in violation of protocol",
-                    "UNEXPECTED_EOF_WHILE_READING",
-                    "RemoteProtocolError",
-                    "ConnectError",
-                    "DeadlineExceeded",
-                    "Service Unavailable",
-                    "10054", "Удаленный хост принудительно разорвал существующее подключение",
-                    "Server disconnected without sending a response"
-                ]
-                
-                if any(msg.lower() in err_str.lower() for msg in retry_errors) and attempt < max_retries:
-                    extracted_delay = self._extract_retry_delay(err_str)
-                    wait_time = extracted_delay if extracted_delay is not None else 0.1
-                    print(f"\n⚠️ Ошибка при создании соединения ({err_str[:50]}...). Попытка {attempt}/{max_retries}, жду {wait_time:.1f}с...")
-                    time.sleep(wait_time)
-                    continue
-                
-                error_msg = f"Произошла критическая ошибка API: {e}\n\n{traceback.format_exc()}"
-                self.print(f"\n❌ {error_msg}")
-                return error_msg
+                wait_time, error_msg = self._request_error(e, attempt, max_retries, key_index, config)
+                if error_msg is not None:
+                    return error_msg
+                time.sleep(wait_time)
+            finally:
+                rate_limiter.release(permit)
+
+    def _new_stream_state(self):
+        return {
+            "parts": [], "tool_calls": [], "text": "",
+            "start_time": getattr(self, '_current_request_start_time', time.time()),
+            "first_chunk_time": None,
+            "prompt_tokens": 0, "candidates_tokens": 0, "cached_tokens": 0,
+            "started": {},   # индекс вызова -> (future, дедлайн, таймаут) для speculative-инструментов
+        }
 
-    def _handle_stream(self, stream):
-        response_parts = []
-        tool_calls_buffer = []
-        full_response_text = ""
-        
-        start_time = getattr(self, '_current_request_start_time', time.time())
-        first_chunk_time = None
-        prompt_tokens = 0
-        candidates_tokens = 0
-        cached_tokens = 0
+    def _start_speculative(self, state, fc):
+        """Запускает идемпотентный read-only инструмент сразу по приходу function_call (opt-in)."""
+        if not getattr(self, "speculative_tools", False):
+            return
+        speculative = self._tools_cache()["speculative"]
+        timeout = speculative.get(fc.name)
+        if timeout is None or fc.name in getattr(self, "blocked_tools", []):
+            return
+        # Чтение не должно обгонять более ранний вызов, который может изменить состояние
+        if any(c.name not in speculative for c in state["tool_calls"][:-1]):
+            return
+        name, args = self._parse_tool_calls([fc])[0]
+        ctx = contextvars.copy_context()  # ACL (security_context) действует и в потоке пула
+        future = _get_tool_pool().submit(ctx.run, self._run_tool_call, name, args)
+        state["started"][len(state["tool_calls"]) - 1] = (future, time.monotonic() + timeout, timeout)
+
+    def _consume_chunk(self, state, chunk):
+        """Один чанк стрима: usage_metadata, вывод текста/мыслей, накопление частей и вызовов."""
+        if state["first_chunk_time"] is None:
+            state["first_chunk_time"] = time.time()
         
         try:
-            for chunk in stream:
-                if first_chunk_time is None:
-                    first_chunk_time = time.time()
-                
-                try:
-                    usage = getattr(chunk, 'usage_metadata', None)
-                    if usage:
-                        p_count = getattr(usage, 'prompt_token_count', 0)
-                        c_count = getattr(usage, 'candidates_token_count', 0)
-                        cache_count = getattr(usage, 'cached_content_token_count', 0)
-                        if p_count: prompt_tokens = p_count
-                        if c_count: candidates_tokens = c_count
-                        if cache_count: cached_tokens = cache_count
-                except:
-                    pass
-                        
-                if not getattr(chunk, 'candidates', None) or not chunk.candidates[0].content or not getattr(chunk.candidates[0].content, 'parts', None):
-                    continue
+            usage = getattr(chunk, 'usage_metadata', None)
+            if usage:
+                p_count = getattr(usage, 'prompt_token_count', 0)
+                c_count = getattr(usage, 'candidates_token_count', 0)
+                cache_count = getattr(usage, 'cached_content_token_count', 0)
+                if p_count: state["prompt_tokens"] = p_count
+                if c_count: state["candidates_tokens"] = c_count
+                if cache_count: state["cached_tokens"] = cache_count
+        except:
+            pass
                 
-                for part in chunk.candidates[0].content.parts:
-                    response_parts.append(part)
-                    
-                    if getattr(part, 'text', None):
-                        is_thought = getattr(part, 'thought', False)
-                        if is_thought:
-                            if self.print_to_console:
-                                self.print("Мысль:", end='\t\t\t')
-                            self.print_thought(part.text, flush=True, end='')
-                        else:
-                            self.print(part.text, flush=True, end='')
-                            full_response_text += part.text
-                    
-                    if getattr(part, 'function_call', None):
-                        tool_calls_buffer.append(part.function_call)
-
-            self.print("")
+        if not getattr(chunk, 'candidates', None) or not chunk.candidates[0].content or not getattr(chunk.candidates[0].content, 'parts', None):
+            return
+        
+        for part in chunk.candidates[0].content.parts:
+            state["parts"].append(part)
             
-            end_time = time.time()
-            if first_chunk_time is None:
-                first_chunk_time = end_time
-                
-            input_time = first_chunk_time - start_time
-            output_time = end_time - first_chunk_time
+            if getattr(part, 'text', None):
+                is_thought = getattr(part, 'thought', False)
+                if is_thought:
+                    if self.print_to_console:
+                        self.print("Мысль:", end='\t\t\t')
+                    self.print_thought(part.text, flush=True, end='')
+                else:
+                    self.print(part.text, flush=True, end='')
+                    state["text"] += part.text
             
-            model_msg = genai_types.Content(role="model", parts=response_parts)
-            self.messages.append(model_msg)
-
-            # --- МЕТРИКИ ---
-            last_user = None
-            for m in reversed(self.messages[:-1]):
-                if getattr(m, 'role', '') == 'user':
-                    last_user = m
-                    break
+            if getattr(part, 'function_call', None):
+                state["tool_calls"].append(part.function_call)
+                self._start_speculative(state, part.function_call)
+
+    def _finish_stream(self, state):
+        """Конец стрима: ответ модели в историю, метрики токенов и времени."""
+        prompt_tokens = state["prompt_tokens"]
+        candidates_tokens = state["candidates_tokens"]
+        cached_tokens = state["cached_tokens"]
+
+        self.print("")
+
+        # Запрос завершён: отдаём разрешение до выполнения инструментов
+        rate_limiter.release(getattr(self, '_current_permit', None), prompt_tokens + candidates_tokens)
+        self._current_permit = None
+        prompt_cache.record_usage(prompt_tokens, cached_tokens)
+        
+        end_time = time.time()
+        first_chunk_time = state["first_chunk_time"]
+        if first_chunk_time is None:
+            first_chunk_time = end_time
+            
+        input_time = first_chunk_time - state["start_time"]
+        output_time = end_time - first_chunk_time
+        
+        model_msg = genai_types.Content(role="model", parts=state["parts"])
+        self.messages.append(model_msg)
+
+        # --- МЕТРИКИ ---
+        last_user = None
+        for m in reversed(self.messages[:-1]):
+            if getattr(m, 'role', '') == 'user':
+                last_user = m
+                break
+        
+        ledger = self._token_ledger()
+        if prompt_tokens > 0:
+            ledger.reconcile(ledger.last_sent, prompt_tokens)
+        last_reply, ledger.last_reply = ledger.last_reply, (model_msg, prompt_tokens + candidates_tokens)
+
+        if last_user:
+            if not hasattr(last_user, '_metrics'):
+                last_user._metrics = {}
             
-            if last_user:
-                if not hasattr(last_user, '_metrics'):
-                    last_user._metrics = {}
+            if prompt_tokens > 0:
+                # 1. Считаем дельту (вес только текущего сообщения)
+                prev_context = 0
+                prev_output = 0
                 
-                if prompt_tokens > 0:
-                    # 1. Считаем дельту (вес только текущего сообщения)
-                    prev_context = 0
-                    prev_output = 0
-                    
-                    found_prev = False
-                    for m in reversed(self.messages[:-2]):
-                        if getattr(m, 'role', '') == 'user' and hasattr(m, '_metrics') and 'total_context' in m._metrics:
-                            prev_context = m._metrics['total_context']
-                            found_prev = True
-                        elif getattr(m, 'role', '') == 'model' and hasattr(m, '_metrics') and 'output_tokens' in m._metrics and not found_prev:
-                            prev_output += m._metrics['output_tokens']
-                            
-                        if found_prev:
-                            break
-                    
-                    delta = prompt_tokens - (prev_context + prev_output)
-                    msg_tokens = max(0, delta) if prev_context > 0 else prompt_tokens
-                    
-                    last_user._metrics['input_tokens'] = msg_tokens
-                    
-                    # 2. Сохраняем сырые данные для глобальной суммы
-                    last_user._metrics['total_context'] = prompt_tokens
-                    
-                    # 3. Кеш и оплачиваемые токены (uncached)
-                    if cached_tokens > 0:
-                        last_user._metrics['cached_tokens'] = cached_tokens
-                        last_user._metrics['uncached_tokens'] = prompt_tokens - cached_tokens
-                    else:
-                        last_user._metrics['uncached_tokens'] = prompt_tokens
+                found_prev = False
+                if last_reply and last_reply[1] and len(self.messages) >= 3 \
+                        and self.messages[-2] is last_user and self.messages[-3] is last_reply[0]:
+                    # Обычный ход: предыдущий ответ модели прямо перед этим сообщением — дельта без обхода истории
+                    prev_context, found_prev = last_reply[1], True
+                for m in ([] if found_prev else reversed(self.messages[:-2])):
+                    if getattr(m, 'role', '') == 'user' and hasattr(m, '_metrics') and 'total_context' in m._metrics:
+                        prev_context = m._metrics['total_context']
+                        found_prev = True
+                    elif getattr(m, 'role', '') == 'model' and hasattr(m, '_metrics') and 'output_tokens' in m._metrics and not found_prev:
+                        prev_output += m._metrics['output_tokens']
+                        
+                    if found_prev:
+                        break
+                
+                delta = prompt_tokens - (prev_context + prev_output)
+                msg_tokens = max(0, delta) if prev_context > 0 else prompt_tokens
+                
+                last_user._metrics['input_tokens'] = msg_tokens
+                
+                # 2. Сохраняем сырые данные для глобальной суммы
+                last_user._metrics['total_context'] = prompt_tokens
+                
+                # 3. Кеш и оплачиваемые токены (uncached)
+                if cached_tokens > 0:
+                    last_user._metrics['cached_tokens'] = cached_tokens
+                    last_user._metrics['uncached_tokens'] = prompt_tokens - cached_tokens
+                else:
+                    last_user._metrics['uncached_tokens'] = prompt_tokens
 
-                last_user._metrics['input_time'] = input_time
-            
-            if not hasattr(model_msg, '_metrics'):
-                model_msg._metrics = {}
-            if candidates_tokens > 0:
-                model_msg._metrics['output_tokens'] = candidates_tokens
-            model_msg._metrics['output_time'] = output_time
-            model_msg._metrics['input_time'] = input_time
-            # -------------
-
-            if tool_calls_buffer:
-                res = self._execute_tool_calls(tool_calls_buffer)
+            last_user._metrics['input_time'] = input_time
+            self._mark_message_changed(last_user)
+        
+        if not hasattr(model_msg, '_metrics'):
+            model_msg._metrics = {}
+        if candidates_tokens > 0:
+            model_msg._metrics['output_tokens'] = candidates_tokens
+        model_msg._metrics['output_time'] = output_time
+        model_msg._metrics['input_time'] = input_time
+        # -------------
+
+    def _stream_error(self, e):
+        """Ошибка во время стрима: (пауза перед повтором, None) или (None, текст ошибки)."""
+        e_trace = traceback.format_exc()
+        err_str = str(e)
+        if _is_retryable_error(err_str):
+            permit = getattr(self, '_current_permit', None)
+            wait_time = self._retry_wait_after_error(err_str, permit.key[1] if permit else None)
+            print(f"\n⚠️ Ошибка в процессе получения данных ({err_str[:50]}...). Ожидание {wait_time}с и повтор...")
+            return wait_time + 1, None
+        self.print(f"\n❌ Ошибка обработки стрима: {e}\n{e_trace}")
+        return None, f"Ошибка обработки стрима: {e}"
+
+    def _handle_stream(self, stream):
+        state = self._new_stream_state()
+        try:
+            for chunk in stream:
+                self._consume_chunk(state, chunk)
+            self._finish_stream(state)
+
+            full_response_text = state["text"]
+            if state["tool_calls"]:
+                res = self._execute_tool_calls(state["tool_calls"], state["started"])
                 if res:
                     full_response_text += res
 
             return full_response_text 
 
         except Exception as e:
-            e_trace = traceback.format_exc()
-            err_str = str(e)
-            
-            retry_errors = [
-                "429", "Resource has been exhausted",
-                "500", "502", "503", "504",
-                "EOF occurred in violation of protocol",
-                "UNEXPECTED_EOF_WHILE_READING",
-                "RemoteProtocolError",
-                "ConnectError",
-                "DeadlineExceeded",
-                "10054", "Удаленный хост принудительно разорвал существующее подключение",
-                "Server disconnected without sending a response"
-            ]
-
-            if any(msg.lower() in err_str.lower() for msg in retry_errors):
-                extracted_delay = self._extract_retry_delay(err_str)
-                wait_time = extracted_delay if extracted_delay is not None else 0.1
-                print(f"\n⚠️ Ошибка в процессе получения данных ({err_str[:50]}...). Ожидание {wait_time}с и повтор...")
-                time.sleep(wait_time + 1)
-                return None
-            else:
-                self.print(f"\n❌ Ошибка обработки стрима: {e}\n{e_trace}")
-                return f"Ошибка обработки стрима: {e}"
+            wait_time, error_msg = self._stream_error(e)
+            if error_msg is not None:
+                return error_msg
+            time.sleep(wait_time)
+            return None
 
-    def _execute_tool_calls(self, tool_calls):
+    def _parse_tool_calls(self, tool_calls):
         import json
-        import base64
-        from google.genai import types as genai_types
-        
-        response_parts = []
-        
+        calls = []
         for fc in tool_calls:
-            name = fc.name
             args = fc.args
-            
             if not isinstance(args, dict):
                 try:
                     args = json.loads(args)
                 except:
                     args = {}
+            calls.append((fc.name, args))
+        return calls
+
+    def _run_tool_calls(self, calls, started=None):
+        """Результаты вызовов в исходном порядке.
+        started — вызовы, уже запущенные во время стрима (speculative); независимые
+        инструменты (parallel_safe в tools.json) стартуют сразу в пуле, остальные
+        выполняются здесь по порядку."""
+        parallel = self._tools_cache()["parallel"]
+        results = [None] * len(calls)
+        futures = dict(started or {})
+        if sum(1 for i, (name, _) in enumerate(calls) if name in parallel and i not in futures) > 1:
+            for i, (name, args) in enumerate(calls):
+                if name in parallel and i not in futures:
+                    ctx = contextvars.copy_context()  # ACL (security_context) действует и в потоке пула
+                    future = _get_tool_pool().submit(ctx.run, self._run_tool_call, name, args)
+                    futures[i] = (future, time.monotonic() + parallel[name], parallel[name])
+        for i, (name, args) in enumerate(calls):
+            if i not in futures:
+                results[i] = self._run_tool_call(name, args)
+        for i, (future, deadline, timeout) in futures.items():
+            name = calls[i][0]
+            try:
+                results[i] = future.result(max(0.0, deadline - time.monotonic()))
+            except concurrent.futures.TimeoutError:
+                results[i] = f"Ошибка: инструмент {name} не ответил за {timeout} секунд."
+                self.print_code(f"Ошибка {name}", results[i])
+            except Exception as e:
+                results[i] = f"Ошибка инструмента: {e}"
+        return results
 
-            # Выполнение инструмента
-            # Guard: Blocked tools
-            if name in getattr(self, "blocked_tools", []):
-                result = f"Ошибка: Инструмент {name} заблокирован пресетом."
-            else:
-                # Overrides: Settings tools
-                overrides = getattr(self, "settings_tools", {}).get(name, {})
-                if overrides:
-                    original_args = args.copy() if isinstance(args, dict) else {}
-                    conflicts = [k for k in overrides if k in original_args and original_args[k] != overrides[k]]
-                    
-                    if isinstance(args, dict):
-                        args.update(overrides)
-                    
-                    result = self.tool_exec(name, args)
-                    
-                    if conflicts:
-                        notes = ", ".join(conflicts)
-                        if isinstance(result, str):
-                            result += f"\n[Внимание: Аргументы ({notes}) были переопределены настройками пресета]"
-                else:
-                    result = self.tool_exec(name, args)
-            
-            # Подготовка данных для FunctionResponse
-            res_payload = {"result": result}
-            fr_parts = []
-            
-            # Если инструмент вернул словарь, проверяем наличие изображений
-            if isinstance(result, dict):
-                res_payload = result.copy()
-                # Извлекаем изображения, если они есть
-                images = res_payload.pop("images", [])
-                if not isinstance(images, list):
-                    images = [images]
-                
-                for img in images:
-                    try:
-                        if isinstance(img, str):
-                            if "base64," in img:
-                                header, b64_str = img.split("base64,", 1)
-                                mime = header.split(":")[1].split(";")[0]
-                                data = base64.b64decode(b64_str)
-                            else:
-                                data = base64.b64decode(img)
-                                mime = "image/jpeg"
-                        elif isinstance(img, bytes):
-                            data = img
-                            mime = "image/jpeg"
-                        else:
-                            continue
-                            
-                        # Используем структуру для мультимодальных ответов инструментов
-                        fr_parts.append(genai_types.FunctionResponsePart(
-                            inline_data=genai_types.FunctionResponseBlob(
-                                mime_type=mime,
-                                data=data
-                            )
-                        ))
-                    except Exception as e:
-                        self.print(f"Ошибка обработки изображения в ответе инструмента: {e}")
-            
-            # Создаем Part с ответом функции
-            response_parts.append(genai_types.Part(
-                function_response=genai_types.FunctionResponse(
-                    name=name,
-                    response=res_payload,
-                    parts=fr_parts if fr_parts else None
-                )
-            ))
-        
+    def _append_tool_responses(self, calls, results):
         # Добавляем ответы инструментов в историю (от имени user по протоколу Gemini)
+        response_parts = [self._tool_response_part(name, result) for (name, _), result in zip(calls, results)]
         self.messages.append(genai_types.Content(role="user", parts=response_parts))
 
+    def _execute_tool_calls(self, tool_calls, started=None):
+        calls = self._parse_tool_calls(tool_calls)
+        self._append_tool_responses(calls, self._run_tool_calls(calls, started))
+
         # Продолжаем диалог с новыми данными
         return self._process_request()
 
-    def _switch_api_key(self):
-        self.current_key_index = (self.current_key_index + 1) % len(self.gemini_keys)
-        with open(f"{self.agent_dir}/keys/gemini.key_num", 'w', encoding="utf8") as f:
-            f.write(str(self.current_key_index))
-        self.ai_key = self.gemini_keys[self.current_key_index]
-        self._setup_client()
-        self.print(f"🔑 Превышен лимит запросов. Переключаюсь на следующий ключ ({self.current_key_index + 1}/{len(self.gemini_keys)}).")
+    # === ASYNC ===
+    # Тот же цикл «запрос → стрим → инструменты» на asyncio: генерация идёт через
+    # client.aio и не держит поток ОС, поэтому один процесс может вести десятки
+    # разговоров на одном цикле событий. Блокирующие шаги (ожидание rate_limiter,
+    # сами инструменты) уходят в asyncio.to_thread. История и метрики — общие с
+    # синхронной версией (_consume_chunk / _finish_stream / _append_tool_responses).
+
+    async def send_async(self, messages):
+        """Асинхронный вариант send."""
+        await asyncio.to_thread(self._build_dynamic_context)
+        security_token = None
+        if hasattr(self, 'fs_permissions'):
+            security_token = security_context.set(self.fs_permissions)
+        try:
+            self._add_messages(messages)
+            return await self._process_request_async()
+        finally:
+            if security_token:
+                security_context.reset(security_token)
+
+    async def _process_request_async(self):
+        max_retries = 100
+        attempt = 0
+        while attempt < max_retries:
+            attempt += 1
+            permit = None
+            key_index = None
+            config = None
+            try:
+                key_index, client, permit, config, contents = await asyncio.to_thread(self._prepare_request)
+
+                stream = await client.aio.models.generate_content_stream(
+                    model=self.model,
+                    contents=contents,
+                    config=config,
+                )
+
+                res = await self._handle_stream_async(stream)
+                if res is not None:
+                    return res
+                continue
+
+            except Exception as e:
+                wait_time, error_msg = self._request_error(e, attempt, max_retries, key_index, config)
+                if error_msg is not None:
+                    return error_msg
+                await asyncio.sleep(wait_time)
+            finally:
+                rate_limiter.release(permit)
+
+    async def _handle_stream_async(self, stream):
+        state = self._new_stream_state()
+        try:
+            async for chunk in stream:
+                self._consume_chunk(state, chunk)
+            self._finish_stream(state)
+
+            full_response_text = state["text"]
+            if state["tool_calls"]:
+                calls = self._parse_tool_calls(state["tool_calls"])
+                results = await asyncio.to_thread(self._run_tool_calls, calls, state["started"])
+                self._append_tool_responses(calls, results)
+                res = await self._process_request_async()
+                if res:
+                    full_response_text += res
+
+            return full_response_text
+
+        except Exception as e:
+            wait_time, error_msg = self._stream_error(e)
+            if error_msg is not None:
+                return error_msg
+            await asyncio.sleep(wait_time)
+            return None
+
+    def _run_tool_call(self, name, args):
+        """Выполнение одного вызова с учётом блокировок и настроек пресета."""
+        # Guard: Blocked tools
+        if name in getattr(self, "blocked_tools", []):
+            result = f"Ошибка: Инструмент {name} заблокирован пресетом."
+        else:
+            # Overrides: Settings tools
+            overrides = getattr(self, "settings_tools", {}).get(name, {})
+            if overrides:
+                original_args = args.copy() if isinstance(args, dict) else {}
+                conflicts = [k for k in overrides if k in original_args and original_args[k] != overrides[k]]
+                
+                if isinstance(args, dict):
+                    args.update(overrides)
+                
+                result = self.tool_exec(name, args)
+                
+                if conflicts:
+                    notes = ", ".join(conflicts)
+                    if isinstance(result, str):
+                        result += f"\n[Внимание: Аргументы ({notes}) были переопределены настройками пресета]"
+            else:
+                result = self.tool_exec(name, args)
+        return result
+
+    def _tool_response_part(self, name, result):
+        """Part с FunctionResponse; изображения из словаря-результата уходят в parts."""
+        import base64
+        from google.genai import types as genai_types
+
+        # Большие результаты — в result_store, в истории остаются начало, конец и handle
+        if name != "tool_result":
+            result = result_store.offload(name, result, getattr(self, "offload_chars", result_store.OFFLOAD_CHARS))
+
+        # Подготовка данных для FunctionResponse
+        res_payload = {"result": result}
+        fr_parts = []
+        
+        # Если инструмент вернул словарь, проверяем наличие изображений
+        if isinstance(result, dict):
+            res_payload = result.copy()
+            # Извлекаем изображения, если они есть
+            images = res_payload.pop("images", [])
+            if not isinstance(images, list):
+                images = [images]
+            
+            for img in images:
+                try:
+                    if isinstance(img, str):
+                        if "base64," in img:
+                            header, b64_str = img.split("base64,", 1)
+                            mime = header.split(":")[1].split(";")[0]
+                            data = base64.b64decode(b64_str)
+                        else:
+                            data = base64.b64decode(img)
+                            mime = "image/jpeg"
+                    elif isinstance(img, bytes):
+                        data = img
+                        mime = "image/jpeg"
+                    else:
+                        continue
+                        
+                    # Используем структуру для мультимодальных ответов инструментов
+                    fr_parts.append(genai_types.FunctionResponsePart(
+                        inline_data=genai_types.FunctionResponseBlob(
+                            mime_type=mime,
+                            data=data
+                        )
+                    ))
+                except Exception as e:
+                    self.print(f"Ошибка обработки изображения в ответе инструмента: {e}")
+        
+        # Создаем Part с ответом функции
+        return genai_types.Part(
+            function_response=genai_types.FunctionResponse(
+                name=name,
+                response=res_payload,
+                parts=fr_parts if fr_parts else None
+            )
+        )
 
 def main():
     print("🚀 AI-агент запущен (Gemini Native Mode). Введите ваш запрос.")
     chat_agent = Chat(print_to_console=True)
     try:
         while True:
+            console_sink.flush()
             user_input = input("\n👤 Вы: ")
             chat_agent.send(user_input)
     except KeyboardInterrupt:
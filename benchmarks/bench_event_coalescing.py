@@ -0,0 +1,56 @@
+import os
+import sys
+import json
+import time
+import threading
+
+# Add project root to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import plugins.web_interface.event_hub as event_hub
+
+# Сколько SSE-кадров и CPU уходит на поток мелких фрагментов с окном склейки и без.
+# Запуск: python benchmarks/bench_event_coalescing.py [кол-во фрагментов] [фрагментов в секунду]
+
+def run(n_fragments, rate, window):
+    hub = event_hub.EventHub()
+    hub.configure(window=window)
+    sub = hub.subscribe()
+    sent = {"frames": 0, "bytes": 0, "decode_cpu": 0.0}
+    done = threading.Event()
+
+    def consumer():
+        # Имитация handle_stream (json.dumps + запись) и браузера (JSON.parse кадра)
+        while not done.is_set() or sub.buffer:
+            for event_id, event in sub.get(timeout=0.05):
+                frame = f"id: {event_id}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n".encode()
+                sent["frames"] += 1
+                sent["bytes"] += len(frame)
+                start = time.process_time()
+                json.loads(frame.split(b"data: ", 1)[1])
+                sent["decode_cpu"] += time.process_time() - start
+
+    thread = threading.Thread(target=consumer)
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    thread.start()
+    for i in range(n_fragments):
+        hub.emit({"type": "text", "chatId": "bench", "data": f"tok{i} "})
+        if rate:
+            time.sleep(1 / rate)
+    hub.emit({"type": "finish", "chatId": "bench", "data": {}})
+    done.set()
+    thread.join()
+    wall = time.perf_counter() - wall_start
+    return sent["frames"], sent["frames"] / wall, (time.process_time() - cpu_start) * 1000, sent["decode_cpu"] * 1000
+
+def main():
+    n_fragments = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    print(f"fragments: {n_fragments}, rate: {rate:.0f}/s")
+    print(f"{'window':<10}{'frames':>10}{'frames/s':>12}{'cpu, ms':>12}{'parse, ms':>12}")
+    for window in (0, 0.03):
+        frames, fps, cpu, parse = run(n_fragments, rate, window)
+        print(f"{window * 1000:<10.0f}{frames:>10}{fps:>12.1f}{cpu:>12.1f}{parse:>12.2f}")
+
+if __name__ == "__main__":
+    main()
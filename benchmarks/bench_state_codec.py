@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+from unittest.mock import MagicMock, patch
+
+# Add project root to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'plugins', 'web_interface')))
+
+import dill
+import agent
+import state_codec
+from google.genai import types
+
+# Сравнение старого формата (dill всего Chat в .pkl) с дельта-форматом .state.
+# Запуск: python benchmarks/bench_state_codec.py [кол-во сообщений] > bench_output.txt
+
+def make_chat(n_messages):
+    def dummy_load(self):
+        self.ai_key = "dummy"
+        self.gemini_keys = ["dummy"]
+        self.current_key_index = 0
+        self.prompts = {"system": "sys " * 5000}
+        self.user_profile = "{}"
+        with open("agent.py", "r", encoding="utf-8") as f:
+            self.self_code = f.read()
+        self.saved_code = ""
+        self.google_search_key = "dummy"
+        self.search_engine_id = "dummy"
+
+    with patch('agent.Chat._load_config', dummy_load), patch('google.genai.Client', return_value=MagicMock()):
+        template = agent.Chat()
+    template.client = None
+    # Имитация start.py: код загрузчика и дерево файлов в системном промпте
+    template.system_prompt = ("start.py tree\n" * 3000) + template.system_prompt
+
+    chat = dill.copy(template)
+    chat.id = "bench"
+    for i in range(n_messages):
+        role = "user" if i % 2 == 0 else "model"
+        chat.messages.append(types.Content(role=role, parts=[types.Part(text=f"message {i} " * 40)]))
+    chat.local_env["counter"] = n_messages
+    return template, chat
+
+def timeit(fn, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, res
+
+def main():
+    n_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    template, chat = make_chat(n_messages)
+    state_codec.register_template(template)
+
+    t_dill_save, pkl_blob = timeit(lambda: dill.dumps(chat))
+    t_dill_load, _ = timeit(lambda: dill.loads(pkl_blob))
+    t_state_save, state_blob = timeit(lambda: state_codec.encode(chat))
+    t_state_load, _ = timeit(lambda: state_codec.decode(state_blob, lambda: dill.copy(template)))
+
+    print(f"messages: {n_messages}")
+    print(f"{'format':<8}{'size, KB':>12}{'save, ms':>12}{'load, ms':>12}")
+    print(f"{'pkl':<8}{len(pkl_blob) / 1024:>12.1f}{t_dill_save * 1000:>12.2f}{t_dill_load * 1000:>12.2f}")
+    print(f"{'state':<8}{len(state_blob) / 1024:>12.1f}{t_state_save * 1000:>12.2f}{t_state_load * 1000:>12.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import sys
+import time
+import atexit
+import threading
+import collections
+
+# Фоновый вывод в консоль.
+# Chat.print и принтеры веб-интерфейса вызываются на каждый фрагмент стрима; прямой
+# print(..., flush=True) из десятков параллельных чатов упирается в блокировку stdout.
+# Здесь фрагмент только кладётся в кольцевой буфер (deque, без блокировок), а
+# фоновый поток раз в flush_interval собирает из фрагментов строки по каждому
+# чату отдельно, добавляет префикс в начало строки и пишет всё одним вызовом write.
+# Незаконченную строку выводит сразу, только если консоль сейчас «принадлежит»
+# этому чату; строки других чатов ждут перевода строки (или PARTIAL_TIMEOUT),
+# так что потоки разных чатов не перемешиваются внутри строки.
+# При переполнении буфера старые фрагменты отбрасываются (в веб они уже ушли).
+
+FLUSH_INTERVAL = 0.05     # секунды между сбросами; 0 — писать синхронно
+RING_CAPACITY = 20000     # фрагментов в буфере
+PARTIAL_TIMEOUT = 1.0     # через столько секунд незаконченная строка выводится всё равно
+
+class ConsoleSink:
+    def __init__(self, stream=None, flush_interval=FLUSH_INTERVAL, capacity=RING_CAPACITY):
+        self.stream = stream
+        self.flush_interval = flush_interval
+        self._ring = collections.deque(maxlen=capacity)
+        self._lines = {}            # ключ чата -> [префикс, текст незаконченной строки, время начала]
+        self._owner = None          # чей незаконченный вывод сейчас в конце консоли
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.stats = {"fragments": 0, "writes": 0, "dropped": 0}
+
+    def configure(self, flush_interval=None, capacity=None):
+        self.flush()
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        if capacity is not None and capacity != self._ring.maxlen:
+            self._ring = collections.deque(self._ring, maxlen=capacity)
+
+    def write(self, key, text, prefix=""):
+        """Ставит фрагмент в очередь; prefix добавляется в начало каждой новой строки этого ключа."""
+        if not text:
+            return
+        if not self.flush_interval:
+            with self._write_lock:
+                self._emit([(key, text, prefix)])
+            return
+        ring = self._ring
+        if len(ring) == ring.maxlen:
+            self.stats["dropped"] += 1
+        ring.append((key, text, prefix))
+        if self._thread is None:
+            self._start()
+        elif len(ring) > ring.maxlen // 2:
+            self._wake.set()
+
+    def flush(self):
+        """Синхронно выводит всё накопленное, включая незаконченные строки."""
+        with self._write_lock:
+            self._emit(self._drain(), force=True)
+
+    def _start(self):
+        with self._write_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="console-sink", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval or FLUSH_INTERVAL)
+            self._wake.clear()
+            try:
+                with self._write_lock:
+                    self._emit(self._drain())
+            except Exception:
+                pass
+
+    def _drain(self):
+        items = []
+        ring = self._ring
+        while True:
+            try:
+                items.append(ring.popleft())
+            except IndexError:
+                return items
+
+    def _emit(self, items, force=False):
+        # Вызывается под _write_lock
+        out = []
+        now = time.monotonic()
+        self.stats["fragments"] += len(items)
+        for key, text, prefix in items:
+            line = self._lines.get(key)
+            if line is None:
+                line = self._lines[key] = [prefix, "", now]
+            pieces = text.split("\n")
+            for piece in pieces[:-1]:
+                out.append((key, line[1] + piece + "\n", line[0]))
+                line[0], line[1], line[2] = prefix, "", now
+            line[1] += pieces[-1]
+            if line[1] == "":
+                line[0] = prefix
+
+        chunks = []
+        for key, text, prefix in out:
+            chunks.append(self._take_console(key, prefix, text, complete=True))
+        for key, line in list(self._lines.items()):
+            if not line[1]:
+                continue
+            if force or self._owner in (None, key) or now - line[2] > PARTIAL_TIMEOUT:
+                chunks.append(self._take_console(key, line[0], line[1], complete=False))
+                line[1] = ""
+        text = "".join(chunks)
+        if not text:
+            return
+        stream = self.stream or sys.stdout
+        try:
+            stream.write(text)
+            stream.flush()
+        except Exception:
+            pass
+        self.stats["writes"] += 1
+
+    def _take_console(self, key, prefix, text, complete):
+        """Текст для консоли с учётом того, кто сейчас дописывает последнюю строку."""
+        if self._owner == key:
+            head = ""                      # продолжаем уже начатую строку этого чата
+        elif self._owner is None:
+            head = prefix
+        else:
+            head = "\n" + prefix           # чужая строка не закончена — начинаем новую
+        self._owner = None if complete else key
+        return head + text
+
+sink = ConsoleSink()
+atexit.register(sink.flush)
+
+def write(key, text, prefix=""):
+    sink.write(key, text, prefix)
+
+def flush():
+    sink.flush()
@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+# Кеши для _build_dynamic_context (вызывается на каждое сообщение пользователя).
+# - JSON-конфиги (presets.json, final_prompts.json) разбираются заново только
+#   при смене mtime/размера файла;
+# - пересечение ACL запоминается по хешу входных правил;
+# - вывод gather_script режима переиспользуется, если режим объявил
+#   "gather_ttl" (секунды) и/или "gather_deps" (пути; "dir/**" — всё дерево):
+#   скрипт перезапускается, когда истёк TTL или изменился какой-то из путей.
+#   Режимы без этих полей выполняются каждый раз, как раньше.
+
+GATHER_SKIP_DIRS = {"__pycache__", ".git", "node_modules", "venv", ".venv", "env", "chats", "temp", "sandbox"}
+ACL_CACHE_SIZE = 64
+GATHER_CACHE_SIZE = 64
+
+_lock = threading.Lock()
+_json_cache = {}     # путь -> (mtime_ns, size, данные)
+_acl_cache = {}      # хеш правил -> результат пересечения
+_gather_cache = {}   # хеш (скрипт, область) -> {"output", "at", "fingerprint"}
+stats = {"json_hits": 0, "json_loads": 0, "acl_hits": 0, "gather_hits": 0, "gather_runs": 0}
+
+def load_json(path, default_val):
+    """Разобранный JSON-файл; повторно читается только после изменения. Результат общий — не изменять."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return default_val
+    with _lock:
+        cached = _json_cache.get(path)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            stats["json_hits"] += 1
+            return cached[2]
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except Exception:
+        return default_val
+    with _lock:
+        _json_cache[path] = (st.st_mtime_ns, st.st_size, data)
+        stats["json_loads"] += 1
+    return data
+
+def _digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+def intersect_acl(acl_list, intersect):
+    """intersect(acl_list) с кешем по хешу входа. Возвращает копию: вызывающий дописывает пути чата."""
+    key = _digest(acl_list)
+    with _lock:
+        result = _acl_cache.get(key)
+        if result is not None:
+            stats["acl_hits"] += 1
+    if result is None:
+        result = intersect(acl_list)
+        with _lock:
+            if len(_acl_cache) >= ACL_CACHE_SIZE:
+                _acl_cache.pop(next(iter(_acl_cache)))
+            _acl_cache[key] = result
+    return {**result, "paths": dict(result.get("paths", {}))}
+
+def deps_fingerprint(deps):
+    """Хеш состояния путей: mtime и размер файла/папки, для "dir/**" — всех вложенных."""
+    state = []
+    for dep in deps:
+        recursive = dep.endswith("/**")
+        root = dep[:-3] if recursive else dep
+        try:
+            st = os.stat(root)
+            state.append((dep, st.st_mtime_ns, st.st_size))
+        except OSError:
+            state.append((dep, None, None))
+            continue
+        if not recursive:
+            continue
+        for current, dirs, files in os.walk(root):
+            dirs[:] = sorted(d for d in dirs if d not in GATHER_SKIP_DIRS)
+            for name in dirs + sorted(files):
+                try:
+                    st = os.stat(os.path.join(current, name))
+                    state.append((os.path.join(current, name), st.st_mtime_ns, st.st_size))
+                except OSError:
+                    pass
+    return _digest(state)
+
+def gather(script, run, ttl=None, deps=None, scope=None):
+    """Вывод gather_script: run() или сохранённый результат, пока не истёк ttl и не изменились deps."""
+    if not ttl and not deps:
+        return run()
+    key = _digest([script, scope])
+    now = time.monotonic()
+    fingerprint = deps_fingerprint(deps) if deps else None
+    with _lock:
+        entry = _gather_cache.get(key)
+        if entry and (not ttl or now - entry["at"] < ttl) and entry["fingerprint"] == fingerprint:
+            stats["gather_hits"] += 1
+            return entry["output"]
+    output = run()
+    with _lock:
+        stats["gather_runs"] += 1
+        # Ошибки не запоминаем — следующий вызов попробует снова
+        if not str(output).startswith("Ошибка"):
+            if len(_gather_cache) >= GATHER_CACHE_SIZE:
+                _gather_cache.pop(next(iter(_gather_cache)))
+            _gather_cache[key] = {"output": output, "at": now, "fingerprint": fingerprint}
+    return output
+
+def clear():
+    with _lock:
+        _json_cache.clear()
+        _acl_cache.clear()
+        _gather_cache.clear()
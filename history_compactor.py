@@ -0,0 +1,167 @@
+import json
+import hashlib
+import threading
+from google.genai import types as genai_types
+from token_accounting import estimate_content
+
+# Сжатие истории перед запросом к модели.
+# self.messages не меняется (полная история остаётся на диске и в интерфейсе) —
+# compact() возвращает облегчённую копию для generate_content_stream.
+# Пока оценка размера выше бюджета, по очереди, от старых сообщений к новым:
+#   1. большие ответы инструментов (страницы http, вывод shell, DOM) обрезаются;
+#   2. изображения из старых ходов заменяются текстовой пометкой;
+#   3. старый отрезок истории заменяется кратким содержанием (summarize),
+#      которое запоминается и дальше только дописывается.
+# Последние KEEP_RECENT сообщений не трогаются.
+
+HISTORY_TOKEN_BUDGET = 300_000
+KEEP_RECENT = 8
+STUB_CHARS = 1500
+SUMMARY_HEADER = "[Краткое содержание более ранней части разговора]\n"
+
+_lock = threading.Lock()
+stats = {"compactions": 0, "tokens_saved": 0, "summaries": 0}
+
+def _json_len(value):
+    try:
+        return len(json.dumps(value, ensure_ascii=False, default=str))
+    except Exception:
+        return len(str(value))
+
+# Оценка токенов сообщения общая с учётом токенов чата (кешируется на сообщении)
+estimate_tokens = estimate_content
+
+def _stub_text(text):
+    if len(text) <= STUB_CHARS:
+        return text
+    return f"{text[:STUB_CHARS]}\n[... обрезано при сжатии истории: {len(text) - STUB_CHARS} символов ...]"
+
+def _stub_value(value):
+    if isinstance(value, str):
+        return _stub_text(value)
+    if isinstance(value, dict):
+        return {k: _stub_value(v) for k, v in value.items()}
+    if isinstance(value, list) and _json_len(value) > STUB_CHARS:
+        return _stub_text(json.dumps(value, ensure_ascii=False, default=str))
+    return value
+
+def stub_tool_responses(msg):
+    """Копия сообщения с обрезанными ответами инструментов (None — обрезать нечего)."""
+    parts, changed = [], False
+    for p in msg.parts or []:
+        fr = p.function_response
+        if fr is not None and _json_len(fr.response or {}) > STUB_CHARS:
+            p = genai_types.Part(function_response=genai_types.FunctionResponse(
+                id=fr.id, name=fr.name, response=_stub_value(fr.response or {}), parts=fr.parts))
+            changed = True
+        parts.append(p)
+    return genai_types.Content(role=msg.role, parts=parts) if changed else None
+
+def drop_images(msg):
+    """Копия сообщения без изображений (None — изображений нет)."""
+    parts, changed = [], False
+    for p in msg.parts or []:
+        if p.inline_data is not None:
+            parts.append(genai_types.Part(text="[изображение удалено при сжатии истории]"))
+            changed = True
+            continue
+        fr = p.function_response
+        if fr is not None and fr.parts:
+            p = genai_types.Part(function_response=genai_types.FunctionResponse(
+                id=fr.id, name=fr.name, response=fr.response))
+            changed = True
+        parts.append(p)
+    return genai_types.Content(role=msg.role, parts=parts) if changed else None
+
+def prefix_digest(messages):
+    """Отпечаток отрезка истории: по нему проверяется, что сохранённое краткое содержание ещё верно."""
+    h = hashlib.sha1()
+    for m in messages:
+        h.update((m.role or "").encode())
+        for p in m.parts or []:
+            if p.text:
+                h.update(p.text.encode("utf-8", "ignore"))
+            if p.function_call is not None:
+                h.update(f"call:{p.function_call.name}:{_json_len(p.function_call.args or {})}".encode())
+            if p.function_response is not None:
+                h.update(f"resp:{p.function_response.name}:{_json_len(p.function_response.response or {})}".encode())
+            if p.inline_data is not None:
+                h.update(b"image")
+    return h.hexdigest()
+
+def _is_turn_start(msg):
+    # Отрезок можно отрезать только перед репликой пользователя, а не посреди обмена с инструментами
+    return msg.role == "user" and not any(p.function_response is not None for p in msg.parts or [])
+
+class CompactionResult:
+    __slots__ = ("contents", "original_tokens", "tokens", "summary_state")
+
+    def __init__(self, contents, original_tokens, tokens, summary_state):
+        self.contents = contents
+        self.original_tokens = original_tokens
+        self.tokens = tokens
+        self.summary_state = summary_state
+
+    @property
+    def saved_tokens(self):
+        return self.original_tokens - self.tokens
+
+def compact(messages, budget=HISTORY_TOKEN_BUDGET, keep_recent=KEEP_RECENT, summarize=None, summary_state=None):
+    """Облегчённая копия истории под бюджет токенов.
+    summarize(segment, previous_summary) -> текст или None; summary_state — сохранённое
+    краткое содержание {"upto", "digest", "text"} из прошлых вызовов."""
+    contents = list(messages)
+    tokens = [estimate_tokens(m) for m in contents]
+    original = total = sum(tokens)
+    if not budget or total <= budget:
+        return CompactionResult(contents, original, total, summary_state)
+
+    boundary = max(0, len(contents) - keep_recent)
+    for transform in (stub_tool_responses, drop_images):
+        for i in range(boundary):
+            if total <= budget:
+                break
+            replaced = transform(contents[i])
+            if replaced is not None:
+                contents[i] = replaced
+                new_tokens = estimate_tokens(replaced)
+                total += new_tokens - tokens[i]
+                tokens[i] = new_tokens
+
+    if total > budget and summarize is not None:
+        # Наименьшая граница хода, после которой остаток укладывается в бюджет
+        cut, rest = None, total
+        for k in range(1, boundary + 1):
+            rest -= tokens[k - 1]
+            if k < len(contents) and _is_turn_start(contents[k]):
+                cut = k
+                if rest <= budget * 0.8:
+                    break
+        if cut:
+            summary_state = _summarize_prefix(messages, contents, cut, summarize, summary_state)
+            if summary_state and summary_state["upto"] == cut:
+                first = contents[cut]
+                summary_msg = genai_types.Content(role="user", parts=[
+                    genai_types.Part(text=SUMMARY_HEADER + summary_state["text"])] + list(first.parts or []))
+                contents = [summary_msg] + contents[cut + 1:]
+                total = sum(tokens[cut + 1:]) + estimate_tokens(summary_msg)
+
+    with _lock:
+        stats["compactions"] += 1
+        stats["tokens_saved"] += original - total
+    return CompactionResult(contents, original, total, summary_state)
+
+def _summarize_prefix(messages, contents, cut, summarize, summary_state):
+    """Краткое содержание messages[:cut]: готовое, дописанное к прежнему или новое."""
+    if summary_state and summary_state.get("upto") == cut and summary_state.get("digest") == prefix_digest(messages[:cut]):
+        return summary_state
+    previous, start = None, 0
+    if summary_state and summary_state.get("upto", 0) < cut \
+            and summary_state.get("digest") == prefix_digest(messages[:summary_state["upto"]]):
+        previous, start = summary_state["text"], summary_state["upto"]
+    text = summarize(contents[start:cut], previous)
+    if not text:
+        return summary_state
+    with _lock:
+        stats["summaries"] += 1
+    return {"upto": cut, "digest": prefix_digest(messages[:cut]), "text": text}
@@ -0,0 +1,71 @@
+import time
+import threading
+from google import genai
+from rate_limiter import rate_limiter
+
+# Пул API-ключей Gemini: по одному клиенту на ключ.
+# Вместо последовательной ротации каждый запрос получает наименее загруженный
+# ключ (меньше запросов в полёте, больше свободных RPM в ведре rate_limiter).
+# После 429 ключ уходит на карантин на время из _extract_retry_delay.
+
+QUARANTINE_DEFAULT = 30.0
+
+class KeyPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.keys = []
+        self._clients = {}
+        self._quarantine = {}   # индекс ключа -> time.monotonic(), до которого ключ на паузе
+        self._turn = 0          # сдвиг для равномерного разбиения ничьих
+        self.stats = {"chosen": {}, "quarantined": {}}
+
+    def load(self, keys):
+        with self._lock:
+            if list(keys) != self.keys:
+                self.keys = list(keys)
+                self._clients = {}
+                self._quarantine = {}
+
+    def size(self):
+        return len(self.keys)
+
+    def client(self, key_index):
+        with self._lock:
+            client = self._clients.get(key_index)
+            if client is None:
+                client = self._clients[key_index] = genai.Client(api_key=self.keys[key_index])
+            return client
+
+    def choose(self, model):
+        """(индекс ключа, сколько ждать). Ждать приходится, только если все ключи на карантине."""
+        with self._lock:
+            now = time.monotonic()
+            count = len(self.keys)
+            free = [i for i in range(count) if self._quarantine.get(i, 0) <= now]
+            if not free:
+                index = min(range(count), key=lambda i: self._quarantine[i])
+                return index, self._quarantine[index] - now
+            self._turn = (self._turn + 1) % count
+
+            def score(i):
+                available = rate_limiter.available(model, i)
+                return (rate_limiter.in_flight(model, i),
+                        -(available if available is not None else float("inf")),
+                        (i - self._turn) % count)
+
+            index = min(free, key=score)
+            self.stats["chosen"][index] = self.stats["chosen"].get(index, 0) + 1
+            return index, 0.0
+
+    def quarantine(self, key_index, delay=None):
+        with self._lock:
+            delay = QUARANTINE_DEFAULT if delay is None else delay
+            self._quarantine[key_index] = max(self._quarantine.get(key_index, 0), time.monotonic() + delay)
+            self.stats["quarantined"][key_index] = self.stats["quarantined"].get(key_index, 0) + 1
+
+    def free_count(self):
+        with self._lock:
+            now = time.monotonic()
+            return sum(1 for i in range(len(self.keys)) if self._quarantine.get(i, 0) <= now)
+
+key_pool = KeyPool()
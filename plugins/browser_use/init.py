@@ -1,5 +1,4 @@
 
-import types
 import json
 import os
 import sys
@@ -61,14 +60,6 @@ def main(chat, settings):
     bridge = get_bridge()
     bridge.init_bridge()
     
-    chat.browser_open_tool = types.MethodType(browser_open_tool, chat)
-    chat.browser_actions_tool = types.MethodType(browser_actions_tool, chat)
-    chat.browser_get_dom_tool = types.MethodType(browser_get_dom_tool, chat)
-    chat.browser_get_raw_html_tool = types.MethodType(browser_get_raw_html_tool, chat)
-    chat.browser_execute_js_tool = types.MethodType(browser_execute_js_tool, chat)
-
-    
-    
     # Описания берутся из chat.prompts (загружены start.py из папки prompts/)
     browser_open_schema = {
         "function": {
@@ -95,6 +86,7 @@ def main(chat, settings):
     }
     
     browser_get_dom_schema = {
+        "speculative": True,  # только чтение: можно запускать, не дожидаясь конца стрима
         "function": {
             "name": "browser_get_dom",
             "description": chat.prompts.get("browser_get_dom", "Получить DOM"),
@@ -103,6 +95,7 @@ def main(chat, settings):
     }
     
     browser_get_raw_html_schema = {
+        "speculative": True,  # только чтение: можно запускать, не дожидаясь конца стрима
         "function": {
             "name": "browser_get_raw_html",
             "description": chat.prompts.get("browser_get_raw_html", "Получить RAW HTML"),
@@ -122,15 +115,11 @@ def main(chat, settings):
         }
     }
 
-    # Удаляем старые версии инструментов если они были (для чистоты при перезагрузках)
-    chat.tools = [t for t in chat.tools if t["function"]["name"] not in ["browser_open", "browser_actions", "browser_get_dom", "browser_get_raw_html", "browser_execute_js"]]
-    
-    chat.tools.extend([
-        browser_open_schema, 
-        browser_actions_schema, 
-        browser_get_dom_schema, 
-        browser_get_raw_html_schema, 
-        browser_execute_js_schema
-    ])
+    # register_tool заменяет старые версии инструментов (для чистоты при перезагрузках)
+    chat.register_tool(browser_open_schema, browser_open_tool)
+    chat.register_tool(browser_actions_schema, browser_actions_tool)
+    chat.register_tool(browser_get_dom_schema, browser_get_dom_tool)
+    chat.register_tool(browser_get_raw_html_schema, browser_get_raw_html_tool)
+    chat.register_tool(browser_execute_js_schema, browser_execute_js_tool)
 
     return chat
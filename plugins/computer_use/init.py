@@ -1,6 +1,5 @@
 import os
 import sys
-import types
 import base64
 import json
 import time
@@ -21,29 +20,7 @@ def main(chat, settings):
         print(f"❌ Unknown computer_use backend: {backend}, falling back to wsl")
         from . import tools_wsl as tools
 
-    # 1. Загрузка метаданных инструментов
-    try:
-        with open(os.path.join(current_dir, "tools_metadata.json"), "r", encoding="utf-8") as f:
-            plugin_tools = json.load(f)
-        for t in plugin_tools:
-            name = t["function"]["name"]
-            # Подхватываем промпт из chat.prompts
-            if name in chat.prompts:
-                desc = chat.prompts[name]
-                if name == "computer_use_actions" and hasattr(tools, "TOOLS_PROMPT"):
-                    desc += "\n\n" + tools.TOOLS_PROMPT
-                t["function"]["description"] = desc
-            
-            # Удаляем старые версии инструмента, чтобы обновить
-            chat.tools = [existing for existing in chat.tools if existing['function']['name'] != name]
-            chat.tools.append(t)
-            
-        # Удаляем take_screenshot из инструментов, если он там остался
-        chat.tools = [existing for existing in chat.tools if existing['function']['name'] != 'take_screenshot']
-    except Exception as e:
-        print(f"⚠️ Ошибка загрузки tools_metadata.json: {e}")
-
-    # 2. Инструмент: computer_use_actions
+    # 1. Инструмент: computer_use_actions
     def computer_use_actions_tool(self, actions):
         if hasattr(tools, 'overlay'):
             tools.overlay.start()
@@ -98,7 +75,29 @@ def main(chat, settings):
             
         return final_response
 
-    chat.computer_use_actions_tool = types.MethodType(computer_use_actions_tool, chat)
+    handlers = {"computer_use_actions": computer_use_actions_tool}
+
+    # 2. Регистрация по метаданным инструментов
+    try:
+        with open(os.path.join(current_dir, "tools_metadata.json"), "r", encoding="utf-8") as f:
+            plugin_tools = json.load(f)
+        for t in plugin_tools:
+            name = t["function"]["name"]
+            # Подхватываем промпт из chat.prompts
+            if name in chat.prompts:
+                desc = chat.prompts[name]
+                if name == "computer_use_actions" and hasattr(tools, "TOOLS_PROMPT"):
+                    desc += "\n\n" + tools.TOOLS_PROMPT
+                t["function"]["description"] = desc
+            
+            # register_tool заменяет старую версию инструмента
+            if name in handlers:
+                chat.register_tool(t, handlers[name])
+            
+        # Удаляем take_screenshot из инструментов, если он там остался
+        chat.tools = [existing for existing in chat.tools if existing['function']['name'] != 'take_screenshot']
+    except Exception as e:
+        print(f"⚠️ Ошибка загрузки tools_metadata.json: {e}")
 
     print(f"✅ Computer Use (backend: {backend}) интегрирован.")
     return chat
@@ -0,0 +1,162 @@
+import io
+import json
+import asyncio
+import http.client
+import concurrent.futures
+
+import event_hub
+
+# asyncio-бэкенд веб-интерфейса (только stdlib).
+# SSE-потоки мультиплексируются на одном цикле событий и не держат по потоку
+# на клиента. Остальные маршруты обслуживает тот же WebRequestHandler, но в
+# ограниченном пуле потоков; ходы агента выполняет планировщик (scheduler.py).
+
+REQUEST_WORKERS = 16
+MAX_HEADER_LINES = 100
+SSE_KEEPALIVE = 15.0
+WRITE_TIMEOUT = 60.0
+
+class _HeadersTooLarge(Exception):
+    pass
+
+class _LoopWriter(io.RawIOBase):
+    """wfile для обработчика из пула: каждая запись уходит в сокет через цикл (с drain)."""
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+
+    def writable(self):
+        return True
+
+    async def _write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def write(self, data):
+        data = bytes(data)
+        # Таймаут: если цикл остановлен, поток пула не должен зависнуть навсегда
+        asyncio.run_coroutine_threadsafe(self._write(data), self.loop).result(WRITE_TIMEOUT)
+        return len(data)
+
+class AsyncWebServer:
+    def __init__(self, handler_cls, host, port, request_workers=REQUEST_WORKERS, keepalive=SSE_KEEPALIVE):
+        self.handler_cls = handler_cls
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.request_pool = concurrent.futures.ThreadPoolExecutor(request_workers, thread_name_prefix="web-request")
+        self.loop = None
+        self.server = None
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        return self.server
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def _read_request(self, reader):
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        if not request_line:
+            return None
+        raw_headers = b""
+        for _ in range(MAX_HEADER_LINES):
+            line = await reader.readline()
+            raw_headers += line
+            if line in (b"\r\n", b"\n", b""):
+                break
+        else:
+            # Остаток заголовков нельзя читать как тело запроса
+            raise _HeadersTooLarge()
+        method, target, version = (request_line.split() + ["HTTP/1.0"])[:3]
+        headers = http.client.parse_headers(io.BytesIO(raw_headers))
+        length = int(headers.get("Content-Length", 0) or 0)
+        body = await reader.readexactly(length) if length else b""
+        return method, target, version, headers, body
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            request = await self._read_request(reader)
+            if request is None:
+                return
+            method, target, version, headers, body = request
+            if method == "GET" and target.split("?", 1)[0] == "/stream":
+                await self._stream(writer, target, headers)
+            else:
+                await self.loop.run_in_executor(self.request_pool, self._dispatch, writer, *request)
+        except _HeadersTooLarge:
+            await self._send_error(writer, 431, "Request Header Fields Too Large")
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    def _cors_lines(self):
+        return "".join(f"{name}: {value}\r\n" for name, value in self.handler_cls.CORS_HEADERS)
+
+    async def _send_error(self, writer, code, message):
+        """Ответ-ошибка в формате send_json_error, когда до обработчика дело не дошло."""
+        body = json.dumps({"error": message, "code": code}).encode()
+        head = (f"HTTP/1.0 {code} {message}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"{self._cors_lines()}\r\n")
+        try:
+            writer.write(head.encode("latin-1") + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    def _dispatch(self, writer, method, target, version, headers, body):
+        """Выполняет do_<METHOD> обработчика без сокетного сервера (в потоке пула)."""
+        handler = self.handler_cls.__new__(self.handler_cls)
+        handler.command, handler.path, handler.request_version = method, target, version
+        handler.requestline = f"{method} {target} {version}"
+        handler.headers = headers
+        handler.rfile = io.BytesIO(body)
+        handler.wfile = _LoopWriter(self.loop, writer)
+        handler.client_address = writer.get_extra_info("peername") or ("", 0)
+        handler.server = None
+        handler.close_connection = True
+        do_method = getattr(handler, f"do_{method}", None)
+        if do_method is None:
+            return handler.send_json_error(501, f"Unsupported method ({method})")
+        do_method()
+
+    async def _stream(self, writer, target, headers):
+        chat_ids, last_event_id = self.handler_cls.stream_params(target, headers)
+        wake = asyncio.Event()
+        sub = event_hub.hub.subscribe(chat_ids, last_event_id,
+                                      notify=lambda: self.loop.call_soon_threadsafe(wake.set))
+        try:
+            writer.write(b"HTTP/1.0 200 OK\r\n"
+                         b"Content-Type: text/event-stream\r\n"
+                         b"Cache-Control: no-cache\r\n"
+                         b"Connection: keep-alive\r\n"
+                         + self._cors_lines().encode("latin-1") +
+                         b"\r\n: keep-alive\n\n")
+            await writer.drain()
+            while True:
+                if not sub.buffer:
+                    try:
+                        await asyncio.wait_for(wake.wait(), self.keepalive)
+                    except asyncio.TimeoutError:
+                        pass
+                wake.clear()
+                events = sub.get(timeout=0)
+                writer.write(event_hub.format_frames(events) if events else b": keep-alive\n\n")
+                await writer.drain()
+        finally:
+            sub.close()
+            self.handler_cls.stop_if_no_listeners()
+
+def serve(handler_cls, host, port, **kwargs):
+    asyncio.run(AsyncWebServer(handler_cls, host, port, **kwargs).serve_forever())
@@ -0,0 +1,122 @@
+import os
+import json
+import hashlib
+import threading
+
+# Общее для всех чатов контентно-адресуемое хранилище изображений:
+# chats/blobs/<sha[:2]>/<sha>.<ext>. Один и тот же скриншот хранится один раз,
+# а refs.json помнит, какие чаты на него ссылаются (для удаления в delete_chat).
+
+BLOBS_DIR = os.path.join("chats", "blobs")
+_lock = threading.Lock()
+_refs = None        # sha -> set(chat_id)
+_chat_refs = None   # chat_id -> set(sha)
+_refs_dir = None
+
+def _ext_for(mime_type):
+    ext = "bin"
+    if "jpeg" in mime_type or "jpg" in mime_type: ext = "jpg"
+    elif "png" in mime_type: ext = "png"
+    elif "webp" in mime_type: ext = "webp"
+    return ext
+
+def _refs_path():
+    return os.path.join(BLOBS_DIR, "refs.json")
+
+def _ensure_refs():
+    global _refs, _chat_refs, _refs_dir
+    if _refs is not None and _refs_dir == BLOBS_DIR:
+        return
+    _refs, _chat_refs, _refs_dir = {}, {}, BLOBS_DIR
+    try:
+        with open(_refs_path(), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {}
+    for sha, chats in data.items():
+        _refs[sha] = set(chats)
+        for cid in chats:
+            _chat_refs.setdefault(cid, set()).add(sha)
+
+def _save_refs():
+    os.makedirs(BLOBS_DIR, exist_ok=True)
+    tmp_path = _refs_path() + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({sha: sorted(chats) for sha, chats in _refs.items()}, f)
+    os.replace(tmp_path, _refs_path())
+
+def blob_name(sha, mime_type):
+    return f"{sha}.{_ext_for(mime_type)}"
+
+def blob_path(name):
+    """Путь к блобу по имени файла <sha>.<ext> (или None для чужих имён)."""
+    sha = name.split(".", 1)[0]
+    if len(sha) != 64 or any(c not in "0123456789abcdef" for c in sha):
+        return None
+    return os.path.join(BLOBS_DIR, sha[:2], name)
+
+def add_ref(sha, chat_id):
+    with _lock:
+        _add_ref_locked(sha, chat_id)
+
+def _add_ref_locked(sha, chat_id):
+    if not chat_id:
+        return
+    _ensure_refs()
+    chats = _refs.setdefault(sha, set())
+    if chat_id in chats:
+        return
+    chats.add(chat_id)
+    _chat_refs.setdefault(chat_id, set()).add(sha)
+    _save_refs()
+
+def put(data_bytes, mime_type, chat_id=None):
+    """Сохраняет байты (если такого содержимого ещё нет). Возвращает (sha, путь)."""
+    sha = hashlib.sha256(data_bytes).hexdigest()
+    name = blob_name(sha, mime_type)
+    path = blob_path(name)
+    # Проверка, запись и ссылка — под одной блокировкой: иначе release_chat другого
+    # чата может удалить блоб между записью и add_ref.
+    with _lock:
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data_bytes)
+            os.replace(tmp_path, path)
+        _add_ref_locked(sha, chat_id)
+    return sha, path.replace("\\", "/")
+
+def read(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def release_chat(chat_id):
+    """Снимает ссылки чата; блобы, на которые больше никто не ссылается, удаляются."""
+    with _lock:
+        _ensure_refs()
+        shas = _chat_refs.pop(chat_id, set())
+        if not shas:
+            return 0
+        removed = 0
+        for sha in shas:
+            chats = _refs.get(sha)
+            if chats is None:
+                continue
+            chats.discard(chat_id)
+            if chats:
+                continue
+            del _refs[sha]
+            sub_dir = os.path.join(BLOBS_DIR, sha[:2])
+            try:
+                for name in os.listdir(sub_dir):
+                    if name.startswith(sha + "."):
+                        os.remove(os.path.join(sub_dir, name))
+                        removed += 1
+            except OSError:
+                pass
+        _save_refs()
+        return removed
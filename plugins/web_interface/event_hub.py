@@ -0,0 +1,174 @@
+import json
+import time
+import threading
+from collections import deque
+
+# Шина событий веб-интерфейса (publish/subscribe).
+# web_emit публикует событие один раз; каждое SSE-подключение получает свой
+# ограниченный буфер с фильтром по chatId и ждёт на условии, а не опрашивает очереди.
+# Последние события хранятся в кольцевом буфере для повтора по Last-Event-ID.
+# emit() дополнительно склеивает подряд идущие text/thought одного чата в окне
+# COALESCE_WINDOW / COALESCE_BYTES, чтобы не слать тысячи крошечных SSE-кадров.
+
+SUBSCRIBER_BUFFER = 2000
+REPLAY_SIZE = 2000
+COALESCE_WINDOW = 0.03   # секунды; 0 — без склейки
+COALESCE_BYTES = 4096
+COALESCE_TYPES = ("text", "thought")
+
+class Subscriber:
+    def __init__(self, hub, chat_ids=None, maxlen=SUBSCRIBER_BUFFER, notify=None):
+        self.hub = hub
+        self.notify = notify  # для asyncio: будит цикл событий (вызывается под замком)
+        self.chat_ids = set(chat_ids) if chat_ids else None
+        self.buffer = deque(maxlen=maxlen)
+        self.dropped = 0
+        self.closed = False
+        self.cond = threading.Condition(hub._lock)
+
+    def accepts(self, event):
+        return self.chat_ids is None or event.get("chatId") in self.chat_ids
+
+    def _push(self, item):
+        # Вызывается под hub._lock
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append(item)
+        self.cond.notify()
+        if self.notify:
+            self.notify()
+
+    def get(self, timeout=None):
+        """Ждёт событий и забирает все накопленные: список (event_id, event). Пустой — по таймауту."""
+        with self.cond:
+            if not self.buffer and not self.closed:
+                self.cond.wait(timeout)
+            items = list(self.buffer)
+            self.buffer.clear()
+            return items
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+class EventHub:
+    def __init__(self, replay_size=REPLAY_SIZE):
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._ring = deque(maxlen=replay_size)
+        self._seq = 0
+        # Эпоха отличает id этого процесса от id, выданных до перезапуска сервера
+        self._epoch = format(int(time.time() * 1000), "x")
+
+        self.coalesce_window = COALESCE_WINDOW
+        self.coalesce_bytes = COALESCE_BYTES
+        self._pending = {}    # chatId -> незавершённая пачка text/thought
+        self._pending_cond = threading.Condition(threading.Lock())
+        self._flusher = None
+        self.stats = {"events": 0, "frames": 0}
+
+    def configure(self, window=None, max_bytes=None):
+        if window is not None: self.coalesce_window = max(0.0, float(window))
+        if max_bytes is not None: self.coalesce_bytes = max(1, int(max_bytes))
+
+    def _parse_id(self, event_id):
+        try:
+            epoch, seq = str(event_id).split(":", 1)
+            return int(seq) if epoch == self._epoch else None
+        except (ValueError, AttributeError):
+            return None
+
+    def emit(self, event):
+        """Как publish, но склеивает подряд идущие text/thought одного чата."""
+        cid = event.get("chatId")
+        mergeable = (self.coalesce_window > 0 and event.get("type") in COALESCE_TYPES
+                     and isinstance(event.get("data"), str))
+        with self._pending_cond:
+            self.stats["events"] += 1
+            batch = self._pending.get(cid)
+            if batch and (not mergeable or batch["event"]["type"] != event["type"]):
+                self._flush_batch(cid)
+                batch = None
+            if not mergeable:
+                return self.publish(event)
+            if batch is None:
+                batch = self._pending[cid] = {"event": event, "parts": [], "size": 0,
+                                              "deadline": time.monotonic() + self.coalesce_window}
+                self._ensure_flusher()
+                self._pending_cond.notify()
+            batch["parts"].append(event["data"])
+            batch["size"] += len(event["data"])
+            if batch["size"] >= self.coalesce_bytes:
+                self._flush_batch(cid)
+
+    def flush(self, chat_id=None):
+        """Немедленно отправляет накопленные пачки (одного чата или всех)."""
+        with self._pending_cond:
+            for cid in ([chat_id] if chat_id is not None else list(self._pending)):
+                if cid in self._pending:
+                    self._flush_batch(cid)
+
+    def _flush_batch(self, cid):
+        # Вызывается под _pending_cond
+        batch = self._pending.pop(cid)
+        self.publish(dict(batch["event"], data="".join(batch["parts"])))
+
+    def _ensure_flusher(self):
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._flush_loop, name="event-hub-flusher", daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        with self._pending_cond:
+            while True:
+                if not self._pending:
+                    self._pending_cond.wait()
+                    continue
+                now = time.monotonic()
+                for cid, batch in list(self._pending.items()):
+                    if batch["deadline"] <= now:
+                        self._flush_batch(cid)
+                if self._pending:
+                    self._pending_cond.wait(max(0.0, min(b["deadline"] for b in self._pending.values()) - now))
+
+    def publish(self, event):
+        with self._lock:
+            self.stats["frames"] += 1
+            self._seq += 1
+            item = (f"{self._epoch}:{self._seq}", event)
+            self._ring.append((self._seq, item))
+            for sub in self._subscribers:
+                if sub.accepts(event):
+                    sub._push(item)
+            return item[0]
+
+    def subscribe(self, chat_ids=None, last_event_id=None, notify=None):
+        """Новый подписчик; при last_event_id в его буфер сразу кладутся пропущенные события."""
+        sub = Subscriber(self, chat_ids, notify=notify)
+        with self._lock:
+            last_seq = self._parse_id(last_event_id) if last_event_id else None
+            if last_seq is not None:
+                for seq, item in self._ring:
+                    if seq > last_seq and sub.accepts(item[1]):
+                        sub._push(item)
+            self._subscribers.append(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            sub.closed = True
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
+            sub.cond.notify_all()
+            if sub.notify:
+                sub.notify()
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+def format_frames(events):
+    """SSE-кадры (id + data) для списка (event_id, event) в одном буфере."""
+    return "".join(f"id: {event_id}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+                   for event_id, event in events).encode()
+
+hub = EventHub()
@@ -3,10 +3,12 @@ import os
 import threading
 import importlib.util
 import types
-import queue
 import time
 import copy
 import json
+import console_sink
+import python_workers
+from rate_limiter import rate_limiter
 from google.genai import types as genai_types
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -33,42 +35,24 @@ except ImportError:
         storage = importlib.util.module_from_spec(spec)
         spec.loader.exec_module(storage)
 
+import state_codec
+
 
 # === WEB INTERFACE METHODS ===
 
 def web_emit(self, msg_type, payload):
-    """Отправляет событие в веб-интерфейс через очередь."""
-    if not hasattr(self, 'web_queue') or self.web_queue is None:
-        self.web_queue = queue.Queue(maxsize=2000)
-        
+    """Публикует событие в шину веб-интерфейса (получат все подписанные SSE-клиенты)."""
     cid = getattr(self, "id", "unknown")
-    event = { "type": msg_type, "chatId": cid, "data": payload }
-    try: 
-        self.web_queue.put_nowait(event)
-    except queue.Full:
-        try: 
-            self.web_queue.get_nowait()
-            self.web_queue.put_nowait(event)
-        except queue.Empty: 
-            pass
+    server.event_hub.hub.emit({ "type": msg_type, "chatId": cid, "data": payload })
 
 def web_print(self, message, count_tab=-1, **kwargs):
     """Переопределенный print: выводит в консоль и отправляет в веб."""
     end = kwargs.get('end', '\n')
     msg_str = str(message)
     
-    # Console Output (вызываем оригинальный метод или логику)
-    # Так как мы не можем вызвать super() легко при манки-патчинге, реализуем логику вывода
-    print(f"[{getattr(self, 'id', '?')}]: ", end='')
+    # Console Output: через console_sink, префикс чата и отступ — в начале каждой строки
     if count_tab == -1: count_tab = self.count_tab
-    if msg_str != '':
-        try:
-            console_msg = '\t' * count_tab + msg_str.replace('\n', '\n' + '\t' * count_tab)
-            print(console_msg, **kwargs)
-        except:
-            print(msg_str, **kwargs)
-    elif end != '':
-        print('\t' * count_tab, **kwargs)
+    console_sink.write(id(self), msg_str + end, prefix=f"[{getattr(self, 'id', '?')}]: " + '\t' * count_tab)
     
     # Web Output
     self.web_emit("text", str(message) + str(end))
@@ -85,16 +69,8 @@ def web_print_thought(self, message, count_tab=-1, **kwargs):
         self._web_thought_stack[-1] += msg_str + (end if end != '\n' else '\n')
 
     # Console
-    print(f"[{getattr(self, 'id', '?')}] (thought): ", end='')
     if count_tab == -1: count_tab = self.count_tab
-    if msg_str != '':
-        try:
-            console_msg = '\t' * count_tab + msg_str.replace('\n', '\n' + '\t' * count_tab)
-            print(console_msg, **kwargs)
-        except:
-            print(msg_str, **kwargs)
-    elif end != '':
-        print('\t' * count_tab, **kwargs)
+    console_sink.write(id(self), msg_str + end, prefix=f"[{getattr(self, 'id', '?')}] (thought): " + '\t' * count_tab)
     
     # Web
     self.web_emit("thought", str(message) + str(end))
@@ -125,15 +101,8 @@ def web_print_code(self, language, code, count_tab=-1, max_code_display_lines=6)
             if len(displayed_code) > 500:
                 displayed_code = code[:250] + '\n\t...\n' + code[-250:]
     
-    def raw_print(msg, tabs):
-        try:
-            print('\t' * tabs + msg.replace('\n', '\n' + '\t' * tabs))
-        except:
-            print(msg)
-
-    print("") 
-    raw_print(f"[{getattr(self, 'id', '?')}] Code ({language}):", count_tab)
-    raw_print(displayed_code + '\n', count_tab + 1)
+    console_sink.write(id(self), f"\n[{getattr(self, 'id', '?')}] Code ({language}):\n", prefix='\t' * count_tab)
+    console_sink.write(id(self), displayed_code + '\n\n', prefix='\t' * (count_tab + 1))
 
 def web_send(self, messages):
     # self.busy_depth и stop_requested должны быть инициализированы
@@ -230,9 +199,8 @@ def web_getstate(self):
         state = self.__dict__.copy()
 
     # Удаляем непиклируемые или временные объекты
-    for attr in ['client', 'web_queue', '_web_thought_stack']:
-        if attr in state:
-            del state[attr]
+    for attr in state_codec.TRANSIENT_ATTRS:
+        state.pop(attr, None)
             
     # Сбрасываем состояние занятости для сохраненной копии
     state['busy_depth'] = 0
@@ -246,10 +214,6 @@ def web_setstate(self, state):
     else:
         self.__dict__.update(state)
     
-    # Восстанавливаем (инициализируем) очередь
-    if not hasattr(self, 'web_queue') or self.web_queue is None:
-        self.web_queue = queue.Queue()
-        
     if not hasattr(self, '_web_thought_stack'):
         self._web_thought_stack = []
 
@@ -295,7 +259,39 @@ def main(root_chat, settings):
     # Патчим класс (применяется ко всем чатам)
     patch_chat_class(root_chat)
 
-    server_thread = threading.Thread(target=server.run_server, args=(root_chat,), daemon=True)
+    # Склейка потоковых text/thought событий: окно в мс и максимальный размер пачки
+    server.event_hub.hub.configure(
+        window=settings.get("coalesce_window_ms", server.event_hub.COALESCE_WINDOW * 1000) / 1000,
+        max_bytes=settings.get("coalesce_bytes", server.event_hub.COALESCE_BYTES),
+    )
+
+    # Пул ходов агента: общий лимит и лимиты по моделям ({"gemini-...": 2})
+    server.scheduler.scheduler.configure(
+        workers=settings.get("agent_workers", server.scheduler.AGENT_WORKERS),
+        model_limits=settings.get("model_limits", {}),
+    )
+
+    # Лимиты токенов в минуту по моделям для общего rate_limiter ({"gemini-...": 1000000})
+    rate_limiter.configure(tpm_limits=settings.get("model_tpm", {}))
+
+    # Сброс консольного вывода (console_sink): период в мс, 0 — писать сразу
+    if "console_flush_ms" in settings:
+        console_sink.sink.configure(flush_interval=settings["console_flush_ms"] / 1000.0)
+
+    # python_tool в отдельных процессах: {"python_backend": "worker", "python_workers": {"max_workers": 8, ...}}
+    if "python_backend" in settings:
+        root_chat.python_backend = settings["python_backend"]
+    python_workers.pool.configure(**settings.get("python_workers", {}))
+
+    # Read-only инструменты ("speculative") стартуют, как только пришёл их function_call
+    root_chat.speculative_tools = bool(settings.get("speculative_tools", False))
+
+    # Бюджет токенов истории, сверх которого старые ходы сжимаются (0 — без сжатия)
+    if "history_token_budget" in settings:
+        root_chat.history_token_budget = int(settings["history_token_budget"])
+
+    backend = settings.get("server_backend", "threading")
+    server_thread = threading.Thread(target=server.run_server, args=(root_chat, backend), daemon=True)
     server_thread.start()
     print("✅ Web Server thread started.")
     # time.sleep(10) # Removed sleep чтобы при запуске внутри песочницы сервер успел загрузиться
@@ -0,0 +1,134 @@
+import time
+import threading
+from collections import OrderedDict, deque
+
+# Планировщик ходов агента для /api/send.
+# Фиксированный пул рабочих потоков и FIFO-очередь на каждый чат: сообщение,
+# отправленное в занятый чат, ждёт своей очереди, а не отклоняется с 409.
+# Одновременно в чате выполняется не больше одного хода; есть общий лимит
+# (размер пула) и лимиты по моделям. Чаты обслуживаются по кругу.
+
+AGENT_WORKERS = 4
+WAIT_SAMPLES = 200
+
+class _Job:
+    __slots__ = ("chat_id", "model", "fn", "enqueued_at")
+
+    def __init__(self, chat_id, model, fn):
+        self.chat_id = chat_id
+        self.model = model
+        self.fn = fn
+        self.enqueued_at = time.monotonic()
+
+class AgentScheduler:
+    def __init__(self, workers=AGENT_WORKERS, model_limits=None):
+        self.workers = workers
+        self.model_limits = dict(model_limits or {})
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()   # chat_id -> deque[_Job]
+        self._running = {}             # chat_id -> _Job
+        self._running_models = {}      # model -> число выполняющихся ходов
+        self._threads = []
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+        self._completed = 0
+
+    def configure(self, workers=None, model_limits=None):
+        with self._cond:
+            if workers is not None: self.workers = max(1, int(workers))
+            if model_limits is not None: self.model_limits = dict(model_limits)
+            self._cond.notify_all()
+
+    def _ensure_workers(self):
+        # Вызывается под _cond; пул только растёт (лишние потоки простаивают)
+        self._threads = [t for t in self._threads if t.is_alive()]
+        while len(self._threads) < self.workers:
+            t = threading.Thread(target=self._worker, name=f"agent-worker-{len(self._threads)}", daemon=True)
+            self._threads.append(t)
+            t.start()
+
+    def submit(self, chat_id, model, fn):
+        """Ставит ход в очередь чата. Возвращает число ходов перед ним (0 — начнётся сразу)."""
+        with self._cond:
+            queue = self._queues.setdefault(chat_id, deque())
+            ahead = len(queue) + (1 if chat_id in self._running else 0)
+            queue.append(_Job(chat_id, model, fn))
+            self._ensure_workers()
+            self._cond.notify_all()
+            return ahead
+
+    def cancel(self, chat_id):
+        """Снимает ещё не начатые ходы чата (текущий останавливается через stop_requested)."""
+        with self._cond:
+            return len(self._queues.pop(chat_id, ()))
+
+    def is_pending(self, chat_id):
+        with self._cond:
+            return chat_id in self._running or bool(self._queues.get(chat_id))
+
+    def _model_free(self, model):
+        limit = self.model_limits.get(model)
+        return limit is None or self._running_models.get(model, 0) < limit
+
+    def _next_job(self):
+        # Вызывается под _cond
+        if len(self._running) >= self.workers:
+            return None
+        for chat_id in list(self._queues):
+            if chat_id in self._running:
+                continue
+            queue = self._queues[chat_id]
+            if not self._model_free(queue[0].model):
+                continue
+            job = queue.popleft()
+            if queue:
+                self._queues.move_to_end(chat_id)
+            else:
+                del self._queues[chat_id]
+            return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                self._running[job.chat_id] = job
+                self._running_models[job.model] = self._running_models.get(job.model, 0) + 1
+                self._waits.append(time.monotonic() - job.enqueued_at)
+            try:
+                job.fn()
+            except Exception as e:
+                print(f"⚠️ Agent turn failed for {job.chat_id}: {e}")
+            finally:
+                with self._cond:
+                    self._running.pop(job.chat_id, None)
+                    self._running_models[job.model] -= 1
+                    self._completed += 1
+                    self._cond.notify_all()
+
+    def metrics(self):
+        with self._cond:
+            now = time.monotonic()
+            waits = sorted(self._waits)
+            chats = {}
+            for chat_id, queue in self._queues.items():
+                chats[chat_id] = {"queued": len(queue), "oldest_wait": round(now - queue[0].enqueued_at, 3)}
+            for chat_id in self._running:
+                chats.setdefault(chat_id, {"queued": 0, "oldest_wait": 0.0})["running"] = True
+            return {
+                "workers": self.workers,
+                "running": len(self._running),
+                "queued": sum(len(q) for q in self._queues.values()),
+                "completed": self._completed,
+                "models": {m: {"running": n, "limit": self.model_limits.get(m)} for m, n in self._running_models.items() if n},
+                "wait_time": {
+                    "avg": round(sum(waits) / len(waits), 3) if waits else 0.0,
+                    "p95": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0.0,
+                    "max": round(waits[-1], 3) if waits else 0.0,
+                },
+                "chats": chats,
+            }
+
+scheduler = AgentScheduler()
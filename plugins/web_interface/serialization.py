@@ -1,38 +1,33 @@
 import json
 import os
-import hashlib
+import sys
 import base64
 from google.genai import types
 
+current_dir = os.path.dirname(os.path.abspath(__file__))
+if current_dir not in sys.path:
+    sys.path.append(current_dir)
+
+import blob_store
+from access_control import trusted_io
+
 def _save_image(chat_id, data_bytes, mime_type):
     if not chat_id:
         return None
-        
-    base_dir = "chats"
-    chat_dir = os.path.join(base_dir, str(chat_id), "images")
-    os.makedirs(chat_dir, exist_ok=True)
-    
-    file_hash = hashlib.md5(data_bytes).hexdigest()
-    ext = "bin"
-    if "jpeg" in mime_type or "jpg" in mime_type: ext = "jpg"
-    elif "png" in mime_type: ext = "png"
-    elif "webp" in mime_type: ext = "webp"
-    
-    filename = f"{file_hash}.{ext}"
-    file_path = os.path.join(chat_dir, filename)
-    
-    if not os.path.exists(file_path):
-        with open(file_path, "wb") as f:
-            f.write(data_bytes)
-            
-    return f"chats/{chat_id}/images/{filename}"
+    # Общее хранилище пишет сериализация, а не код чата: у чата к нему доступа нет
+    with trusted_io():
+        _, path = blob_store.put(data_bytes, mime_type, chat_id)
+    return path
 
 def _load_image(path):
-    full_path = os.path.join(".", path)
-    if os.path.exists(full_path):
-        with open(full_path, "rb") as f:
-            return f.read()
-    return None
+    return blob_store.read(os.path.join(".", path))
+
+def _lazy_image_part(path, mime_type):
+    """Part-заглушка без байтов: данные читаются с диска только при отправке запроса."""
+    part = types.Part(inline_data=types.Blob(mime_type=mime_type))
+    part._blob_path = path
+    part._local_filename = os.path.basename(path)
+    return part
 
 def serialize_message(msg, chat_id=None):
     if isinstance(msg, dict): return msg.copy()
@@ -49,11 +44,15 @@ def serialize_message(msg, chat_id=None):
             if inline_data:
                 mime_type = getattr(inline_data, "mime_type", "image/jpeg")
                 img_bytes = getattr(inline_data, "data", None)
+                image_path = getattr(part, "_blob_path", None)
                 if img_bytes:
+                    # Живое сообщение не меняется: в запись попадает только ссылка на блоб
                     image_path = _save_image(chat_id, img_bytes, mime_type)
-                    if image_path:
-                        part._local_filename = os.path.basename(image_path)
-                        parts_data.append({"local_image_path": image_path, "mime_type": mime_type})
+                elif image_path and chat_id and blob_store.blob_path(part._local_filename):
+                    with trusted_io():
+                        blob_store.add_ref(part._local_filename.split(".", 1)[0], chat_id)
+                if image_path:
+                    parts_data.append({"local_image_path": image_path, "mime_type": mime_type})
             elif text:
                 if is_thought: thoughts_list.append(text)
                 else: parts_data.append({"text": text})
@@ -125,6 +124,35 @@ def serialize_history_for_web(messages, chat_id=None):
         history.append(data)
     return history
 
+# Итоги по метрикам сообщений: total_context — максимум, остальное — сумма
+USAGE_MAX_FIELDS = ("total_context",)
+USAGE_SUM_FIELDS = ("cached_tokens", "uncached_tokens", "input_time", "output_tokens", "output_time")
+
+def usage_totals(messages):
+    """Итоги токенов и времени по всей истории (интерфейс загружает её страницами)."""
+    totals = dict.fromkeys(USAGE_MAX_FIELDS + USAGE_SUM_FIELDS, 0)
+    for msg in messages:
+        metrics = getattr(msg, "_metrics", None)
+        if not metrics:
+            continue
+        for key in USAGE_MAX_FIELDS:
+            totals[key] = max(totals[key], metrics.get(key) or 0)
+        for key in USAGE_SUM_FIELDS:
+            totals[key] += metrics.get(key) or 0
+    return totals
+
+def page_history_for_web(messages, chat_id=None, before=None, limit=50):
+    """Страница истории от новых к старым: сообщения [cursor, before) и курсор следующей страницы."""
+    total = len(messages)
+    end = total if before is None else max(0, min(int(before), total))
+    start = max(0, end - max(1, int(limit)))
+    return {
+        "messages": serialize_history_for_web(messages[start:end], chat_id=chat_id),
+        "start": start,
+        "cursor": start if start > 0 else None,
+        "total": total,
+    }
+
 def deserialize_message(data):
     if not isinstance(data, dict): return data
     thoughts = data.get("thoughts", None)
@@ -136,11 +164,8 @@ def deserialize_message(data):
             if "text" in p:
                 parts.append(types.Part(text=p["text"]))
             elif "local_image_path" in p:
-                img_data = _load_image(p["local_image_path"])
-                if img_data:
-                    part = types.Part.from_bytes(data=img_data, mime_type=p.get("mime_type", "image/jpeg"))
-                    part._local_filename = os.path.basename(p["local_image_path"])
-                    parts.append(part)
+                if os.path.exists(p["local_image_path"]):
+                    parts.append(_lazy_image_part(p["local_image_path"], p.get("mime_type", "image/jpeg")))
             elif "function_call" in p:
                 try: parts.append(types.Part(function_call=types.FunctionCall(**p["function_call"])))
                 except: pass
@@ -154,6 +179,29 @@ def deserialize_message(data):
     if metrics: msg._metrics = metrics
     return msg
 
+def detach_images(messages, chat_id=None):
+    """Копия истории для чекпоинта: байты изображений уходят в хранилище блобов,
+    вместо них — ленивые ссылки. Исходные сообщения не меняются."""
+    if not chat_id:
+        return messages
+    result = []
+    for msg in messages:
+        parts = getattr(msg, "parts", None) or []
+        if not any(getattr(p, "inline_data", None) is not None and p.inline_data.data for p in parts):
+            result.append(msg)
+            continue
+        new_parts = []
+        for part in parts:
+            inline_data = part.inline_data
+            if inline_data is not None and inline_data.data:
+                mime_type = inline_data.mime_type or "image/jpeg"
+                path = _save_image(chat_id, inline_data.data, mime_type)
+                if path:
+                    part = _lazy_image_part(path, mime_type)
+            new_parts.append(part)
+        result.append(msg.model_copy(update={"parts": new_parts}))
+    return result
+
 def serialize_history(messages, chat_id=None):
     return [serialize_message(msg, chat_id) for msg in messages]
 
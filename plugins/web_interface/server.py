@@ -2,7 +2,6 @@ import http.server
 import socketserver
 import json
 import os
-import queue
 import time
 import threading
 import sys
@@ -41,6 +40,12 @@ try:
 except Exception as e:
     log_debug(f"Storage import failed: {e}")
 
+import event_hub
+import scheduler
+import python_workers
+from rate_limiter import rate_limiter
+from prompt_cache import prompt_cache
+
 try:
     import serialization
 # guard removed
@@ -52,6 +57,11 @@ HOST = "127.0.0.1"
 #HOST = "192.168.123.10"
 START_PORT = 8080
 STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+SSE_KEEPALIVE = 15.0
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_PAGE_MAX = 500
+# Поля чата, которые отдаёт /load (сама история — постранично через /messages)
+CHAT_META_FIELDS = ("id", "name", "model", "active_preset_id", "active_modes", "busy_depth")
 
 mimetypes.init()
 mimetypes.add_type('application/javascript', '.js')
@@ -86,7 +96,6 @@ class WebRequestHandler(http.server.BaseHTTPRequestHandler):
 
         # 3. Initialize fresh components
         new_agent.print_to_console = False 
-        new_agent.web_queue = queue.Queue()
         
         return new_agent
     
@@ -118,9 +127,6 @@ class WebRequestHandler(http.server.BaseHTTPRequestHandler):
                     return None
                     
                 chat.client = self.ai_client
-                # Ensure web queue exists
-                if not hasattr(chat, 'web_queue') or chat.web_queue is None:
-                    chat.web_queue = queue.Queue()
                     
                 if warning:
                     print(warning)
@@ -164,6 +170,7 @@ class WebRequestHandler(http.server.BaseHTTPRequestHandler):
             elif path == "/api/final-prompts":
                 config = storage.get_final_prompts_config()
                 p_id = data.get("id") or str(time.time())
+                previous = config["prompts"].get(p_id, {})
                 config["prompts"][p_id] = {
                     "name": data.get("name", "New Prompt"), 
                     "text": data.get("text", ""),
@@ -173,6 +180,11 @@ class WebRequestHandler(http.server.BaseHTTPRequestHandler):
                     "exec_script": data.get("exec_script", ""),
                     "fs_permissions": data.get("fs_permissions")
                 }
+                # Настройки кеша gather_script редактор не показывает — сохраняем прежние
+                for field in ("gather_ttl", "gather_deps"):
+                    value = data.get(field, previous.get(field))
+                    if value:
+                        config["prompts"][p_id][field] = value
                 if data.get("make_active"): config["active_id"] = p_id
                 storage.save_final_prompts_config(config)
                 self._refresh_active_agents_prompts()
@@ -299,6 +311,7 @@ class WebRequestHandler(http.server.BaseHTTPRequestHandler):
                 cid = path.split("/")[-1]
                 if storage.delete_chat(cid):
                    if cid in self.active_chats: del self.active_chats[cid]
+                   python_workers.pool.release(cid)
                    self.send_json({"status": "deleted"})
                 else: self.send_json_error(404, "Not found")
          except Exception as e: self.send_json_error(500, str(e))
@@ -316,11 +329,6 @@ class WebRequestHandler(http.server.BaseHTTPRequestHandler):
         if not agent: 
             return self.send_json_error(500, "Agent init failed")
         
-        if getattr(agent, "busy_depth", False): 
-            return self.send_json_error(409, "Busy")
-        
-        agent.stop_requested = False
-
         # Orchestration is now handled by agent.py's send()
 
         msg_payload = {
@@ -330,6 +338,7 @@ class WebRequestHandler(http.server.BaseHTTPRequestHandler):
         }
 
         def run_and_save():
+            agent.stop_requested = False
             try:
                 agent.send(msg_payload)
             finally:
@@ -339,8 +348,12 @@ class WebRequestHandler(http.server.BaseHTTPRequestHandler):
                     except Exception as e:
                         print(f"Auto-save failed for {cid}: {e}")
 
-        threading.Thread(target=run_and_save).start()
-        self.send_json({"status": "processing"})
+        # Занятый чат не отклоняет сообщение: оно ждёт в очереди чата
+        ahead = scheduler.scheduler.submit(cid, getattr(agent, "model", None), run_and_save)
+        if ahead:
+            self.send_json({"status": "queued", "position": ahead})
+        else:
+            self.send_json({"status": "processing"})
         
     def api_create_chat(self):
         if is_print_debug:
@@ -377,12 +390,9 @@ class WebRequestHandler(http.server.BaseHTTPRequestHandler):
                 print(f"api_load_chat({cid})")
             chat, warning = storage.load_chat_state(cid, self.clone_root_chat)
             if chat: 
-                resp = chat.__dict__.copy()
-                if "client" in resp: del resp["client"]
-                if "web_queue" in resp: del resp["web_queue"]
-                
-                if serialization:
-                    resp["messages"] = serialization.serialize_history_for_web(chat.messages, chat_id=cid)
+                resp = {k: chat.__dict__[k] for k in CHAT_META_FIELDS if k in chat.__dict__}
+                resp["total_messages"] = len(chat.messages)
+                resp["usage_totals"] = serialization.usage_totals(chat.messages)
                 
                 chat.client = self.ai_client
                 self.active_chats[cid] = chat
@@ -393,13 +403,27 @@ class WebRequestHandler(http.server.BaseHTTPRequestHandler):
         except Exception as e:
             self.send_json_error(500, f"Error loading chat: {str(e)}")
     
+    def api_get_messages(self, path, query):
+        """Страница истории: ?before=<индекс>&limit=N, по умолчанию — самые новые сообщения."""
+        cid = path.split("/")[-2]
+        agent = self.get_agent_for_chat(cid)
+        if not agent:
+            return self.send_json_error(404, "Chat not found")
+        try:
+            before = query.get("before", [None])[0]
+            before = int(before) if before not in (None, "") else None
+            limit = min(int(query.get("limit", [MESSAGES_PAGE_SIZE])[0]), MESSAGES_PAGE_MAX)
+        except ValueError:
+            return self.send_json_error(400, "Invalid cursor")
+        self.send_json(serialization.page_history_for_web(agent.messages, chat_id=cid, before=before, limit=limit))
+
     def api_save_chat(self, path):
         if is_print_debug:
             print(f"api_save_chat({path})")
         
         cid = path.split("/")[-2]
         if cid in self.active_chats:
-            storage.save_chat_state(self.active_chats[cid])
+            storage.save_chat_state(self.active_chats[cid], checkpoint=True)
         self.send_json({"status": "saved"})
 
     def api_edit_message(self, path, data): 
@@ -415,9 +439,10 @@ class WebRequestHandler(http.server.BaseHTTPRequestHandler):
             print(f"api_stop({data})")
         
         cid = data.get("chatId")
+        cancelled = scheduler.scheduler.cancel(cid) if cid else 0
         if cid and cid in self.active_chats:
              self.active_chats[cid].stop_requested = True
-        self.send_json({"status": "ok"})
+        self.send_json({"status": "ok", "cancelled": cancelled})
 
 
     def api_clear_context(self, path):
@@ -431,7 +456,7 @@ class WebRequestHandler(http.server.BaseHTTPRequestHandler):
                     self.active_chats[cid] = new_agent
             self.send_json({"status": "context_cleared"})
         else:
-            self.send_json_error(404, "PKL not found")
+            self.send_json_error(404, "State not found")
 
     def api_change_preset(self, path, data):
         cid = path.split("/")[-2]
@@ -479,12 +504,17 @@ class WebRequestHandler(http.server.BaseHTTPRequestHandler):
             else: self.send_json_error(404, "Chat not found")
         if path == "/api/chats": 
             self.send_json(storage.list_chats())
+        elif path.startswith("/api/chats/") and path.endswith("/messages"):
+            self.api_get_messages(path, query)
         elif path == "/api/final-prompts":
             resp = storage.get_final_prompts_config()
             presets_cfg = storage.get_presets_config()
             resp["presets"] = presets_cfg.get("presets", {})
             resp["default_preset_id"] = presets_cfg.get("default_preset_id", "default")
             self.send_json(resp)
+        elif path == "/api/queue":
+            self.send_json({**scheduler.scheduler.metrics(), "rate_limits": rate_limiter.stats(),
+                            "prompt_cache": prompt_cache.metrics()})
         elif path == "/api/models":
             self.send_json(self.root_chat.models)
         elif path == "/api/tools":
@@ -504,25 +534,72 @@ class WebRequestHandler(http.server.BaseHTTPRequestHandler):
             if any(p and (".." in p or "/" in p or "\\" in p) for p in [chat_id, filename]):
                 return self.send_json_error(403, "Invalid path component")
                 
-            file_path = os.path.join("chats", chat_id, "images", filename)
+            # Shared content-addressed store first, legacy per-chat folder as fallback
+            file_path = storage.blob_store.blob_path(filename)
+            if not file_path or not os.path.exists(file_path):
+                file_path = os.path.join("chats", chat_id, "images", filename)
             
             if os.path.exists(file_path):
-                self.send_response(200)
-                mime, _ = mimetypes.guess_type(file_path)
-                self.send_header("Content-Type", mime or "application/octet-stream")
-                self._send_cors_headers()
-                
-                with open(file_path, 'rb') as f:
-                    content = f.read()
-                    
-                self.send_header("Content-Length", str(len(content)))
-                self.end_headers()
-                self.wfile.write(content)
+                self.stream_file(file_path, etag=f'"{filename.split(".", 1)[0]}"')
             else:
                 self.send_json_error(404, "Image not found")
         except Exception as e:
             self.send_json_error(500, str(e))
 
+    def stream_file(self, file_path, etag=None, chunk_size=64 * 1024):
+        """Отдаёт файл кусками с поддержкой ETag/If-None-Match и одиночного Range."""
+        size = os.path.getsize(file_path)
+        if etag is None:
+            st = os.stat(file_path)
+            etag = f'"{st.st_mtime_ns:x}-{size:x}"'
+
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self._send_cors_headers()
+            self.end_headers()
+            return
+
+        start, end = 0, size - 1
+        status = 200
+        range_header = self.headers.get("Range")
+        if range_header:
+            m = re.match(r"bytes=(\d*)-(\d*)$", range_header.strip())
+            if m and (m.group(1) or m.group(2)):
+                if m.group(1):
+                    start = int(m.group(1))
+                    if m.group(2): end = min(int(m.group(2)), size - 1)
+                else:
+                    start = max(0, size - int(m.group(2)))
+                if start > end or start >= size:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self._send_cors_headers()
+                    self.end_headers()
+                    return
+                status = 206
+
+        self.send_response(status)
+        mime, _ = mimetypes.guess_type(file_path)
+        self.send_header("Content-Type", mime or "application/octet-stream")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "private, max-age=31536000, immutable")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self._send_cors_headers()
+        self.end_headers()
+
+        with open(file_path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk: break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
     def serve_static(self, path):
         full = os.path.abspath(os.path.join(STATIC_DIR, path))
         if not full.startswith(STATIC_DIR): 
@@ -553,10 +630,16 @@ class WebRequestHandler(http.server.BaseHTTPRequestHandler):
             self.wfile.write(json.dumps(data, default=str).encode())
         except Exception as e: log_debug(f"Send JSON error: {e}")
 
+    # Единая CORS-политика: её же отдаёт asyncio-бэкенд (async_server.py) для SSE и ошибок
+    CORS_HEADERS = (
+        ("Access-Control-Allow-Origin", "*"),
+        ("Access-Control-Allow-Methods", "GET, POST, OPTIONS, DELETE, PATCH"),
+        ("Access-Control-Allow-Headers", "Content-Type"),
+    )
+
     def _send_cors_headers(self):
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS, DELETE, PATCH")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        for name, value in self.CORS_HEADERS:
+            self.send_header(name, value)
 
     def do_OPTIONS(self):
         self.send_response(200)
@@ -568,6 +651,8 @@ class WebRequestHandler(http.server.BaseHTTPRequestHandler):
         pass
 
     def handle_stream(self):
+        chat_ids, last_event_id = self.stream_params(self.path, self.headers)
+
         self.send_response(200)
         self.send_header("Content-Type", "text/event-stream")
         self.send_header("Cache-Control", "no-cache")
@@ -575,49 +660,33 @@ class WebRequestHandler(http.server.BaseHTTPRequestHandler):
         self._send_cors_headers()
         self.end_headers()
         
-        self.wfile.write(b": keep-alive\n\n")
-        self.wfile.flush()
-        
-        while True:
-            # Snapshot of active chats to avoid runtime errors if dict changes
-            current_chats = list(self.active_chats.values())
-            
-            if not current_chats:
-                try:
-                    time.sleep(1)
-                    self.wfile.write(b": keep-alive\n\n")
-                    self.wfile.flush()
-                except Exception:
-                    break
-                continue
-
-            got_event = False
-            for chat in current_chats:
-                try:
-                    # Use a small timeout to poll all chats
-                    if not hasattr(chat, 'web_queue') or chat.web_queue is None:
-                        continue
-                        
-                    event = chat.web_queue.get(timeout=0.05)
-                    payload = json.dumps(event, ensure_ascii=False)
-                    self.wfile.write(f"data: {payload}\n\n".encode())
-                    self.wfile.flush()
-                    got_event = True
-                except queue.Empty:
-                    pass
-                except Exception as e:
-                    log_debug(f"SSE Connection error: {e}")
-                    return
-
-            if not got_event:
-                 try:
-                    time.sleep(0.5)
-                    self.wfile.write(b": keep-alive\n\n")
-                    self.wfile.flush()
-                 except Exception:
-                    for c in current_chats:
-                        if hasattr(c, "stop_requested"): c.stop_requested = True
-                    break
+        sub = event_hub.hub.subscribe(chat_ids, last_event_id)
+        try:
+            self.wfile.write(b": keep-alive\n\n")
+            self.wfile.flush()
+            while True:
+                events = sub.get(timeout=SSE_KEEPALIVE)
+                self.wfile.write(event_hub.format_frames(events) if events else b": keep-alive\n\n")
+                self.wfile.flush()
+        except Exception as e:
+            log_debug(f"SSE Connection closed: {e}")
+        finally:
+            sub.close()
+            self.stop_if_no_listeners()
+
+    @classmethod
+    def stream_params(cls, target, headers):
+        """(chat_ids, last_event_id) из query (?chat_id=a,b) и заголовка Last-Event-ID."""
+        query = parse_qs(urlparse(target).query)
+        chat_ids = [c for c in ",".join(query.get("chat_id", [])).split(",") if c] or None
+        return chat_ids, headers.get("Last-Event-ID") or query.get("last_event_id", [None])[0]
+
+    @classmethod
+    def stop_if_no_listeners(cls):
+        # Последний клиент ушёл — останавливаем генерацию, как и раньше
+        if event_hub.hub.subscriber_count() == 0:
+            for c in list(cls.active_chats.values()):
+                if hasattr(c, "stop_requested"): c.stop_requested = True
 
 def get_free_port(start_port):
     port = start_port
@@ -630,11 +699,12 @@ def get_free_port(start_port):
                 port += 1
     return start_port
 
-def run_server(chat):
+def run_server(chat, backend="threading"):
     WebRequestHandler.ai_client = chat.client
     chat.client = None
     chat.web_queue = None
     WebRequestHandler.root_chat = chat
+    storage.set_state_template(chat)
     print(f"WebRequestHandler настроен")
 
     if not os.path.exists(STATIC_DIR): 
@@ -644,6 +714,15 @@ def run_server(chat):
     port = get_free_port(START_PORT)
     log_debug(f"Server starting on {port}")
     print(f"Порт получен: {port}")
+    if backend == "asyncio":
+        import async_server
+        try:
+            print(f"🌍 Web Interface (asyncio) running at http://{HOST}:{port}")
+            async_server.serve(WebRequestHandler, HOST, port, keepalive=SSE_KEEPALIVE)
+        except Exception as e:
+            log_debug(f"Server crash: {e}")
+            print(f"❌ Server crashed: {e}")
+        return
     try:
         server = socketserver.ThreadingTCPServer((HOST, port), WebRequestHandler)
         server.allow_reuse_address = True
@@ -0,0 +1,104 @@
+import io
+import re
+import types
+import pickle
+import zlib
+import dill
+from agent import TRANSIENT_ATTRS
+
+# Компактный версионированный формат состояния чата (chats/<id>.state).
+# Хранит только то, что отличается от корневого шаблона чата: сообщения, режимы,
+# пресет, модель и сериализуемую часть local_env. Всё остальное (system_prompt,
+# tools, prompts, ...) при загрузке берётся из свежего клона шаблона.
+
+MAGIC = b"AGST"
+VERSION = 1
+
+# Статические данные шаблона: используются, если шаблон не зарегистрирован
+STATIC_ATTRS = {
+    "system_prompt", "self_code", "tools", "prompts", "user_profile", "models",
+    "gemini_keys", "ai_key", "current_key_index", "google_search_key", "search_engine_id",
+    "saved_code", "agent_dir", "final_prompt", "tool_handlers",
+}
+
+_template = None
+
+def register_template(chat):
+    """Запоминает корневой чат, относительно которого считаются дельты."""
+    global _template
+    _template = chat
+
+def _same_as_template(key, value):
+    if _template is None:
+        return key in STATIC_ATTRS
+    if key not in _template.__dict__:
+        return False
+    try:
+        return bool(_template.__dict__[key] == value)
+    except Exception:
+        return False
+
+def _pack(value):
+    """(codec, bytes): обычный pickle, а dill — только если без него никак."""
+    try:
+        return "p", pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return "d", dill.dumps(value)
+
+def _unpack(codec, data):
+    return pickle.loads(data) if codec == "p" else dill.loads(data)
+
+def _pack_local_env(local_env):
+    packed = {}
+    for k, v in local_env.items():
+        if k == "self" or isinstance(v, (io.IOBase, types.ModuleType, re.Match)):
+            continue
+        try:
+            packed[k] = _pack(v)
+        except Exception:
+            pass  # несериализуемые значения (сокеты, процессы) не переживают перезапуск
+    return packed
+
+def encode(chat, messages=None):
+    """messages — подмена chat.messages для записи (например, история без байтов изображений)."""
+    attrs = {}
+    local_env = {}
+    for key, value in chat.__dict__.items():
+        if key == "messages" and messages is not None:
+            value = messages
+        if key in TRANSIENT_ATTRS:
+            continue
+        if key == "local_env":
+            local_env = _pack_local_env(value or {})
+            continue
+        if key != "messages" and _same_as_template(key, value):
+            continue
+        try:
+            attrs[key] = _pack(value)
+        except Exception as e:
+            print(f"⚠️ state_codec: attribute '{key}' skipped: {e}")
+    payload = {"version": VERSION, "attrs": attrs, "local_env": local_env}
+    return MAGIC + bytes([VERSION]) + zlib.compress(pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL), 1)
+
+def decode(data, get_chat):
+    """Восстанавливает чат: клон шаблона (get_chat) + сохранённые дельты."""
+    if data[:4] != MAGIC:
+        raise ValueError("Not a chat state file")
+    version = data[4]
+    if version > VERSION:
+        raise ValueError(f"Unsupported chat state version: {version}")
+    payload = pickle.loads(zlib.decompress(data[5:]))
+
+    chat = get_chat()
+    for key, (codec, raw) in payload["attrs"].items():
+        try:
+            setattr(chat, key, _unpack(codec, raw))
+        except Exception as e:
+            print(f"⚠️ state_codec: attribute '{key}' not restored: {e}")
+    env = chat.__dict__.setdefault("local_env", {})
+    for key, (codec, raw) in payload["local_env"].items():
+        try:
+            env[key] = _unpack(codec, raw)
+        except Exception:
+            pass
+    return chat
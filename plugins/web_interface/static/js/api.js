@@ -12,6 +12,13 @@ export async function loadChat(id) {
     return res.json();
 }
 
+export async function fetchMessages(id, before = null, limit = 50) {
+    const params = new URLSearchParams({ limit });
+    if (before !== null && before !== undefined) params.set('before', before);
+    const res = await fetch(`${API_BASE}/chats/${id}/messages?${params}`);
+    return res.json();
+}
+
 export async function fetchCurrentChat() {
     return null; 
 }
@@ -389,6 +389,10 @@ export default {
          id="chat-messages-container"
          ref="messagesContainer" @scroll="handleScroll">
 
+        <div v-if="store.isLoadingOlder" class="flex justify-center py-2 text-gray-500 text-xs">
+          <i class="ph ph-circle-notch animate-spin mr-2"></i> Загрузка истории...
+        </div>
+
         <!-- Дашборд статистики сессии -->
         <div v-if="filteredMessages.length > 0 && (store.totalInputTokens > 0 || store.totalOutputTokens > 0)" 
            class="w-[95%] mx-auto grid gap-3 mt-2 mb-6 opacity-70 hover:opacity-100 transition-opacity"
@@ -666,6 +670,19 @@ export default {
       if (!messagesContainer.value) return;
       const { scrollTop, scrollHeight, clientHeight } = messagesContainer.value;
       showScrollButton.value = (scrollHeight - scrollTop - clientHeight) > 300;
+      if (scrollTop < 200 && store.messagesCursor !== null && !store.isLoadingOlder) loadOlder();
+    };
+    const loadOlder = async () => {
+      const el = messagesContainer.value;
+      const prevHeight = el ? el.scrollHeight : 0;
+      if (!(await store.loadOlderMessages())) return;
+      await nextTick();
+      // Сохраняем позицию: старые сообщения добавились сверху
+      if (el) {
+        el.style.scrollBehavior = 'auto';
+        el.scrollTop += el.scrollHeight - prevHeight;
+        el.style.scrollBehavior = '';
+      }
     };
     watch(() => store.messages, async () => {
       let shouldScroll = true;
@@ -804,6 +821,7 @@ export default {
         try { 
           const res = await api.sendMessage(store.currentChatId, text, imgs);
           if (res.error) { store.isThinking = false; store.addToast(res.error,"error"); }
+          else if (res.status === 'queued') store.addToast(`Сообщение в очереди (перед ним: ${res.position})`, "info");
         } 
         catch (e) { store.isThinking = false; store.addToast("Ошибка отправки","error"); }
       }
@@ -207,8 +207,7 @@ export default {
         if (res.status === 'context_cleared') {
           store.addToast('Контекст очищен', 'success');
           if (store.currentChatId === id) {
-             const data = await api.loadChat(id);
-             store.setMessages(data.chat.messages);
+             await store.loadLatestMessages(id);
           }
         }
       }
@@ -238,6 +237,7 @@ export default {
         return;
       }
       store.currentChatId = 'temp';
+      store.setUsageTotals(null);
       store.setMessages([]);
       if (window.innerWidth < 768) store.closeSidebarMobile();
     };
@@ -249,7 +249,7 @@ export default {
           store.addToast(res.error, 'error');
           return;
         }
-        if (store.currentChatId === id) { store.currentChatId = null; store.setMessages([]); }
+        if (store.currentChatId === id) { store.currentChatId = null; store.setUsageTotals(null); store.setMessages([]); }
         await refreshList();
       }
     };
@@ -267,7 +267,9 @@ export default {
         store.currentChatId = id;
         store.activePresetId = data.chat.active_preset_id || 'default';
         store.active_parameters = data.chat.active_modes || [];
-        store.setMessages(data.chat.messages);
+        store.setUsageTotals(data.chat.usage_totals);
+        store.setMessages([]);
+        await store.loadLatestMessages(id);
         
         if (data.chat.model) {
           selectedModel.value = data.chat.model;
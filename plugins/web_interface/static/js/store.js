@@ -5,6 +5,8 @@ export const store = reactive({
     currentChatId: null,
     chats: [],
     messages: [],
+    messagesCursor: null,     // индекс самого старого загруженного сообщения (null — загружено всё)
+    isLoadingOlder: false,
     isThinking: false,
     models: [],
     allTools: [],
@@ -32,24 +34,36 @@ export const store = reactive({
     active_parameters: [], 
     
     
+    // Итоги по всей истории чата считает сервер (usage_totals в ответе загрузки чата):
+    // в messages лежат только загруженные страницы. К ним добавляются метрики сообщений,
+    // пришедших после загрузки (у сообщений из истории стоит fromHistory).
+    usageTotals: null,
+    setUsageTotals(totals) {
+        this.usageTotals = totals || null;
+    },
+    _liveUsage(key, combine) {
+        const base = this.usageTotals?.[key] || 0;
+        return this.messages.reduce((acc, msg) => msg.fromHistory ? acc : combine(acc, msg.metrics?.[key] || 0), base);
+    },
+
     // Computed Metrics
     get totalInputTokens() {
-        return this.messages.reduce((maxVal, msg) => Math.max(maxVal, msg.metrics?.total_context || 0), 0);
+        return this._liveUsage('total_context', Math.max);
     },
     get totalCachedTokens() {
-        return this.messages.reduce((sum, msg) => sum + (msg.metrics?.cached_tokens || 0), 0);
+        return this._liveUsage('cached_tokens', (a, b) => a + b);
     },
     get totalUncachedTokens() {
-        return this.messages.reduce((sum, msg) => sum + (msg.metrics?.uncached_tokens || 0), 0);
+        return this._liveUsage('uncached_tokens', (a, b) => a + b);
     },
     get totalInputTime() {
-        return this.messages.reduce((sum, msg) => sum + (msg.metrics?.input_time || 0), 0);
+        return this._liveUsage('input_time', (a, b) => a + b);
     },
     get totalOutputTokens() {
-        return this.messages.reduce((sum, msg) => sum + (msg.metrics?.output_tokens || 0), 0);
+        return this._liveUsage('output_tokens', (a, b) => a + b);
     },
     get totalOutputTime() {
-        return this.messages.reduce((sum, msg) => sum + (msg.metrics?.output_time || 0), 0);
+        return this._liveUsage('output_time', (a, b) => a + b);
     },
     get currentContextTokens() {
         if (this.messages.length === 0) return 0;
@@ -76,13 +90,44 @@ export const store = reactive({
         
         return lastUserContext + lastModelOutput;
     },
-    setMessages(msgs) {
+    setMessages(msgs, cursor = null) {
+        this.messagesCursor = cursor;
         if (!msgs) {
             this.messages = [];
             return;
         }
         
-        this.messages = msgs.map(m => {
+        this.messages = this.toViewMessages(msgs);
+    },
+
+    // Первая (самая новая) страница истории чата
+    async loadLatestMessages(chatId) {
+        const api = await import('./api.js');
+        const page = await api.fetchMessages(chatId);
+        if (page.error) return page;
+        if (this.currentChatId === chatId) this.setMessages(page.messages, page.cursor);
+        return page;
+    },
+
+    // Подгрузка более старой страницы при прокрутке вверх
+    async loadOlderMessages() {
+        if (this.messagesCursor === null || this.isLoadingOlder || !this.currentChatId) return false;
+        const chatId = this.currentChatId;
+        this.isLoadingOlder = true;
+        try {
+            const api = await import('./api.js');
+            const page = await api.fetchMessages(chatId, this.messagesCursor);
+            if (page.error || this.currentChatId !== chatId) return false;
+            this.messages = [...this.toViewMessages(page.messages), ...this.messages];
+            this.messagesCursor = page.cursor;
+            return true;
+        } finally {
+            this.isLoadingOlder = false;
+        }
+    },
+
+    toViewMessages(msgs) {
+        return msgs.map(m => {
             if (m.items && Array.isArray(m.items)) return m;
 
             const items = [];
@@ -155,7 +200,7 @@ export const store = reactive({
                  if (!hasImages) items.push({ type: 'images', content: m.images });
             }
 
-            return { ...m, items: items, metrics: m.metrics || null };
+            return { ...m, items: items, metrics: m.metrics || null, fromHistory: true };
         });
     },
     
@@ -7,10 +7,13 @@ import dill
 import copy
 import sys
 import types
-import queue
 import traceback
 import re
 import threading
+import hashlib
+import bisect
+import atexit
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 PROMPTS_CONFIG_PATH = "final_prompts.json"
 WEB_PROMPT_MARKER_START = "### FINAL_PRO" + "MPT_START ###"
@@ -26,10 +29,24 @@ except ImportError:
     print("Warning: serialization module not found in storage")
     serialization = None
 
+import state_codec
+import blob_store
+
 is_print_debug = True
 CHATS_DIR = "chats"
 INDEX_PATH = os.path.join(CHATS_DIR, "index.json")
-index_lock = threading.Lock()
+index_lock = threading.RLock()
+INDEX_FLUSH_DELAY = 1.0  # write-behind: секунд между изменением индекса и записью index.json
+INDEX_REBUILD_WORKERS = min(8, (os.cpu_count() or 1) + 4)
+
+# Append-only журнал сообщений: chats/<id>.jsonl дописывается на каждом ходе,
+# а пара .json/.state становится редким чекпоинтом (компакцией журнала).
+LOG_VERSION = 1
+LOG_COMPACT_RECORDS = 200            # записей в журнале до компакции
+LOG_COMPACT_BYTES = 8 * 1024 * 1024  # или байт
+LOG_RECHECK_TAIL = 4                 # сколько последних сообщений перепроверять всегда (стрим дописывает части)
+_log_locks = {}
+_log_locks_guard = threading.Lock()
 
 def ensure_chats_dir():
     if not os.path.exists(CHATS_DIR):
@@ -45,95 +62,221 @@ def get_current_config():
     return {}
 
 # --- INDEXING LOGIC ---
+# Индекс живёт в памяти: словарь id -> запись и отсортированный по updated_at
+# список ключей. index.json пишется отложенно (write-behind), а его mtime
+# используется для инвалидации, если файл изменили снаружи.
+
+_index = None              # id -> {"id", "name", "updated_at", "preview"}
+_index_order = []          # отсортированный список (updated_at, id)
+_index_mtime = None        # mtime index.json, соответствующий содержимому памяти
+_index_path_loaded = None  # путь, из которого загружен индекс (CHATS_DIR может меняться)
+_index_pending = {}        # id -> запись или None (удаление), ещё не сброшенные на диск
+_index_timer = None
+
+def _index_path():
+    return os.path.join(CHATS_DIR, "index.json")
+
+def _file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
 
 def _load_index_raw():
-    if os.path.exists(INDEX_PATH):
+    path = _index_path()
+    if os.path.exists(path):
         try:
-            with open(INDEX_PATH, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return data if isinstance(data, list) else None
         except:
             # Если файл битый (например, оборванная запись), возвращаем None,
             # чтобы спровоцировать пересборку индекса.
             return None
     return None # Если файла нет
 
-def _save_index_raw(index_data):
+def _save_index_raw(index_data, path=None):
+    global _index_mtime
     try:
-        tmp_path = INDEX_PATH + ".tmp"
+        path = path or _index_path()
+        tmp_path = path + ".tmp"
         with open(tmp_path, 'w', encoding='utf-8') as f:
-            json.dump(index_data, f, ensure_ascii=False, indent=2)
-        os.replace(tmp_path, INDEX_PATH)
+            json.dump(index_data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, path)
+        _index_mtime = _file_mtime(path)
     except Exception as e:
         print(f"Error saving index: {e}")
 
-def _rebuild_index():
+def _index_set(entry):
+    old = _index.get(entry["id"])
+    if old is not None:
+        key = (old.get("updated_at", ""), old["id"])
+        pos = bisect.bisect_left(_index_order, key)
+        if pos < len(_index_order) and _index_order[pos] == key:
+            del _index_order[pos]
+    _index[entry["id"]] = entry
+    bisect.insort(_index_order, (entry.get("updated_at", ""), entry["id"]))
+
+def _index_del(chat_id):
+    old = _index.pop(chat_id, None)
+    if old is not None:
+        key = (old.get("updated_at", ""), chat_id)
+        pos = bisect.bisect_left(_index_order, key)
+        if pos < len(_index_order) and _index_order[pos] == key:
+            del _index_order[pos]
+    return old is not None
+
+def _index_replace(entries):
+    global _index, _index_order, _index_path_loaded
+    _index = {}
+    _index_order = []
+    _index_path_loaded = _index_path()
+    for item in entries:
+        if isinstance(item, dict) and item.get("id"):
+            item.setdefault("updated_at", "")
+            _index[item["id"]] = item
+    _index_order = sorted((item["updated_at"], cid) for cid, item in _index.items())
+
+def _ensure_index():
+    """Загружает индекс в память при первом обращении и перечитывает его,
+    если index.json изменён снаружи (mtime не совпадает с нашим)."""
+    global _index_mtime
+    path = _index_path()
+    if _index is not None and _index_path_loaded != path:
+        # CHATS_DIR сменился: дописываем хвост старого индекса по его пути
+        if _index_pending:
+            _save_index_raw([_index[cid] for _, cid in _index_order], _index_path_loaded)
+            _index_pending.clear()
+    mtime = _file_mtime(path)
+    if _index is not None and _index_path_loaded == path and (mtime == _index_mtime or mtime is None and _index_pending):
+        return
+    data = _load_index_raw()
+    if data is None:
+        _rebuild_index()
+        return
+    _index_replace(data)
+    # Локальные изменения, ещё не записанные на диск, важнее прочитанного файла
+    for cid, entry in _index_pending.items():
+        if entry is None: _index_del(cid)
+        else: _index_set(entry)
+    _index_mtime = mtime
+
+def _schedule_index_flush():
+    global _index_timer
+    if _index_timer is None:
+        _index_timer = threading.Timer(INDEX_FLUSH_DELAY, flush_index)
+        _index_timer.daemon = True
+        _index_timer.start()
+
+def flush_index():
+    """Сбрасывает отложенные изменения индекса в index.json."""
+    global _index_timer
+    with index_lock:
+        _index_timer = None
+        if _index is None or not _index_pending:
+            return
+        os.makedirs(os.path.dirname(_index_path_loaded), exist_ok=True)
+        _save_index_raw([_index[cid] for _, cid in _index_order], _index_path_loaded)
+        _index_pending.clear()
+
+atexit.register(flush_index)
+
+def _meta_path(chat_id):
+    return os.path.join(CHATS_DIR, f"{chat_id}.meta.json")
+
+def _write_meta(chat_id, name, updated_at, preview):
+    """Маленький sidecar-заголовок чата: по нему индекс строится без разбора messages."""
+    path = _meta_path(chat_id)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"id": chat_id, "name": name, "updated_at": updated_at, "preview": preview}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def _read_chat_header(chat_id):
+    """Запись индекса для чата: из .meta.json, а для старых чатов — из полного .json
+    (после чего sidecar создаётся, и следующая пересборка его уже не парсит)."""
+    try:
+        with open(_meta_path(chat_id), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        return {
+            "id": chat_id,
+            "name": meta.get("name", "New Chat"),
+            "updated_at": meta.get("updated_at", ""),
+            "preview": meta.get("preview", "Empty chat")
+        }
+    except (OSError, ValueError):
+        pass
+
+    with open(os.path.join(CHATS_DIR, f"{chat_id}.json"), 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    entry = {
+        "id": chat_id,
+        "name": data.get("name", "New Chat"),
+        "updated_at": data.get("updated_at", ""),
+        "preview": _get_preview(data.get("messages", []))
+    }
+    try:
+        _write_meta(chat_id, entry["name"], entry["updated_at"], entry["preview"])
+    except OSError:
+        pass
+    return entry
+
+def _rebuild_index(progress=None):
+    """Пересобирает индекс по заголовкам чатов, параллельно в пуле потоков.
+    progress(done, total) вызывается по мере готовности записей."""
     if is_print_debug: print("🛠 Rebuilding chats index...")
     ensure_chats_dir()
     chats = []
     try:
-        files = [f for f in os.listdir(CHATS_DIR) if f.endswith(".json") and f != "index.json"]
+        files = [f for f in os.listdir(CHATS_DIR) if f.endswith(".json") and f != "index.json" and not f.endswith(".meta.json")]
     except OSError:
         return []
 
-    for filename in files:
-        chat_id = filename[:-5]
-        json_path = os.path.join(CHATS_DIR, filename)
-        try:
-            with open(json_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            chats.append({
-                "id": chat_id,
-                "name": data.get("name", "New Chat"),
-                "updated_at": data.get("updated_at", ""),
-                "preview": _get_preview(data.get("messages", []))
-            })
-        except: continue
+    total = len(files)
+    if progress is None and is_print_debug:
+        step = max(1, total // 10)
+        def progress(done, total):
+            if done % step == 0 or done == total:
+                print(f"🛠 Index: {done}/{total}")
+
+    if total:
+        with ThreadPoolExecutor(max_workers=INDEX_REBUILD_WORKERS) as pool:
+            futures = [pool.submit(_read_chat_header, filename[:-5]) for filename in files]
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    chats.append(future.result())
+                except Exception:
+                    pass
+                if progress: progress(done, total)
     
     with index_lock:
+        _index_replace(chats)
+        _index_pending.clear()
         _save_index_raw(chats)
     return chats
 
 def _update_index_entry(chat_id, name, updated_at, preview):
+    entry = {"id": chat_id, "name": name, "updated_at": updated_at, "preview": preview}
     with index_lock:
-        index = _load_index_raw()
-        if index is None: # Если индекса нет или он поврежден, пересоберем всё
-            _rebuild_index()
-            return
-            
-        # Ищем существующий
-        found = False
-        for i, item in enumerate(index):
-            if item.get("id") == chat_id:
-                index[i] = {"id": chat_id, "name": name, "updated_at": updated_at, "preview": preview}
-                found = True
-                break
-        
-        if not found:
-            index.append({"id": chat_id, "name": name, "updated_at": updated_at, "preview": preview})
-            
-        _save_index_raw(index)
+        _ensure_index()
+        _index_set(entry)
+        _index_pending[chat_id] = entry
+        _schedule_index_flush()
 
 def _remove_from_index(chat_id):
     with index_lock:
-        index = _load_index_raw()
-        if index:
-            new_index = [item for item in index if item.get("id") != chat_id]
-            if len(new_index) != len(index):
-                _save_index_raw(new_index)
+        _ensure_index()
+        if _index_del(chat_id):
+            _index_pending[chat_id] = None
+            _schedule_index_flush()
 
 # --- PUBLIC API ---
 
 def list_chats(get_chat=None):
-    with index_lock: # Блокируем чтение для безопасности
-        index = _load_index_raw()
-        
-    if index is None:
-        return _rebuild_index()
-    
-    # Сортировка по дате обновления (новые сверху)
-    index.sort(key=lambda x: x.get("updated_at", ""), reverse=True)
-    return index
+    # Сортировка по дате обновления (новые сверху) уже поддерживается _index_order
+    with index_lock:
+        _ensure_index()
+        return [dict(_index[cid]) for _, cid in reversed(_index_order)]
 
 def _get_preview(messages):
     for msg in reversed(messages):
@@ -154,27 +297,218 @@ def _get_preview(messages):
                 return (content[:70] + '...') if len(content) > 70 else content
     return "Empty chat"
 
+# --- APPEND-ONLY MESSAGE LOG ---
+
+def _log_path(chat_id):
+    return os.path.join(CHATS_DIR, f"{chat_id}.jsonl")
+
+def _get_log_lock(chat_id):
+    with _log_locks_guard:
+        lock = _log_locks.get(chat_id)
+        if lock is None:
+            lock = _log_locks[chat_id] = threading.Lock()
+        return lock
+
+def _dump_line(record):
+    return json.dumps(record, ensure_ascii=False, default=str)
+
+def _line_hash(line):
+    return hashlib.md5(line.encode("utf-8")).hexdigest()
+
+def _serialize_for_log(msg, chat_id):
+    data = serialization.serialize_message(msg, chat_id) if serialization else msg
+    return _dump_line(data)
+
+def _chat_meta(chat):
+    return {
+        'name': getattr(chat, 'name', 'New Chat'),
+        'updated_at': getattr(chat, 'updated_at', ''),
+        'active_preset_id': getattr(chat, 'active_preset_id', 'default'),
+        'active_modes': list(getattr(chat, 'active_modes', []) or []),
+        'model': getattr(chat, 'model', None),
+        'model_rpm': getattr(chat, 'model_rpm', None),
+    }
+
+def _read_log(chat_id):
+    """Читает журнал: (header, records). Оборванная последняя строка пропускается."""
+    path = _log_path(chat_id)
+    if not os.path.exists(path):
+        return None, []
+    header = None
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line: continue
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if rec.get("op") == "header":
+                header = rec
+                records = []
+            else:
+                records.append(rec)
+    return header, records
+
+def _replay_log(messages, records):
+    """Применяет записи журнала к списку сообщений чекпоинта. Возвращает последнюю meta-запись."""
+    meta = None
+    for rec in records:
+        op = rec.get("op")
+        if op in ("append", "set"):
+            msg = serialization.deserialize_message(rec["msg"]) if serialization else rec["msg"]
+            i = rec.get("i", len(messages))
+            if i < len(messages):
+                messages[i] = msg
+            elif i == len(messages):
+                messages.append(msg)
+        elif op == "truncate":
+            del messages[rec.get("n", len(messages)):]
+        elif op == "meta":
+            meta = rec
+    return meta
+
+def _apply_log(chat, checkpoint):
+    """Догружает в chat хвост журнала, если он относится к тому же чекпоинту."""
+    header, records = _read_log(chat.id)
+    if not header or header.get("checkpoint") != checkpoint:
+        return
+    del chat.messages[header.get("base", len(chat.messages)):]
+    meta = _replay_log(chat.messages, records)
+    if meta:
+        for key, value in meta.items():
+            if key != "op": setattr(chat, key, value)
+    _init_log_state(chat, checkpoint, len(records), os.path.getsize(_log_path(chat.id)))
+
+def _init_log_state(chat, checkpoint, records=0, size=0):
+    count = len(chat.messages)
+    hashes = {}
+    for i in range(max(0, count - LOG_RECHECK_TAIL), count):
+        hashes[i] = _line_hash(_serialize_for_log(chat.messages[i], chat.id))
+    chat.__dict__.pop('_changed_messages', None)
+    chat._log_state = {
+        "checkpoint": checkpoint,
+        "messages": list(chat.messages),  # какие объекты лежали на каждой позиции при прошлом сохранении
+        "hashes": hashes,                 # хеши строк, известные на прошлое сохранение
+        "records": records,
+        "bytes": size,
+        "meta": _chat_meta(chat),
+    }
+
+def _changed_indices(chat, state):
+    """Позиции, которые надо перепроверить: хвост, заменённые сообщения
+    и сообщения, помеченные чатом как изменённые на месте (Chat._mark_message_changed)."""
+    messages = chat.messages
+    saved = state["messages"]
+    count = min(len(saved), len(messages))
+    touched = {id(m) for m in chat.__dict__.pop('_changed_messages', None) or ()}
+    indices = set(range(max(0, count - LOG_RECHECK_TAIL), len(messages)))
+    for i in range(count):
+        msg = messages[i]
+        if msg is not saved[i] or id(msg) in touched:
+            indices.add(i)
+    return sorted(indices)
+
+def _append_to_log(chat):
+    """Дописывает в журнал только изменения с прошлого сохранения.
+    Возвращает False, если журнал пора компактировать в чекпоинт."""
+    state = chat._log_state
+    messages = chat.messages
+    lines = []
+    count = len(state["messages"])
+    hashes = state["hashes"]
+
+    if len(messages) < count:
+        lines.append(_dump_line({"op": "truncate", "n": len(messages)}))
+        count = len(messages)
+        hashes = {i: h for i, h in hashes.items() if i < count}
+
+    for i in _changed_indices(chat, state):
+        msg_line = _serialize_for_log(messages[i], chat.id)
+        h = _line_hash(msg_line)
+        if i < count:
+            # Хеш старого сообщения может быть неизвестен — тогда запись повторяется, это безопасно
+            if hashes.get(i) == h: continue
+            op = "set"
+        else:
+            op = "append"
+        lines.append('{"op": "%s", "i": %d, "msg": %s}' % (op, i, msg_line))
+        hashes[i] = h
+
+    meta = _chat_meta(chat)
+    if meta != state["meta"]:
+        lines.append(_dump_line(dict(op="meta", **meta)))
+
+    if lines:
+        data = "\n".join(lines) + "\n"
+        with open(_log_path(chat.id), 'a', encoding='utf-8') as f:
+            f.write(data)
+        state["records"] += len(lines)
+        state["bytes"] += len(data.encode("utf-8"))
+
+    state["messages"] = list(messages)
+    state["hashes"] = hashes
+    state["meta"] = meta
+    return state["records"] < LOG_COMPACT_RECORDS and state["bytes"] < LOG_COMPACT_BYTES
+
+def _reset_log(chat_id, checkpoint, base):
+    path = _log_path(chat_id)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(_dump_line({"op": "header", "version": LOG_VERSION, "id": chat_id, "checkpoint": checkpoint, "base": base}) + "\n")
+    os.replace(tmp_path, path)
+
+# --- PUBLIC API (STATE) ---
+
+def set_state_template(chat):
+    """Корневой чат, из которого восстанавливается всё, что не хранится в .state."""
+    state_codec.register_template(chat)
+
+def _finish_loaded_chat(chat, id):
+    if not getattr(chat, "name", False): chat.name = "New chat"
+    if not getattr(chat, "id", False): chat.id = id
+    if not getattr(chat, "active_preset_id", False): chat.active_preset_id = 'default'
+    chat.busy_depth = 0
+
+def _load_legacy_pkl(pkl_path, id):
+    with open(pkl_path, 'rb') as f:
+        if is_print_debug:
+            print(f"dill...")
+        chat = dill.load(f)
+        if is_print_debug:
+            print(f"end")
+    _finish_loaded_chat(chat, id)
+    checkpoint = getattr(chat, "_log_checkpoint", None)
+    if checkpoint:
+        _apply_log(chat, checkpoint)
+    # Миграция: следующий save_chat_state запишет полный чекпоинт в формате .state
+    chat.__dict__.pop('_log_state', None)
+    return chat
+
 def load_chat_state(id, get_chat):
     if is_print_debug:
         print(f"load_chat_state({id})")
     ensure_chats_dir()
+    state_path = os.path.join(CHATS_DIR, f"{id}.state")
     pkl_path = os.path.join(CHATS_DIR, f"{id}.pkl")
     json_path = os.path.join(CHATS_DIR, f"{id}.json")
+
+    if os.path.exists(state_path) and os.path.getsize(state_path) > 0:
+        try:
+            with open(state_path, 'rb') as f:
+                chat = state_codec.decode(f.read(), get_chat)
+            _finish_loaded_chat(chat, id)
+            checkpoint = getattr(chat, "_log_checkpoint", None)
+            if checkpoint:
+                _apply_log(chat, checkpoint)
+            return chat, None
+        except Exception as e:
+            print(f"⚠️ Failed to decode {state_path}: {e}")
     
     if os.path.exists(pkl_path) and os.path.getsize(pkl_path) > 0:
         try:
-            with open(pkl_path, 'rb') as f:
-                if is_print_debug:
-                    print(f"dill...")
-                chat = dill.load(f)
-                if is_print_debug:
-                    print(f"end")
-                if not getattr(chat, "name", False): chat.name = "New chat"
-                if not getattr(chat, "id", False): chat.id = id
-                if not getattr(chat, "active_preset_id", False): chat.active_preset_id = 'default'
-                if not hasattr(chat, "web_queue") or chat.web_queue is None: chat.web_queue = queue.Queue()
-                chat.busy_depth = 0
-                return chat, None
+            return _load_legacy_pkl(pkl_path, id), None
         except: pass
 
     if os.path.exists(json_path) and os.path.getsize(json_path) > 0:
@@ -185,32 +519,44 @@ def load_chat_state(id, get_chat):
             for key, value in data.items():
                 if key == "messages" and serialization:
                     chat.messages = serialization.deserialize_history(value)
+                elif key == "log_checkpoint":
+                    chat._log_checkpoint = value
                 else: setattr(chat, key, value)
             chat.id = id
             chat.busy_depth = 0
+            if data.get("log_checkpoint"):
+                _apply_log(chat, data["log_checkpoint"])
             return chat, "⚠️ Restored from JSON backup."
         except: pass
 
     return None, "Chat not found"
 
-def save_chat_state(chat):
+def migrate_legacy_states(get_chat):
+    """Переводит все старые chats/<id>.pkl в формат .state. Возвращает список мигрированных id."""
     ensure_chats_dir()
-    if not getattr(chat, 'id', None): chat.id = str(uuid.uuid4())
-    chat.updated_at = datetime.datetime.now().isoformat()
-    
-    # Очистка системного промпта
-    if hasattr(chat, 'system_prompt') and chat.system_prompt:
-        pattern = re.escape(WEB_PROMPT_MARKER_START) + r".*?" + re.escape(WEB_PROMPT_MARKER_END)
-        chat.system_prompt = re.sub(pattern, "", chat.system_prompt, flags=re.DOTALL).strip()
+    migrated = []
+    for filename in os.listdir(CHATS_DIR):
+        if not filename.endswith(".pkl"):
+            continue
+        chat_id = filename[:-4]
+        if os.path.exists(os.path.join(CHATS_DIR, f"{chat_id}.state")):
+            continue
+        try:
+            chat = _load_legacy_pkl(os.path.join(CHATS_DIR, filename), chat_id)
+            with _get_log_lock(chat_id):
+                _write_checkpoint(chat)
+            migrated.append(chat_id)
+        except Exception as e:
+            print(f"⚠️ Migration of {chat_id} failed: {e}")
+    return migrated
 
-    messages_json = serialization.serialize_history(chat.messages, chat_id=chat.id) if serialization else chat.messages
-    
-    # Определение имени и превью
-    preview = _get_preview(chat.messages)
-    current_name = getattr(chat, 'name', 'New Chat')
-    if current_name == 'New Chat' and preview != 'Empty chat':
-        current_name = preview[:30]
-    chat.name = current_name
+def _write_checkpoint(chat):
+    """Полный снимок: .json + .state, после чего журнал обнуляется."""
+    checkpoint = uuid.uuid4().hex
+    chat._log_checkpoint = checkpoint
+    # Изображения пишутся в хранилище блобов один раз; и .json, и .state получают ссылки
+    messages = serialization.detach_images(chat.messages, chat.id) if serialization else chat.messages
+    messages_json = serialization.serialize_history(messages, chat_id=chat.id) if serialization else messages
 
     base_data = {
         'id': chat.id,
@@ -221,7 +567,8 @@ def save_chat_state(chat):
         'active_modes': getattr(chat, 'active_modes', []),
         'model': getattr(chat, 'model', None),
         'model_rpm': getattr(chat, 'model_rpm', None),
-        'plugin_config': get_current_config()
+        'plugin_config': get_current_config(),
+        'log_checkpoint': checkpoint
     }
 
     # Сохранение JSON
@@ -231,14 +578,50 @@ def save_chat_state(chat):
         json.dump(base_data, f, ensure_ascii=False, indent=2, default=str)
     os.replace(tmp_json, json_path)
 
-    # Сохранение PKL
+    # Сохранение состояния: только дельты относительно шаблона
+    state_path = os.path.join(CHATS_DIR, f'{chat.id}.state')
+    tmp_state = state_path + ".tmp"
+    with open(tmp_state, 'wb') as f:
+        f.write(state_codec.encode(chat, messages))
+    os.replace(tmp_state, state_path)
+
+    # Старый .pkl после миграции больше не нужен
     pkl_path = os.path.join(CHATS_DIR, f'{chat.id}.pkl')
-    tmp_pkl = pkl_path + ".tmp"
-    with open(tmp_pkl, 'wb') as f:
-        dill.dump(chat, f)
-    os.replace(tmp_pkl, pkl_path)
+    if os.path.exists(pkl_path):
+        os.remove(pkl_path)
+
+    _reset_log(chat.id, checkpoint, len(chat.messages))
+    _init_log_state(chat, checkpoint)
+
+def save_chat_state(chat, checkpoint=False):
+    """Сохраняет чат. По умолчанию дописывает в журнал только новые/изменённые сообщения;
+    полный чекпоинт .json/.state пишется при checkpoint=True, для нового чата или при компакции."""
+    ensure_chats_dir()
+    if not getattr(chat, 'id', None): chat.id = str(uuid.uuid4())
+    chat.updated_at = datetime.datetime.now().isoformat()
     
-    # Обновление индекса
+    # Очистка системного промпта
+    if hasattr(chat, 'system_prompt') and chat.system_prompt:
+        pattern = re.escape(WEB_PROMPT_MARKER_START) + r".*?" + re.escape(WEB_PROMPT_MARKER_END)
+        chat.system_prompt = re.sub(pattern, "", chat.system_prompt, flags=re.DOTALL).strip()
+
+    # Определение имени и превью
+    preview = _get_preview(chat.messages)
+    current_name = getattr(chat, 'name', 'New Chat')
+    if current_name == 'New Chat' and preview != 'Empty chat':
+        current_name = preview[:30]
+    chat.name = current_name
+
+    with _get_log_lock(chat.id):
+        state = getattr(chat, '_log_state', None)
+        if checkpoint or not state or not os.path.exists(_log_path(chat.id)) or not _append_to_log(chat):
+            _write_checkpoint(chat)
+    
+    # Обновление заголовка и индекса
+    try:
+        _write_meta(chat.id, chat.name, chat.updated_at, preview)
+    except OSError as e:
+        print(f"Error saving chat header: {e}")
     _update_index_entry(chat.id, chat.name, chat.updated_at, preview)
     
     return chat
@@ -246,16 +629,22 @@ def save_chat_state(chat):
 def delete_chat(id):
     ensure_chats_dir()
     deleted = False
-    for ext in [".pkl", ".json"]:
+    for ext in [".state", ".pkl", ".json", ".jsonl", ".meta.json"]:
         p = os.path.join(CHATS_DIR, f"{id}{ext}")
         if os.path.exists(p):
             os.remove(p)
             deleted = True
+        # Остатки прерванной атомарной записи
+        if os.path.exists(p + ".tmp"):
+            os.remove(p + ".tmp")
     
     img_dir = os.path.join(CHATS_DIR, str(id))
     if os.path.exists(img_dir):
         shutil.rmtree(img_dir)
         deleted = True
+
+    if deleted:
+        blob_store.release_chat(str(id))
         
     if deleted:
         _remove_from_index(id)
@@ -265,14 +654,22 @@ def rename_chat(id, new_name, get_chat):
     chat, _ = load_chat_state(id, get_chat)
     if not chat: return False
     chat.name = new_name
-    save_chat_state(chat)
+    save_chat_state(chat, checkpoint=True)
     return True
 
 def clear_chat_context(id):
-    pkl_path = os.path.join(CHATS_DIR, f"{id}.pkl")
-    if os.path.exists(pkl_path):
-        os.remove(pkl_path)
-        _rebuild_index() # Проще всего пересобрать превью
+    removed = False
+    for ext in [".state", ".pkl"]:
+        path = os.path.join(CHATS_DIR, f"{id}{ext}")
+        if os.path.exists(path):
+            os.remove(path)
+            removed = True
+    if removed:
+        try:
+            entry = _read_chat_header(id)
+            _update_index_entry(id, entry["name"], entry["updated_at"], entry["preview"])
+        except Exception as e:
+            print(f"Error updating index for {id}: {e}")
         return True
     return False
 
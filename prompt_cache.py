@@ -0,0 +1,172 @@
+import json
+import time
+import hashlib
+import threading
+from google.genai import types as genai_types
+
+# Кеш статического префикса запроса через Gemini cached content.
+# Системный промпт (исходники agent.py, дерево файлов, промпты плагинов) и
+# объявления инструментов одинаковы на каждой итерации цикла инструментов —
+# вместо повторной отправки они один раз кладутся в cachedContents, а запрос
+# ссылается на него по имени. final_prompt (режимы, данные gather) меняется
+# часто и в кеш не попадает — он идёт в самом запросе. Записи различаются по
+# хешу содержимого, TTL продлевается заранее; запись, с которой ушли все чаты,
+# удаляется на стороне API. Вызовы API идут вне общей блокировки: один и тот же
+# префикс создаёт только один поток, остальные ждут его, а не весь процесс.
+# Если кеш недоступен (маленький промпт, модель без поддержки, ошибка API) —
+# запрос идёт как раньше, без кеша.
+
+CACHE_TTL = 3600            # секунды жизни записи на стороне API
+REFRESH_MARGIN = 300        # продлеваем TTL, если до истечения осталось меньше
+RETRY_AFTER_FAILURE = 600   # после ошибки создания не пытаемся снова столько секунд
+MIN_CACHE_CHARS = 8000      # меньше минимального размера cached content нет смысла пробовать
+
+def prefix_digest(model, system_instruction, tool_declarations):
+    payload = json.dumps([model, system_instruction, tool_declarations],
+                         sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class PromptCache:
+    def __init__(self, ttl=CACHE_TTL):
+        self.enabled = True
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}   # (ключ, модель, хеш) -> {"name", "expires", "owners"}
+        self._owners = {}    # (чат, ключ, модель) -> (ключ, модель, хеш) записи, которой чат пользуется
+        self._pending = {}   # (ключ, модель, хеш) -> Event: запись создаётся другим потоком
+        self._failed = {}    # (ключ, модель, хеш) -> time.monotonic() следующей попытки
+        self.stats = {"created": 0, "refreshed": 0, "reused": 0, "deleted": 0, "fallbacks": 0,
+                      "prompt_tokens": 0, "cached_tokens": 0}
+
+    def get(self, client, key_index, model, system_instruction, tool_declarations, digest=None, owner=None):
+        """Имя cached content для префикса или None — тогда запрос отправляется без кеша.
+        owner — чат: запись, с которой ушли все её чаты, удаляется на стороне API."""
+        if not self.enabled or client is None or len(system_instruction) < MIN_CACHE_CHARS:
+            return None
+        key = (key_index, model, digest or prefix_digest(model, system_instruction, tool_declarations))
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if self._failed.get(key, 0) > now:
+                    self.stats["fallbacks"] += 1
+                    return None
+                entry = self._entries.get(key)
+                pending = self._pending.get(key)
+                if entry and (entry["expires"] - now >= REFRESH_MARGIN or pending and entry["expires"] > now):
+                    # Запись свежая или её уже продлевает другой поток
+                    self.stats["reused"] += 1
+                    stale = self._attach(owner, key, entry)
+                    break
+                if pending is None:
+                    pending = self._pending[key] = threading.Event()
+                    stale = None
+                    break
+            # Ту же запись создаёт другой поток — ждём только его
+            pending.wait(60)
+        if stale is None:
+            entry, stale = self._renew(client, key, entry, system_instruction, tool_declarations, owner, pending)
+        self._delete(client, stale)
+        return entry["name"] if entry else None
+
+    def _renew(self, client, key, entry, system_instruction, tool_declarations, owner, pending):
+        """Продление или создание записи (сетевые вызовы — вне _lock)."""
+        now = time.monotonic()
+        name = None
+        refreshed = False
+        try:
+            if entry and entry["expires"] > now:
+                try:
+                    client.caches.update(name=entry["name"],
+                                         config=genai_types.UpdateCachedContentConfig(ttl=f"{int(self.ttl)}s"))
+                    name, refreshed = entry["name"], True
+                except Exception:
+                    pass    # запись пропала на стороне API — создаём заново
+            if name is None:
+                name = self._create(client, key[1], system_instruction, tool_declarations)
+        finally:
+            with self._lock:
+                del self._pending[key]
+                pending.set()
+                stale = []
+                if name is None:
+                    self._failed[key] = now + RETRY_AFTER_FAILURE
+                    self.stats["fallbacks"] += 1
+                    self._entries.pop(key, None)
+                    entry = None
+                else:
+                    owners = entry["owners"] if refreshed else set()
+                    entry = self._entries[key] = {"name": name, "expires": now + self.ttl, "owners": owners}
+                    self.stats["refreshed" if refreshed else "created"] += 1
+                    for k in [k for k, v in self._entries.items() if v["expires"] <= now]:
+                        del self._entries[k]
+                    stale = self._attach(owner, key, entry)
+        return entry, stale
+
+    def _create(self, client, model, system_instruction, tool_declarations):
+        try:
+            cached = client.caches.create(model=model, config=genai_types.CreateCachedContentConfig(
+                system_instruction=system_instruction,
+                tools=[genai_types.Tool(function_declarations=[d]) for d in tool_declarations],
+                ttl=f"{int(self.ttl)}s",
+            ))
+            name = getattr(cached, "name", None)
+            if not isinstance(name, str) or not name:
+                raise ValueError("cached content without name")
+            return name
+        except Exception as e:
+            print(f"⚠️ Кеш промпта недоступен, запросы идут без него: {str(e)[:100]}")
+            return None
+
+    def _attach(self, owner, key, entry):
+        """Вызывается под _lock. Привязывает чат к записи; возвращает имена записей,
+        которыми больше никто не пользуется (их удаляет вызывающий, вне блокировки)."""
+        if owner is None:
+            return []
+        slot = (owner, key[0], key[1])
+        previous = self._owners.get(slot)
+        self._owners[slot] = key
+        entry["owners"].add(owner)
+        if previous is None or previous == key:
+            return []
+        old = self._entries.get(previous)
+        if old is None:
+            return []
+        old["owners"].discard(owner)
+        if old["owners"] or previous in self._pending:
+            return []
+        del self._entries[previous]
+        return [old["name"]]
+
+    def _delete(self, client, names):
+        for name in names:
+            try:
+                client.caches.delete(name=name)
+                with self._lock:
+                    self.stats["deleted"] += 1
+            except Exception:
+                pass    # истечёт по TTL
+
+    def invalidate(self, name):
+        """Забывает запись (например, API ответил, что cached content не найден)."""
+        with self._lock:
+            for k in [k for k, v in self._entries.items() if v["name"] == name]:
+                del self._entries[k]
+
+    def record_usage(self, prompt_tokens, cached_tokens):
+        with self._lock:
+            self.stats["prompt_tokens"] += prompt_tokens or 0
+            self.stats["cached_tokens"] += cached_tokens or 0
+
+    def hit_rate(self):
+        """Доля входных токенов, взятых из кеша."""
+        with self._lock:
+            prompt = self.stats["prompt_tokens"]
+            return self.stats["cached_tokens"] / prompt if prompt else 0.0
+
+    def metrics(self):
+        """Счётчики для /api/queue."""
+        hit_rate = self.hit_rate()
+        with self._lock:
+            return {**self.stats, "entries": len(self._entries), "hit_rate": round(hit_rate, 4)}
+
+prompt_cache = PromptCache()
@@ -0,0 +1,249 @@
+import os
+import sys
+import ast
+import json
+import time
+import struct
+import atexit
+import threading
+import traceback
+import subprocess
+
+# Выполнение кода python_tool в отдельных процессах (chat.python_backend = "worker").
+# У каждого чата свой «тёплый» интерпретатор: переменные живут между вызовами,
+# тяжёлый или зависший код не держит GIL сервера и не роняет его, а чаты
+# выполняются на разных ядрах. Обмен — по stdin/stdout воркера кадрами
+# «4 байта длины + JSON» (не pickle: воркер выполняет недоверенный код).
+# В воркере действует тот же ACL, что и в процессе агента: воркер импортирует
+# agent (его audit hook) и выставляет security_context на время вызова.
+# Лимиты: память (RLIMIT_AS) на весь процесс, CPU (RLIMIT_CPU) на каждый вызов,
+# плюс общий таймаут на стороне агента; при превышении воркер перезапускается.
+# Код, обращающийся к self (объекту чата), выполняется в процессе агента, как раньше;
+# пространства имён у процесса агента и воркера разные (это сказано в описании python).
+# Воркеров не больше max_workers: занятые не вытесняются, а новый вызов ждёт свободного
+# места до таймаута и затем получает отказ.
+
+PYTHON_TIMEOUT = 300       # секунды на вызов (стена)
+CPU_LIMIT = 120            # секунды процессорного времени на вызов
+MEMORY_LIMIT_MB = 2048     # адресное пространство воркера; 0 — без лимита
+MAX_WORKERS = os.cpu_count() or 4
+
+_HEADER = struct.Struct(">I")
+
+def uses_name(code, name):
+    """Есть ли в коде обращение к имени name (например, self)."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return False
+    return any(isinstance(node, ast.Name) and node.id == name for node in ast.walk(tree))
+
+def _write_frame(stream, payload):
+    data = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+    stream.write(_HEADER.pack(len(data)) + data)
+    stream.flush()
+
+def _read_exact(stream, size):
+    chunks = []
+    while size:
+        chunk = stream.read(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+def _read_frame(stream):
+    header = _read_exact(stream, _HEADER.size)
+    if header is None:
+        return None
+    data = _read_exact(stream, _HEADER.unpack(header)[0])
+    return None if data is None else json.loads(data.decode("utf-8"))
+
+class Worker:
+    def __init__(self, memory_limit_mb=MEMORY_LIMIT_MB, cpu_limit=CPU_LIMIT):
+        self.lock = threading.Lock()
+        self.busy = 0       # вызовы, получившие воркер из пула (меняется под блокировкой пула)
+        self.last_used = time.monotonic()
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "worker", str(memory_limit_mb), str(cpu_limit)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=None,
+        )
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def call(self, request, timeout):
+        """Ответ воркера или None, если он не ответил за timeout / завершился."""
+        timer = threading.Timer(timeout, self.kill)
+        timer.daemon = True
+        timer.start()
+        try:
+            _write_frame(self.proc.stdin, request)
+            return _read_frame(self.proc.stdout)
+        except (OSError, ValueError):
+            return None
+        finally:
+            timer.cancel()
+
+    def kill(self):
+        try:
+            self.proc.kill()
+        except OSError:
+            pass
+
+class WorkerPool:
+    def __init__(self, max_workers=MAX_WORKERS, timeout=PYTHON_TIMEOUT):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.memory_limit_mb = MEMORY_LIMIT_MB
+        self.cpu_limit = CPU_LIMIT
+        self._lock = threading.Lock()
+        self._freed = threading.Condition(self._lock)
+        self._workers = {}   # ключ чата -> Worker
+        self._lost = set()   # чаты, чей воркер остановлен ради места (состояние потеряно)
+        self.stats = {"started": 0, "calls": 0, "crashes": 0, "evicted": 0, "refused": 0}
+
+    def configure(self, max_workers=None, timeout=None, memory_limit_mb=None, cpu_limit=None):
+        if max_workers is not None: self.max_workers = max_workers
+        if timeout is not None: self.timeout = timeout
+        if memory_limit_mb is not None: self.memory_limit_mb = memory_limit_mb
+        if cpu_limit is not None: self.cpu_limit = cpu_limit
+
+    def _get(self, key):
+        """Резервирует воркер чата (busy += 1): (worker, restarted) или (None, False), если места нет."""
+        deadline = time.monotonic() + self.timeout
+        restarted = False
+        with self._lock:
+            while True:
+                worker = self._workers.get(key)
+                if worker is not None and worker.alive():
+                    worker.busy += 1
+                    return worker, False
+                if worker is not None:
+                    del self._workers[key]      # упавший воркер освобождает своё место
+                    restarted = True
+                if len(self._workers) < self.max_workers or self._evict_idle():
+                    break
+                # Все воркеры заняты — ждём, пока какой-нибудь освободится
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats["refused"] += 1
+                    return None, False
+                self._freed.wait(remaining)
+            restarted = restarted or key in self._lost
+            self._lost.discard(key)
+            worker = self._workers[key] = Worker(self.memory_limit_mb, self.cpu_limit)
+            worker.busy = 1
+            self.stats["started"] += 1
+            return worker, restarted
+
+    def _evict_idle(self):
+        """Останавливает давно не использованный свободный воркер (под блокировкой пула)."""
+        idle = [(w.last_used, k) for k, w in self._workers.items() if not w.busy]
+        if not idle:
+            return False
+        evicted = min(idle)[1]
+        self._workers.pop(evicted).kill()
+        self._lost.add(evicted)
+        self.stats["evicted"] += 1
+        return True
+
+    def execute(self, key, code, acl=None):
+        """Выполняет код в воркере чата; результат — как у python_tool (значение result или текст ошибки)."""
+        worker, restarted = self._get(key)
+        if worker is None:
+            return (f"Ошибка выполнения: все процессы Python ({self.max_workers}) заняты другими чатами "
+                    f"дольше {self.timeout} с. Повтори вызов позже.")
+        try:
+            with worker.lock:
+                worker.last_used = time.monotonic()
+                response = worker.call({"op": "exec", "code": code, "acl": acl}, self.timeout)
+                worker.last_used = time.monotonic()
+        finally:
+            with self._lock:
+                worker.busy -= 1
+                self.stats["calls"] += 1
+                self._freed.notify_all()
+        note = "[Процесс Python был перезапущен, переменные прошлых вызовов потеряны]\n" if restarted else ""
+        if response is None:
+            worker.kill()
+            with self._lock:
+                self.stats["crashes"] += 1
+                if self._workers.get(key) is worker:
+                    del self._workers[key]
+                self._freed.notify_all()
+            return (f"{note}Ошибка выполнения: процесс Python завершён — превышен таймаут ({self.timeout} с), "
+                    f"лимит CPU ({self.cpu_limit} с) или памяти ({self.memory_limit_mb} МБ). Переменные сброшены.")
+        if response.get("error"):
+            return f"{note}Ошибка выполнения:\n\n{response['error']}"
+        return note + response.get("result", "")
+
+    def release(self, key):
+        with self._lock:
+            worker = self._workers.pop(key, None)
+            self._lost.discard(key)
+            self._freed.notify_all()
+        if worker is not None:
+            worker.kill()
+
+    def shutdown(self):
+        with self._lock:
+            workers, self._workers = list(self._workers.values()), {}
+            self._freed.notify_all()
+        for worker in workers:
+            worker.kill()
+
+pool = WorkerPool()
+atexit.register(pool.shutdown)
+
+# === WORKER PROCESS ===
+
+def _set_limits(memory_limit_mb):
+    try:
+        import resource
+    except ImportError:
+        return None     # Windows: лимиты только через таймаут агента
+    if memory_limit_mb:
+        limit = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    return resource
+
+def _worker_main(memory_limit_mb, cpu_limit):
+    # Протокол идёт по копиям дескрипторов; print и input кода не задевают его
+    proto_in = os.fdopen(os.dup(0), "rb")
+    proto_out = os.fdopen(os.dup(1), "wb")
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.dup2(2, 1)
+
+    import agent    # audit hook и security_context — те же, что в процессе агента
+    resource = _set_limits(memory_limit_mb)
+    env = {"__name__": "__agent_worker__"}
+
+    while True:
+        request = _read_frame(proto_in)
+        if request is None:
+            return
+        if resource is not None and cpu_limit:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            soft = int(usage.ru_utime + usage.ru_stime) + cpu_limit
+            resource.setrlimit(resource.RLIMIT_CPU, (soft, resource.getrlimit(resource.RLIMIT_CPU)[1]))
+        token = agent.security_context.set(request.get("acl"))
+        error = None
+        try:
+            env["result"] = ''
+            exec(request["code"], env, env)
+            response = {"result": str(env.get("result", ''))}
+        except BaseException as e:
+            error = e
+        finally:
+            agent.security_context.reset(token)
+            sys.stdout.flush()
+        if error is not None:
+            # Трейсбек читает исходники — уже без ACL вызова
+            response = {"error": "".join(traceback.format_exception(type(error), error, error.__traceback__))}
+        _write_frame(proto_out, response)
+
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] == "worker":
+    _worker_main(int(sys.argv[2]), int(sys.argv[3]))
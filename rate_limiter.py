@@ -0,0 +1,178 @@
+import time
+import threading
+from collections import deque
+
+# Общий для процесса ограничитель запросов к Gemini.
+# Ключ — (модель, индекс API-ключа): все Chat (веб-сессии, под-чаты chat_tool)
+# делят одни и те же ведра токенов, а не считают паузы каждый сам по себе.
+# Ведро RPM — запросы в минуту, ведро TPM — токены в минуту по usage_metadata.
+# Разрешения выдаются строго по очереди прихода (FIFO), чтобы ни один чат не голодал.
+
+class TokenBucket:
+    def __init__(self, per_minute, tokens=None):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity if tokens is None else min(self.capacity, tokens)
+        self.updated = time.monotonic()
+
+    def resized(self, per_minute):
+        """Ведро с новым лимитом и текущим уровнем (без внепланового всплеска)."""
+        self.refill(time.monotonic())
+        return TokenBucket(per_minute, self.tokens)
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Сколько секунд ждать, пока в ведре наберётся amount (после refill)."""
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+class Permit:
+    __slots__ = ("key", "chat", "estimate", "acquired_at", "waited", "released")
+
+    def __init__(self, key, chat, estimate, waited):
+        self.key = key
+        self.chat = chat
+        self.estimate = estimate
+        self.acquired_at = time.monotonic()
+        self.waited = waited
+        self.released = False
+
+class _Limit:
+    def __init__(self, rpm, tpm):
+        self.rpm = TokenBucket(rpm)
+        self.tpm = TokenBucket(tpm) if tpm else None
+        self.queue = deque()      # билеты ожидающих, по порядку прихода
+        self.in_flight = 0
+        self.stats = {"acquired": 0, "released": 0, "wait_total": 0.0, "wait_max": 0.0, "tokens": 0}
+        self.token_log = deque()  # (время, токены) за последнюю минуту
+
+class RateLimiter:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._limits = {}
+        self.tpm_limits = {}      # модель -> лимит токенов в минуту (нет записи — TPM не ограничен)
+
+    def configure(self, tpm_limits=None):
+        """tpm_limits: {"gemini-...": токенов в минуту}; применяется и к уже созданным ведрам."""
+        with self._cond:
+            if tpm_limits is not None:
+                self.tpm_limits = {model: int(tpm) for model, tpm in tpm_limits.items() if tpm}
+                for (model, _), limit in self._limits.items():
+                    self._set_tpm(limit, self.tpm_limits.get(model))
+            self._cond.notify_all()
+
+    @staticmethod
+    def _set_tpm(limit, tpm):
+        if not tpm:
+            limit.tpm = None
+        elif limit.tpm is None:
+            limit.tpm = TokenBucket(tpm)
+        elif limit.tpm.capacity != tpm:
+            limit.tpm = limit.tpm.resized(tpm)
+
+    def _limit(self, key, rpm):
+        limit = self._limits.get(key)
+        if limit is None:
+            limit = self._limits[key] = _Limit(rpm, self.tpm_limits.get(key[0]))
+        elif limit.rpm.capacity != rpm:
+            limit.rpm = limit.rpm.resized(rpm)
+        return limit
+
+    def acquire(self, model, key_index, rpm, estimated_tokens=0, chat=None, on_wait=None):
+        """Блокирует до выдачи разрешения на один запрос. on_wait(сек) вызывается перед долгим ожиданием."""
+        key = (model, key_index)
+        ticket = object()
+        start = time.monotonic()
+        notified = False
+        with self._cond:
+            limit = self._limit(key, rpm)
+            limit.queue.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    limit.rpm.refill(now)
+                    delay = limit.rpm.wait_time(1)
+                    if limit.tpm is not None:
+                        limit.tpm.refill(now)
+                        delay = max(delay, limit.tpm.wait_time(min(estimated_tokens, limit.tpm.capacity)))
+                    if limit.queue[0] is ticket and delay <= 0:
+                        break
+                    if on_wait and not notified and delay > 1:
+                        # Уведомление (print → web_emit) — без общей блокировки, затем пересчёт
+                        notified = True
+                        self._cond.release()
+                        try:
+                            on_wait(delay)
+                        finally:
+                            self._cond.acquire()
+                        continue
+                    self._cond.wait(delay if limit.queue[0] is ticket else None)
+                limit.rpm.tokens -= 1
+                if limit.tpm is not None:
+                    limit.tpm.tokens -= estimated_tokens
+            finally:
+                limit.queue.remove(ticket)
+                self._cond.notify_all()
+            waited = time.monotonic() - start
+            limit.in_flight += 1
+            limit.stats["acquired"] += 1
+            limit.stats["wait_total"] += waited
+            limit.stats["wait_max"] = max(limit.stats["wait_max"], waited)
+            return Permit(key, chat, estimated_tokens, waited)
+
+    def release(self, permit, used_tokens=0):
+        """Завершает запрос: TPM корректируется по фактическому расходу из usage_metadata."""
+        if permit is None or permit.released:
+            return
+        with self._cond:
+            permit.released = True
+            limit = self._limits[permit.key]
+            limit.in_flight -= 1
+            limit.stats["released"] += 1
+            limit.stats["tokens"] += used_tokens
+            now = time.monotonic()
+            if used_tokens:
+                limit.token_log.append((now, used_tokens))
+            if limit.tpm is not None:
+                limit.tpm.tokens -= used_tokens - permit.estimate
+            self._cond.notify_all()
+
+    def in_flight(self, model, key_index):
+        with self._cond:
+            limit = self._limits.get((model, key_index))
+            return limit.in_flight if limit else 0
+
+    def available(self, model, key_index):
+        """Свободные разрешения RPM в ведре (None — по ключу ещё не было запросов)."""
+        with self._cond:
+            limit = self._limits.get((model, key_index))
+            if limit is None:
+                return None
+            limit.rpm.refill(time.monotonic())
+            return limit.rpm.tokens
+
+    def stats(self):
+        with self._cond:
+            now = time.monotonic()
+            result = {}
+            for (model, key_index), limit in self._limits.items():
+                while limit.token_log and now - limit.token_log[0][0] > 60:
+                    limit.token_log.popleft()
+                limit.rpm.refill(now)
+                acquired = limit.stats["acquired"]
+                result[f"{model}#{key_index}"] = {
+                    **limit.stats,
+                    "wait_avg": limit.stats["wait_total"] / acquired if acquired else 0.0,
+                    "in_flight": limit.in_flight,
+                    "waiting": len(limit.queue),
+                    "rpm_available": round(limit.rpm.tokens, 2),
+                    "tpm_limit": int(limit.tpm.capacity) if limit.tpm is not None else None,
+                    "tokens_last_minute": sum(t for _, t in limit.token_log),
+                }
+            return result
+
+rate_limiter = RateLimiter()
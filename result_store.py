@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from access_control import trusted_io
+
+# Хранилище больших результатов инструментов (страницы http, вывод shell, HTML браузера).
+# Результат длиннее OFFLOAD_CHARS пишется в chats/tool_results/<handle>.txt, а в
+# историю (и в каждый следующий запрос) попадает только начало, конец и handle.
+# Нужные фрагменты модель дочитывает инструментом tool_result по строкам или байтам.
+# Имя файла — хеш содержимого, одинаковые результаты хранятся один раз.
+# Хранилище общее для всех чатов, поэтому его ввод-вывод идёт вне ACL чата (trusted_io).
+
+RESULTS_DIR = os.path.join("chats", "tool_results")
+OFFLOAD_CHARS = 20000     # результаты длиннее уходят в хранилище
+HEAD_CHARS = 4000
+TAIL_CHARS = 2000
+MAX_READ_CHARS = 20000    # больше за один вызов tool_result не отдаём
+RESULT_TTL = 30 * 86400   # файлы старше удаляются (проверка раз за процесс)
+HANDLE_LEN = 16
+
+_lock = threading.Lock()
+_pruned_dir = None
+stats = {"offloaded": 0, "offloaded_chars": 0, "reads": 0}
+
+def path_for(handle):
+    """Путь к сохранённому результату или None для чужих/битых handle."""
+    handle = str(handle).strip()
+    if len(handle) != HANDLE_LEN or any(c not in "0123456789abcdef" for c in handle):
+        return None
+    return os.path.join(RESULTS_DIR, f"{handle}.txt")
+
+def prune(max_age=RESULT_TTL):
+    """Удаляет результаты, которые не читались и не сохранялись дольше max_age секунд."""
+    cutoff = time.time() - max_age
+    removed = 0
+    try:
+        names = os.listdir(RESULTS_DIR)
+    except OSError:
+        return 0
+    for name in names:
+        path = os.path.join(RESULTS_DIR, name)
+        try:
+            if os.stat(path).st_mtime < cutoff:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            pass
+    return removed
+
+def put(text):
+    """Сохраняет текст (если такого ещё нет), возвращает handle."""
+    data = text.encode("utf-8")
+    handle = hashlib.sha256(data).hexdigest()[:HANDLE_LEN]
+    with trusted_io():
+        _write(path_for(handle), data)
+    return handle
+
+def _write(path, data):
+    global _pruned_dir
+    with _lock:
+        if _pruned_dir != RESULTS_DIR:
+            _pruned_dir = RESULTS_DIR
+            prune()
+    if os.path.exists(path):
+        os.utime(path)
+        return
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def preview(name, text, handle):
+    """Что видит модель вместо полного результата: handle, начало и конец."""
+    lines = text.count("\n") + 1
+    size = len(text.encode("utf-8"))
+    note = (f"[Результат {name} сокращён: {len(text)} символов, {lines} строк, {size} байт. "
+            f"Полностью сохранён, handle=\"{handle}\"; нужные части читай инструментом "
+            f"tool_result(handle, start, end, unit=\"lines\" или \"bytes\").]")
+    skipped = len(text) - HEAD_CHARS - TAIL_CHARS
+    return f"{note}\n{text[:HEAD_CHARS]}\n[... пропущено {skipped} символов ...]\n{text[-TAIL_CHARS:]}"
+
+def offload(name, result, limit=OFFLOAD_CHARS):
+    """Результат инструмента для истории: длинные строки (и строковые поля словаря) заменяются превью."""
+    if not limit:
+        return result
+    if isinstance(result, str):
+        if len(result) <= limit:
+            return result
+        if result.lstrip().startswith("{"):
+            # JSON-объект (shell: status/stdout/stderr) — выносим поля, чтобы stdout читался по строкам
+            try:
+                parsed = json.loads(result)
+            except ValueError:
+                parsed = None
+            if isinstance(parsed, dict):
+                return offload(name, parsed, limit)
+        try:
+            handle = put(result)
+        except Exception as e:
+            # ошибка хранилища не должна обрывать ход: в историю уходит полный результат
+            print(f"⚠️ Не удалось сохранить результат {name}: {e}")
+            return result
+        with _lock:
+            stats["offloaded"] += 1
+            stats["offloaded_chars"] += len(result)
+        return preview(name, result, handle)
+    if isinstance(result, dict):
+        return {k: offload(name, v, limit) if k != "images" else v for k, v in result.items()}
+    return result
+
+def read_range(handle, start=0, end=None, unit="lines"):
+    """Фрагмент сохранённого результата: строки [start, end) или байты [start, end), с нуля."""
+    path = path_for(handle)
+    if path is None or not os.path.exists(path):
+        return f"Ошибка: результат с handle \"{handle}\" не найден."
+    if unit not in ("lines", "bytes"):
+        return f"Ошибка: unit должен быть \"lines\" или \"bytes\", получено \"{unit}\"."
+    start = max(0, int(start or 0))
+    with trusted_io():
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)
+    with _lock:
+        stats["reads"] += 1
+    if unit == "bytes":
+        end = len(data) if end is None else min(len(data), int(end))
+        total = len(data)
+        text = data[start:end].decode("utf-8", errors="replace")
+    else:
+        lines = data.decode("utf-8", errors="replace").split("\n")
+        end = len(lines) if end is None else min(len(lines), int(end))
+        total = len(lines)
+        text = "\n".join(lines[start:end])
+    header = f"[{unit} {start}-{end} из {total}]"
+    if len(text) > MAX_READ_CHARS:
+        text = text[:MAX_READ_CHARS]
+        header += f" [показаны первые {MAX_READ_CHARS} символов диапазона, запроси диапазон меньше]"
+    return f"{header}\n{text}"
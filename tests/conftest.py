@@ -30,6 +30,7 @@ def mock_agent(mock_client, tmp_path_factory, monkeypatch_module):
     tmp_path = tmp_path_factory.mktemp("data"); test_chats_dir = tmp_path / "chats"
     test_chats_dir.mkdir()
     monkeypatch_module.setattr(storage, "CHATS_DIR", str(test_chats_dir))
+    monkeypatch_module.setattr(storage.blob_store, "BLOBS_DIR", str(test_chats_dir / "blobs"))
     
     # 2. Mock Config loading (don't read real keys/files)
     def dummy_load(self):
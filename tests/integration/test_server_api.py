@@ -109,8 +109,7 @@ class MockAgent(Chat):
             self.generation_event.set()
 
     def web_emit(self, msg_type, payload):
-        if self.web_queue:
-            self.web_queue.put({ "type": msg_type, "chatId": self.id, "data": payload })
+        server.event_hub.hub.publish({ "type": msg_type, "chatId": self.id, "data": payload })
 
 @pytest.fixture
 def test_server():
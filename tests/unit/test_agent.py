@@ -23,16 +23,16 @@ def test_tool_exec_python(mock_agent):
     res = mock_agent.tool_exec("python", {"code": "result = 'hello world'"})
     assert res == "hello world"
 
-def test_tool_exec_dynamic_call(mock_agent, mocker):
-    mock_agent.test_tool_tool = MagicMock(return_value="tool_result")
-    mocker.patch.object(mock_agent, "_get_tools_dicts", return_value=(
-        {"test_tool": ["arg1"]}, # required
-        {"test_tool": ["arg2"]}  # additional
-    ))
+def test_tool_exec_dynamic_call(mock_agent):
+    handler = MagicMock(return_value="tool_result")
+    mock_agent.register_tool({"function": {"name": "test_tool", "description": "", "parameters": {
+        "type": "object",
+        "properties": {"arg1": {"type": "string"}, "arg2": {"type": "string"}},
+        "required": ["arg1"]}}}, handler)
     res = mock_agent.tool_exec("test_tool", {"arg1": "val1", "arg2": "val2"})
     assert res == "tool_result"
-    # Note: exec() interprets "'val1'" as the string 'val1'
-    mock_agent.test_tool_tool.assert_called_once_with("val1", arg2="val2")
+    # Required arguments go positionally, optional ones by name
+    handler.assert_called_once_with(mock_agent, "val1", arg2="val2")
 
 def test_shell_tool(mock_agent, mocker):
     mock_run = mocker.patch("subprocess.run")
@@ -62,3 +62,103 @@ def test_http_tool(mock_agent, mocker):
     mock_get.return_value = mock_response
     res = mock_agent.http_tool("u")
     assert "T" in res and "C" in res and "M" not in res
+
+def test_generate_config_is_rebuilt_only_on_version_change(mock_agent):
+    config = mock_agent.get_generate_config()
+    assert mock_agent.get_generate_config() is config
+    assert mock_agent._get_tools_dicts() is mock_agent._get_tools_dicts()
+
+    mock_agent.blocked_tools = ["python"]
+    blocked = mock_agent.get_generate_config()
+    assert blocked is not config
+    names = [t.function_declarations[0].name for t in blocked.tools]
+    assert "python" not in names and len(names) == len(config.tools) - 1
+
+    mock_agent.final_prompt = "\nextra"
+    assert mock_agent.get_generate_config().system_instruction.endswith("extra")
+
+    # Swapping one blocked tool for another keeps the length but is a new version
+    mock_agent.blocked_tools = ["shell"]
+    names = [t.function_declarations[0].name for t in mock_agent.get_generate_config().tools]
+    assert "python" in names and "shell" not in names
+
+    # Assigning an equal value does not rebuild anything
+    config = mock_agent.get_generate_config()
+    mock_agent.blocked_tools = ["shell"]
+    assert mock_agent.get_generate_config() is config
+
+    # In-place edits are announced with touch_config()
+    mock_agent.tools[0]["function"]["description"] = "changed"
+    mock_agent.touch_config()
+    declarations = [t.function_declarations[0] for t in mock_agent.get_generate_config().tools]
+    assert declarations[0].description == "changed"
+
+def test_parallel_safe_tools_run_concurrently_in_order(mock_agent, mocker):
+    import time, threading
+    from types import SimpleNamespace
+
+    def declare(name, **meta):
+        mock_agent.tools.append({"function": {"name": name, "description": "", "parameters": {
+            "type": "object", "properties": {"q": {"type": "string"}}, "required": ["q"]}}, **meta})
+        mock_agent.touch_config()
+
+    declare("fetch", parallel_safe=True, timeout=5)
+    declare("hang", parallel_safe=True, timeout=0.2)
+    declare("local")
+    main_thread = threading.current_thread()
+    mock_agent.fetch_tool = lambda q: (time.sleep(0.3), f"fetched {q}")[1]
+    mock_agent.hang_tool = lambda q: (time.sleep(1), "late")[1]
+    mock_agent.local_tool = lambda q: f"local {threading.current_thread() is main_thread}"
+    mocker.patch.object(mock_agent, "_process_request", return_value="done")
+
+    calls = [SimpleNamespace(name=n, args={"q": q}) for n, q in
+             [("fetch", "a"), ("local", "b"), ("fetch", "c"), ("hang", "d"), ("fetch", "e")]]
+    start = time.monotonic()
+    assert mock_agent._execute_tool_calls(calls) == "done"
+    assert time.monotonic() - start < 0.8
+
+    responses = [p.function_response for p in mock_agent.messages[-1].parts]
+    assert [r.name for r in responses] == ["fetch", "local", "fetch", "hang", "fetch"]
+    assert [r.response["result"] for r in responses[:3]] == ["fetched a", "local True", "fetched c"]
+    assert "не ответил за 0.2 секунд" in responses[3].response["result"]
+    assert responses[4].response["result"] == "fetched e"
+
+def test_speculative_tools_start_during_stream(mock_agent, mocker):
+    import time
+    from google.genai import types
+
+    started = []
+    def fetch_tool(chat, q):
+        started.append((q, time.monotonic()))
+        time.sleep(0.3)
+        return f"page {q}"
+    schema = {"speculative": True, "function": {"name": "fetch", "description": "", "parameters": {
+        "type": "object", "properties": {"q": {"type": "string"}}, "required": ["q"]}}}
+    mock_agent.register_tool(schema, fetch_tool)
+    mock_agent.local_tool = lambda q: "local"
+    mock_agent.tools.append({"function": {"name": "local", "description": "", "parameters": {
+        "type": "object", "properties": {"q": {"type": "string"}}, "required": ["q"]}}})
+    mock_agent.touch_config()
+    mocker.patch.object(mock_agent, "_process_request", return_value="")
+    mock_agent.speculative_tools = True
+
+    def chunk(part):
+        return types.GenerateContentResponse(candidates=[types.Candidate(content=types.Content(role="model", parts=[part]))])
+    def stream(names):
+        for name in names:
+            yield chunk(types.Part(function_call=types.FunctionCall(name=name, args={"q": name})))
+        time.sleep(0.3)  # trailing thoughts / usage metadata
+        yield chunk(types.Part(text="ok"))
+
+    start = time.monotonic()
+    mock_agent._handle_stream(stream(["fetch"]))
+    assert started[0][1] - start < 0.1
+    assert time.monotonic() - start < 0.5
+    assert mock_agent.messages[-1].parts[0].function_response.response == {"result": "page fetch"}
+
+    # A read never overtakes an earlier call that may change state
+    started.clear()
+    start = time.monotonic()
+    mock_agent._handle_stream(stream(["local", "fetch"]))
+    assert started[0][1] - start >= 0.3
+    assert [p.function_response.name for p in mock_agent.messages[-1].parts] == ["local", "fetch"]
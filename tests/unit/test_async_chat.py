@@ -0,0 +1,65 @@
+import time
+import asyncio
+import threading
+from types import SimpleNamespace
+import agent
+from google.genai import types
+
+def _chunk(part, prompt=100, output=10):
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(role="model", parts=[part]))],
+        usage_metadata=types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=prompt, candidates_token_count=output, cached_content_token_count=40))
+
+class AsyncStubModels:
+    """client.aio.models stand-in: a tool call first, then a text answer."""
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = 0
+        self.threads = set()
+
+    async def generate_content_stream(self, model, contents, config):
+        self.calls += 1
+        has_tool_response = any(getattr(p, "function_response", None) for c in contents for p in c.parts)
+        self.threads.add(threading.current_thread())
+
+        async def gen():
+            await asyncio.sleep(self.delay)
+            if has_tool_response:
+                yield _chunk(types.Part(text="done"), prompt=150, output=5)
+            else:
+                yield _chunk(types.Part(function_call=types.FunctionCall(name="python_str", args={"text": "x"})))
+        return gen()
+
+def _async_client(models):
+    return SimpleNamespace(aio=SimpleNamespace(models=models))
+
+def test_send_async_runs_tool_loop_with_metrics(mock_agent):
+    models = AsyncStubModels()
+    mock_agent.client = _async_client(models)
+
+    assert asyncio.run(mock_agent.send_async("hi")) == "done"
+    roles = [m.role for m in mock_agent.messages]
+    assert roles == ["user", "model", "user", "model"]
+    assert mock_agent.messages[2].parts[0].function_response.response == {"result": repr("x")}
+    assert mock_agent.messages[0]._metrics["total_context"] == 100
+    assert mock_agent.messages[0]._metrics["cached_tokens"] == 40
+    assert mock_agent.messages[3]._metrics["output_tokens"] == 5
+    assert mock_agent._current_permit is None
+
+def test_many_conversations_share_one_event_loop(mock_agent):
+    models = AsyncStubModels(delay=0.2)
+    chats = []
+    for _ in range(8):
+        chat = agent.Chat()
+        chat.client = _async_client(models)
+        chats.append(chat)
+
+    async def run_all():
+        return await asyncio.gather(*(c.send_async(f"hi {i}") for i, c in enumerate(chats)))
+
+    start = time.monotonic()
+    assert asyncio.run(run_all()) == ["done"] * 8
+    # 16 requests of 0.2 s each overlap instead of running one after another
+    assert time.monotonic() - start < 1.5
+    assert models.calls == 16 and len(models.threads) == 1
@@ -0,0 +1,68 @@
+import json
+import asyncio
+import threading
+import http.client
+import pytest
+import plugins.web_interface.server as server
+import async_server
+
+@pytest.fixture
+def async_web(mock_agent):
+    server.WebRequestHandler.root_chat = mock_agent
+    server.WebRequestHandler.active_chats = {}
+    web = async_server.AsyncWebServer(server.WebRequestHandler, "127.0.0.1", 0, keepalive=0.2)
+    loop = asyncio.new_event_loop()
+    srv = loop.run_until_complete(web.start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield srv.sockets[0].getsockname()[1]
+    # Let pool handlers finish their writes while the loop is still running
+    web.request_pool.shutdown(wait=True)
+    loop.call_soon_threadsafe(srv.close)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+
+def test_regular_routes_are_served_by_the_same_handler(async_web):
+    conn = http.client.HTTPConnection("127.0.0.1", async_web, timeout=5)
+    conn.request("GET", "/api/models")
+    resp = conn.getresponse()
+    assert resp.status == 200
+    assert json.loads(resp.read()) == [list(m) for m in server.WebRequestHandler.root_chat.models]
+
+    conn = http.client.HTTPConnection("127.0.0.1", async_web, timeout=5)
+    conn.request("POST", "/api/nowhere", body=b"{}", headers={"Content-Type": "application/json"})
+    assert conn.getresponse().status == 404
+
+def test_sse_streams_share_one_loop(async_web):
+    streams = []
+    for _ in range(2):
+        conn = http.client.HTTPConnection("127.0.0.1", async_web, timeout=5)
+        conn.request("GET", "/stream?chat_id=async")
+        resp = conn.getresponse()
+        assert resp.status == 200
+        assert resp.readline() == b": keep-alive\n"
+        resp.readline()
+        streams.append(resp)
+
+    server.event_hub.hub.publish({"type": "text", "chatId": "async", "data": "hi"})
+    for resp in streams:
+        assert resp.readline().startswith(b"id: ")
+        assert json.loads(resp.readline()[len(b"data: "):])["data"] == "hi"
+
+def test_sse_uses_the_shared_cors_policy(async_web):
+    conn = http.client.HTTPConnection("127.0.0.1", async_web, timeout=5)
+    conn.request("GET", "/stream?chat_id=cors")
+    resp = conn.getresponse()
+    for name, value in server.WebRequestHandler.CORS_HEADERS:
+        assert resp.getheader(name) == value
+    conn.close()
+
+def test_too_many_header_lines_are_rejected(async_web):
+    conn = http.client.HTTPConnection("127.0.0.1", async_web, timeout=5)
+    conn.putrequest("POST", "/api/nowhere")
+    for i in range(async_server.MAX_HEADER_LINES + 5):
+        conn.putheader(f"X-Filler-{i}", "x")
+    conn.endheaders(b"{}")
+    resp = conn.getresponse()
+    assert resp.status == 431
+    assert json.loads(resp.read())["code"] == 431
@@ -0,0 +1,121 @@
+import io
+import os
+import pytest
+import plugins.web_interface.storage as storage
+import plugins.web_interface.server as server
+from google.genai import types
+
+blob_store = storage.blob_store
+
+def _image_chat(chat, chat_id, data):
+    chat.id = chat_id
+    chat.messages = [types.Content(role="user", parts=[
+        types.Part(text=f"image for {chat_id}"),
+        types.Part.from_bytes(data=data, mime_type="image/png"),
+    ])]
+    return chat
+
+def _blob_files():
+    found = []
+    for root, _, files in os.walk(blob_store.BLOBS_DIR):
+        found += [f for f in files if f.endswith(".png")]
+    return found
+
+def test_images_are_deduplicated_across_chats(mock_agent):
+    storage.save_chat_state(_image_chat(mock_agent, "blob_a", b"same screenshot"))
+    storage.save_chat_state(_image_chat(mock_agent, "blob_b", b"same screenshot"))
+    assert len(_blob_files()) == 1
+
+    # Serialization does not touch the live message
+    part = mock_agent.messages[0].parts[1]
+    assert part.inline_data.data == b"same screenshot"
+    assert getattr(part, "_blob_path", None) is None
+
+    storage.delete_chat("blob_a")
+    assert len(_blob_files()) == 1
+    storage.delete_chat("blob_b")
+    assert _blob_files() == []
+
+def test_put_and_release_do_not_interleave(mock_agent, monkeypatch):
+    """A blob is written and referenced in one locked step, so release_chat cannot delete it in between."""
+    sha, _ = blob_store.put(b"shared", "image/png", "old_chat")
+    seen = []
+    real_exists = os.path.exists
+    def checking_exists(path):
+        seen.append(blob_store._lock.locked())
+        return real_exists(path)
+    monkeypatch.setattr(blob_store.os.path, "exists", checking_exists)
+    _, path = blob_store.put(b"shared", "image/png", "new_chat")
+    monkeypatch.undo()
+    assert seen and all(seen)
+
+    blob_store.release_chat("old_chat")
+    assert os.path.exists(path)
+    assert blob_store._refs[sha] == {"new_chat"}
+
+def test_loaded_images_are_lazy(mock_agent):
+    storage.save_chat_state(_image_chat(mock_agent, "blob_lazy", b"lazy bytes"))
+    os.remove(os.path.join(storage.CHATS_DIR, "blob_lazy.state"))
+
+    chat, _ = storage.load_chat_state("blob_lazy", lambda: mock_agent)
+    part = chat.messages[0].parts[1]
+    assert part.inline_data.data is None
+    sent = chat._materialize_contents(chat.messages)
+    assert sent[0].parts[1].inline_data.data == b"lazy bytes"
+    assert chat.messages[0].parts[1].inline_data.data is None
+
+def test_chat_acl_has_no_access_to_shared_blobs(mock_agent):
+    import agent
+    storage.save_chat_state(_image_chat(mock_agent, "blob_acl", b"private"))
+    chat, _ = storage.load_chat_state("blob_acl", lambda: mock_agent)
+    chat.id = "blob_acl"
+    chat.fs_permissions = {"custom": True, "global": "", "paths": {}}
+    chat._build_dynamic_context()
+    blob = chat.messages[0].parts[1]._blob_path
+    assert "chats/blobs/" not in chat.fs_permissions["paths"]
+
+    token = agent.security_context.set(chat.fs_permissions)
+    try:
+        with pytest.raises(agent.GuardViolation):
+            open(blob, "wb")
+        # The agent itself still reads the blob for the request
+        assert chat._materialize_contents(chat.messages)[0].parts[1].inline_data.data == b"private"
+    finally:
+        agent.security_context.reset(token)
+
+class _FakeHandler:
+    def __init__(self, headers):
+        self.headers = headers
+        self.wfile = io.BytesIO()
+        self.status = None
+        self.sent_headers = {}
+    def send_response(self, code): self.status = code
+    def send_header(self, key, value): self.sent_headers[key] = value
+    def end_headers(self): pass
+    def _send_cors_headers(self): pass
+    def send_json_error(self, code, message): self.status = code
+    stream_file = server.WebRequestHandler.stream_file
+
+def _serve(headers, name):
+    handler = _FakeHandler(headers)
+    server.WebRequestHandler.serve_chat_image(handler, {"chat_id": ["c"], "file": [name]})
+    return handler
+
+def test_serve_chat_image_etag_and_range(mock_agent, monkeypatch):
+    monkeypatch.setattr(server.storage.blob_store, "BLOBS_DIR", blob_store.BLOBS_DIR)
+    sha, path = blob_store.put(b"0123456789", "image/png", "c")
+    name = os.path.basename(path)
+
+    full = _serve({}, name)
+    assert full.status == 200 and full.wfile.getvalue() == b"0123456789"
+    etag = full.sent_headers["ETag"]
+
+    assert _serve({"If-None-Match": etag}, name).status == 304
+
+    part = _serve({"Range": "bytes=2-4"}, name)
+    assert part.status == 206
+    assert part.wfile.getvalue() == b"234"
+    assert part.sent_headers["Content-Range"] == "bytes 2-4/10"
+
+    assert _serve({"Range": "bytes=-3"}, name).wfile.getvalue() == b"789"
+    assert _serve({"Range": "bytes=20-"}, name).status == 416
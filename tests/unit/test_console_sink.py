@@ -0,0 +1,56 @@
+import io
+import time
+import threading
+from console_sink import ConsoleSink
+
+def _sink(**kwargs):
+    stream = io.StringIO()
+    return ConsoleSink(stream=stream, **kwargs), stream
+
+def test_fragments_are_assembled_with_prefix_per_line():
+    sink, stream = _sink(flush_interval=10)
+    for fragment in ["Hel", "lo\nwor", "ld", "\n"]:
+        sink.write("a", fragment, prefix="[a]: ")
+    sink.flush()
+    assert stream.getvalue() == "[a]: Hello\n[a]: world\n"
+
+def test_parallel_chats_do_not_interleave_inside_a_line():
+    sink, stream = _sink(flush_interval=10)
+    sink.write("a", "first ", prefix="[a]: ")
+    sink.write("b", "other line\n", prefix="[b]: ")
+    sink.write("a", "half\n", prefix="[a]: ")
+    sink.flush()
+    assert stream.getvalue() == "[b]: other line\n[a]: first half\n"
+
+    # A line already started on the console is continued, a foreign line breaks it
+    sink.write("a", "streaming", prefix="[a]: ")
+    sink.flush()
+    sink.write("b", "done\n", prefix="[b]: ")
+    sink.flush()
+    assert stream.getvalue().endswith("[a]: streaming\n[b]: done\n")
+
+def test_background_thread_flushes_without_blocking_writers():
+    sink, stream = _sink(flush_interval=0.01)
+    threads = [threading.Thread(target=lambda k=k: [sink.write(k, f"{k}{i}\n") for i in range(100)])
+               for k in "xyz"]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    deadline = time.monotonic() + 5
+    while stream.getvalue().count("\n") < 300 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 300
+    assert [l for l in lines if l.startswith("y")] == [f"y{i}" for i in range(100)]
+
+def test_overflow_drops_oldest_fragments():
+    sink, stream = _sink(flush_interval=10, capacity=3)
+    sink._thread = object()   # keep the background writer out of the way
+    for i in range(5):
+        sink.write("a", f"{i}\n")
+    sink.flush()
+    assert stream.getvalue() == "2\n3\n4\n" and sink.stats["dropped"] == 2
+
+def test_zero_interval_writes_synchronously():
+    sink, stream = _sink(flush_interval=0)
+    sink.write("a", "now\n", prefix="\t")
+    assert stream.getvalue() == "\tnow\n"
@@ -0,0 +1,67 @@
+import os
+import json
+import context_cache
+
+def test_json_is_reparsed_only_after_change(tmp_path):
+    path = tmp_path / "presets.json"
+    path.write_text(json.dumps({"a": 1}), encoding="utf-8")
+    first = context_cache.load_json(str(path), {})
+    assert context_cache.load_json(str(path), {}) is first
+
+    path.write_text(json.dumps({"a": 22}), encoding="utf-8")
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+    assert context_cache.load_json(str(path), {}) == {"a": 22}
+    default = {}
+    assert context_cache.load_json(str(tmp_path / "missing.json"), default) is default
+
+def test_gather_output_is_reused_until_deps_change(tmp_path, monkeypatch):
+    runs = []
+    def run():
+        runs.append(1)
+        return f"run {len(runs)}"
+
+    (tmp_path / "pkg").mkdir()
+    (tmp_path / "pkg" / "a.py").write_text("x = 1")
+    deps = [str(tmp_path / "pkg") + "/**"]
+    assert context_cache.gather("script", run, deps=deps) == "run 1"
+    assert context_cache.gather("script", run, deps=deps) == "run 1"
+
+    # Editing a nested file invalidates the output
+    (tmp_path / "pkg" / "a.py").write_text("x = 22")
+    assert context_cache.gather("script", run, deps=deps) == "run 2"
+
+    # Without a TTL or dependencies the script runs every time
+    context_cache.gather("plain", run)
+    context_cache.gather("plain", run)
+    assert len(runs) == 4
+
+    # An expired TTL reruns the script
+    assert context_cache.gather("ttl", run, ttl=60) == "run 5"
+    assert context_cache.gather("ttl", run, ttl=60) == "run 5"
+    monkeypatch.setattr(context_cache.time, "monotonic", lambda: 1e12)
+    assert context_cache.gather("ttl", run, ttl=60) == "run 6"
+
+def test_acl_intersection_is_cached_and_copied():
+    calls = []
+    def intersect(acl_list):
+        calls.append(acl_list)
+        return {"global": "r", "paths": {"src/": "rw"}}
+
+    acl = [{"global": "rw", "paths": {}}, {"global": "r", "paths": {"src/": "rw"}}]
+    first = context_cache.intersect_acl(acl, intersect)
+    first["paths"]["chats/1.pkl"] = "rwxld"
+    second = context_cache.intersect_acl(acl, intersect)
+    assert len(calls) == 1
+    assert second == {"global": "r", "paths": {"src/": "rw"}}
+
+def test_chats_get_their_own_copy_of_preset_lists(mock_agent, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "presets.json").write_text(json.dumps({"default_preset_id": "p", "presets": {
+        "p": {"blocked": ["shell"], "settings": {"python": {"timeout": 5}}}}}), encoding="utf-8")
+    mock_agent.active_preset_id = "p"
+    mock_agent._build_dynamic_context()
+    mock_agent.blocked_tools.append("python")
+    mock_agent.settings_tools["python"]["timeout"] = 99
+
+    preset = context_cache.load_json("presets.json", {})["presets"]["p"]
+    assert preset == {"blocked": ["shell"], "settings": {"python": {"timeout": 5}}}
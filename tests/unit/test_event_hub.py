@@ -0,0 +1,66 @@
+import threading
+import plugins.web_interface.server as server
+
+event_hub = server.event_hub
+
+def _event(cid, data):
+    return {"type": "text", "chatId": cid, "data": data}
+
+def test_every_subscriber_gets_its_own_copy():
+    hub = event_hub.EventHub()
+    tab_a, tab_b = hub.subscribe(), hub.subscribe()
+    hub.publish(_event("c1", "hello"))
+    assert [e["data"] for _, e in tab_a.get(timeout=0)] == ["hello"]
+    assert [e["data"] for _, e in tab_b.get(timeout=0)] == ["hello"]
+
+def test_chat_filter():
+    hub = event_hub.EventHub()
+    sub = hub.subscribe(chat_ids=["c2"])
+    hub.publish(_event("c1", "skip"))
+    hub.publish(_event("c2", "keep"))
+    assert [e["data"] for _, e in sub.get(timeout=0)] == ["keep"]
+
+def test_last_event_id_replay():
+    hub = event_hub.EventHub()
+    first = hub.publish(_event("c1", "a"))
+    hub.publish(_event("c1", "b"))
+    hub.publish(_event("c1", "c"))
+    sub = hub.subscribe(last_event_id=first)
+    assert [e["data"] for _, e in sub.get(timeout=0)] == ["b", "c"]
+    # An id from a previous server run replays nothing
+    assert hub.subscribe(last_event_id="0:1").get(timeout=0) == []
+
+def test_subscriber_wakes_on_publish_and_buffer_is_bounded():
+    hub = event_hub.EventHub()
+    sub = hub.subscribe()
+    threading.Timer(0.05, hub.publish, args=(_event("c1", "late"),)).start()
+    assert [e["data"] for _, e in sub.get(timeout=5)] == ["late"]
+
+    small = event_hub.Subscriber(hub, maxlen=2)
+    with small.cond:
+        for i in range(3):
+            small._push((str(i), _event("c1", i)))
+    assert small.dropped == 1 and len(small.buffer) == 2
+    sub.close()
+    assert hub.subscriber_count() == 0
+
+def test_coalescing_merges_fragments_until_other_event():
+    hub = event_hub.EventHub()
+    hub.configure(window=10, max_bytes=4096)
+    sub = hub.subscribe()
+    for word in ("Hel", "lo", " world"):
+        hub.emit(_event("c1", word))
+    hub.emit({"type": "thought", "chatId": "c1", "data": "hmm"})
+    hub.emit({"type": "finish", "chatId": "c1", "data": {}})
+    assert [(e["type"], e["data"]) for _, e in sub.get(timeout=0)] == [
+        ("text", "Hello world"), ("thought", "hmm"), ("finish", {})]
+    assert hub.stats == {"events": 5, "frames": 3}
+
+def test_coalescing_flushes_by_size_and_time():
+    hub = event_hub.EventHub()
+    hub.configure(window=0.02, max_bytes=4)
+    sub = hub.subscribe()
+    hub.emit(_event("c1", "abcd"))
+    assert [e["data"] for _, e in sub.get(timeout=0)] == ["abcd"]
+    hub.emit(_event("c1", "x"))
+    assert [e["data"] for _, e in sub.get(timeout=5)] == ["x"]
@@ -0,0 +1,72 @@
+from google.genai import types as genai_types
+import history_compactor
+
+def user(text):
+    return genai_types.Content(role="user", parts=[genai_types.Part(text=text)])
+
+def model(text):
+    return genai_types.Content(role="model", parts=[genai_types.Part(text=text)])
+
+def tool_exchange(name, output):
+    call = genai_types.Content(role="model", parts=[genai_types.Part(
+        function_call=genai_types.FunctionCall(name=name, args={"url": "x"}))])
+    response = genai_types.Content(role="user", parts=[genai_types.Part(
+        function_response=genai_types.FunctionResponse(name=name, response={"result": output}))])
+    return [call, response]
+
+def test_history_under_budget_is_sent_as_is():
+    messages = [user("hi"), model("hello")]
+    result = history_compactor.compact(messages, budget=1000)
+    assert result.contents == messages
+    assert result.saved_tokens == 0
+
+def test_stale_tool_responses_are_stubbed_and_originals_kept():
+    big = "x" * 40000
+    messages = [user("fetch")] + tool_exchange("http", big) + [model("done")] + [user("next"), model("ok")]
+    result = history_compactor.compact(messages, budget=2000, keep_recent=2)
+
+    stubbed = result.contents[2].parts[0].function_response.response["result"]
+    assert len(stubbed) < 2000 and "обрезано" in stubbed
+    assert result.tokens <= 2000 and result.saved_tokens > 9000
+    # The full history is untouched
+    assert messages[2].parts[0].function_response.response["result"] == big
+
+def test_old_images_are_dropped():
+    image = genai_types.Part(inline_data=genai_types.Blob(mime_type="image/png", data=b"png"))
+    messages = [genai_types.Content(role="user", parts=[genai_types.Part(text="look"), image]), model("seen"),
+                user("recent"), model("ok")]
+    result = history_compactor.compact(messages, budget=20, keep_recent=2)
+    assert all(p.inline_data is None for p in result.contents[0].parts)
+    assert messages[0].parts[1].inline_data is not None
+
+def test_old_turns_are_summarized_incrementally():
+    calls = []
+    def summarize(segment, previous):
+        calls.append((len(segment), previous))
+        return f"summary {len(calls)}"
+
+    messages = []
+    for i in range(6):
+        messages += [user(f"question {i} " + "q" * 400), model("a" * 400)]
+    result = history_compactor.compact(messages, budget=400, keep_recent=2, summarize=summarize)
+
+    first = result.contents[0]
+    assert first.role == "user" and first.parts[0].text.endswith("summary 1")
+    assert first.parts[1].text.startswith("question")
+    assert result.tokens < result.original_tokens
+
+    # Same history: the stored summary is reused without a new call
+    again = history_compactor.compact(messages, budget=400, keep_recent=2, summarize=summarize,
+                                      summary_state=result.summary_state)
+    assert len(calls) == 1 and again.contents[0].parts[0].text == first.parts[0].text
+
+    # New turns only summarize the tail on top of the previous summary
+    messages += [user("more " + "m" * 400), model("b" * 400)]
+    history_compactor.compact(messages, budget=400, keep_recent=2, summarize=summarize,
+                              summary_state=result.summary_state)
+    assert calls[1][1] == "summary 1" and calls[1][0] == 2
+
+def test_failed_summary_falls_back_to_full_turns():
+    messages = [user("q" * 4000), model("a" * 4000), user("recent"), model("ok")]
+    result = history_compactor.compact(messages, budget=100, keep_recent=2, summarize=lambda s, p: None)
+    assert result.contents == messages and result.summary_state is None
@@ -0,0 +1,45 @@
+from unittest.mock import MagicMock
+from google.genai import types
+from key_pool import KeyPool, key_pool
+from rate_limiter import rate_limiter
+
+def _pool(n):
+    pool = KeyPool()
+    pool.load([f"key{i}" for i in range(n)])
+    return pool
+
+def test_least_loaded_key_is_chosen():
+    pool = _pool(3)
+    busy = [rate_limiter.acquire("kp-model", 0, 1000), rate_limiter.acquire("kp-model", 1, 1000)]
+    assert pool.choose("kp-model") == (2, 0.0)
+    for p in busy:
+        rate_limiter.release(p)
+
+def test_quarantine_skips_key_until_delay_expires():
+    pool = _pool(2)
+    pool.quarantine(0, 60)
+    assert all(pool.choose("kp-other")[0] == 1 for _ in range(4))
+    pool.quarantine(1, 30)
+    index, wait = pool.choose("kp-other")
+    assert index == 1 and 0 < wait <= 30
+    assert pool.free_count() == 0
+
+def test_429_moves_request_to_another_key(mock_agent, monkeypatch):
+    pool = _pool(2)
+    monkeypatch.setattr("agent.key_pool", pool)
+    chunk = types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text="ok")]))])
+    clients = {0: MagicMock(), 1: MagicMock()}
+    clients[0].models.generate_content_stream.side_effect = Exception("429 RESOURCE_EXHAUSTED. Please retry in 40s")
+    clients[1].models.generate_content_stream.return_value = iter([chunk])
+    pool._clients = clients
+    mock_agent.messages = [types.Content(role="user", parts=[types.Part(text="hi")])]
+
+    # A request in flight on key 1 makes key 0 the least loaded one
+    busy = rate_limiter.acquire(mock_agent.model, 1, mock_agent.model_rpm)
+    try:
+        assert mock_agent._process_request() == "ok"
+    finally:
+        rate_limiter.release(busy)
+    assert pool.stats["chosen"] == {0: 1, 1: 1}
+    assert pool.stats["quarantined"] == {0: 1}
@@ -0,0 +1,124 @@
+import itertools
+import threading
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+import prompt_cache as pc
+from prompt_cache import PromptCache
+from google.genai import types
+
+BIG_PROMPT = "system " * 2000
+TOOLS = [{"name": "python_tool", "description": "run code", "parameters": {"type": "object", "properties": {}}}]
+
+class StubCaches:
+    """Local stand-in for client.caches."""
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.created = []
+        self.updated = []
+        self.deleted = []
+        self._ids = itertools.count()
+
+    def create(self, model, config):
+        if self.fail:
+            raise Exception("400 Cached content is too small")
+        self.created.append(config)
+        return SimpleNamespace(name=f"cachedContents/{next(self._ids)}")
+
+    def update(self, name, config):
+        self.updated.append((name, config.ttl))
+
+    def delete(self, name):
+        self.deleted.append(name)
+
+def _client(fail=False):
+    return SimpleNamespace(caches=StubCaches(fail))
+
+def test_entries_are_keyed_by_content_hash_and_refreshed(monkeypatch):
+    cache, client = PromptCache(), _client()
+    name = cache.get(client, 0, "m", BIG_PROMPT, TOOLS)
+    assert cache.get(client, 0, "m", BIG_PROMPT, TOOLS) == name
+    assert len(client.caches.created) == 1
+    assert client.caches.created[0].system_instruction == BIG_PROMPT
+    # Another prefix or another key gets its own entry
+    assert cache.get(client, 0, "m", BIG_PROMPT + "x", TOOLS) != name
+    assert cache.get(client, 1, "m", BIG_PROMPT, TOOLS) != name
+    assert len(client.caches.created) == 3
+
+    # Close to expiry the TTL is extended instead of creating a new entry
+    monkeypatch.setattr(pc, "REFRESH_MARGIN", cache.ttl + 1)
+    assert cache.get(client, 0, "m", BIG_PROMPT, TOOLS) == name
+    assert client.caches.updated == [(name, f"{cache.ttl}s")]
+    assert cache.stats["refreshed"] == 1
+
+def test_failure_falls_back_without_retrying_every_request():
+    cache, client = PromptCache(), _client(fail=True)
+    assert cache.get(client, 0, "m", BIG_PROMPT, TOOLS) is None
+    client.caches.fail = False
+    assert cache.get(client, 0, "m", BIG_PROMPT, TOOLS) is None
+    assert client.caches.created == []
+    assert cache.stats["fallbacks"] == 2
+    # Small prompts are never sent to the cache API
+    assert cache.get(client, 0, "m", "short", TOOLS) is None
+
+def test_generate_config_uses_cached_content(mock_agent, monkeypatch):
+    cache = PromptCache()
+    monkeypatch.setattr("agent.prompt_cache", cache)
+    mock_agent.system_prompt = BIG_PROMPT
+    client = MagicMock()
+    client.caches = StubCaches()
+
+    mock_agent.final_prompt = "MODE DATA"
+    config = mock_agent.get_generate_config(client, 0)
+    assert config.cached_content == "cachedContents/0"
+    assert config.system_instruction is None and not config.tools
+    # The per-mode final prompt stays out of the cached prefix and goes with the request
+    assert client.caches.created[0].system_instruction == BIG_PROMPT
+    contents = mock_agent._with_final_prompt([types.Content(role="user", parts=[types.Part(text="hi")])], config)
+    assert [p.text for p in contents[0].parts] == ["MODE DATA", "hi"]
+    mock_agent.final_prompt = "OTHER MODE"
+    assert mock_agent.get_generate_config(client, 0).cached_content == "cachedContents/0"
+    assert len(client.caches.created) == 1
+    # Without a client (or when caching is off) the full prefix is sent
+    cache.enabled = False
+    config = mock_agent.get_generate_config(client, 0)
+    assert config.cached_content is None and config.system_instruction.startswith(BIG_PROMPT)
+
+    cache.record_usage(1000, 900)
+    cache.record_usage(1000, 0)
+    assert cache.hit_rate() == 0.45
+    assert cache.metrics()["hit_rate"] == 0.45
+
+def test_replaced_entry_is_deleted_once_no_chat_uses_it():
+    cache, client = PromptCache(), _client()
+    old = cache.get(client, 0, "m", BIG_PROMPT, TOOLS, owner="a")
+    assert cache.get(client, 0, "m", BIG_PROMPT, TOOLS, owner="b") == old
+    new = cache.get(client, 0, "m", BIG_PROMPT + "v2", TOOLS, owner="a")
+    assert client.caches.deleted == []          # chat b still uses the old prefix
+    assert cache.get(client, 0, "m", BIG_PROMPT + "v2", TOOLS, owner="b") == new
+    assert client.caches.deleted == [old]
+    assert cache.stats["deleted"] == 1
+
+def test_api_calls_run_outside_the_shared_lock():
+    cache, client = PromptCache(), _client()
+    started, release = threading.Event(), threading.Event()
+    create = client.caches.create
+    def slow_create(model, config):
+        started.set()
+        release.wait(5)
+        return create(model, config)
+    client.caches.create = slow_create
+
+    names = []
+    first = threading.Thread(target=lambda: names.append(cache.get(client, 0, "m", BIG_PROMPT, TOOLS)))
+    same = threading.Thread(target=lambda: names.append(cache.get(client, 0, "m", BIG_PROMPT, TOOLS)))
+    first.start()
+    assert started.wait(5)
+    same.start()
+    # Another prefix is not blocked by the creation in flight
+    other = _client()
+    assert cache.get(other, 0, "m", BIG_PROMPT + "x", TOOLS) == "cachedContents/0"
+    release.set()
+    first.join(5)
+    same.join(5)
+    assert names == ["cachedContents/0", "cachedContents/0"]
+    assert len(client.caches.created) == 1
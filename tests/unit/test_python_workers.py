@@ -0,0 +1,71 @@
+import pytest
+import python_workers
+
+@pytest.fixture
+def pool():
+    pool = python_workers.WorkerPool(max_workers=2, timeout=20)
+    yield pool
+    pool.shutdown()
+
+def test_worker_keeps_state_between_calls(pool):
+    assert pool.execute("a", "x = 41\nresult = x + 1") == "42"
+    assert pool.execute("a", "print('to console')\nresult = x") == "41"
+    # Each chat gets its own interpreter
+    assert pool.execute("b", "result = globals().get('x')") == "None"
+    assert "ZeroDivisionError" in pool.execute("a", "1 / 0")
+    # input() does not read the protocol pipe
+    assert "EOFError" in pool.execute("a", "input()")
+
+def test_runaway_code_is_killed_and_restarted(pool):
+    pool.configure(timeout=1)
+    pool.execute("a", "x = 1")
+    assert "процесс Python завершён" in pool.execute("a", "while True: pass")
+    pool.configure(timeout=20)
+    assert pool.execute("a", "result = globals().get('x')") == "None"
+    assert pool.stats["crashes"] == 1
+
+def test_acl_applies_inside_worker(pool, tmp_path):
+    secret = tmp_path / "secret.txt"
+    secret.write_text("s")
+    result = pool.execute("a", f"result = open({str(secret)!r}).read()", acl={"global": "", "paths": {}})
+    assert "Access Denied" in result
+    assert pool.execute("a", f"result = open({str(secret)!r}).read()") == "s"
+
+def test_least_recently_used_worker_is_evicted(pool):
+    pool.execute("a", "x = 1")
+    pool.execute("b", "x = 2")
+    pool.execute("c", "x = 3")
+    assert pool.stats["evicted"] == 1
+    assert pool.execute("a", "result = globals().get('x')").startswith("[Процесс Python был перезапущен")
+
+def test_python_tool_routes_to_worker(mock_agent, monkeypatch):
+    calls = []
+    monkeypatch.setattr(python_workers.pool, "execute", lambda key, code, acl=None: calls.append(code) or "w")
+    mock_agent.python_backend = "worker"
+    assert mock_agent.python_tool("result = 1") == "w"
+    # Code that needs the chat object stays in-process
+    assert mock_agent.python_tool("result = self.count_tab") == "0"
+    assert calls == ["result = 1"]
+
+def test_reserved_worker_is_not_evicted(pool):
+    pool.execute("a", "x = 1")
+    pool.execute("b", "x = 2")
+    # "a" was handed out but has not started its call yet
+    worker, _ = pool._get("a")
+    assert worker.busy == 1
+    pool.configure(timeout=1)
+    assert "заняты" not in pool.execute("c", "x = 3")
+    assert pool._workers.get("a") is worker and worker.alive()
+    assert "b" in pool._lost
+    worker.busy -= 1
+
+def test_pool_never_exceeds_max_workers(pool):
+    pool.configure(timeout=1)
+    held = [pool._get("a")[0], pool._get("b")[0]]
+    assert "заняты" in pool.execute("c", "x = 3")
+    assert len(pool._workers) == 2 and pool.stats["refused"] == 1
+    for worker in held:
+        worker.busy -= 1
+    pool.configure(timeout=20)
+    assert pool.execute("c", "result = 3") == "3"
+    assert len(pool._workers) == 2
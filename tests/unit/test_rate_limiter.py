@@ -0,0 +1,101 @@
+import time
+import threading
+from rate_limiter import RateLimiter, rate_limiter
+from google.genai import types
+
+def test_bucket_is_shared_between_chats():
+    limiter = RateLimiter()
+    # 60 RPM: a full bucket, then one permit per second shared by every chat
+    permits = [limiter.acquire("m", 0, 60, chat=f"chat{i % 3}") for i in range(60)]
+    for p in permits:
+        limiter.release(p)
+    start = time.monotonic()
+    limiter.release(limiter.acquire("m", 0, 60, chat="late"))
+    assert time.monotonic() - start > 0.5
+    # Another key has its own bucket
+    start = time.monotonic()
+    limiter.release(limiter.acquire("m", 1, 60))
+    assert time.monotonic() - start < 0.1
+
+def test_permits_are_issued_in_arrival_order():
+    limiter = RateLimiter()
+    for _ in range(600):
+        limiter.release(limiter.acquire("m", 0, 600))
+    order = []
+    def worker(name):
+        limiter.release(limiter.acquire("m", 0, 600, chat=name))
+        order.append(name)
+    threads = []
+    for name in ("a", "b", "c"):
+        t = threading.Thread(target=worker, args=(name,))
+        t.start()
+        threads.append(t)
+        time.sleep(0.02)
+    for t in threads:
+        t.join(5)
+    assert order == ["a", "b", "c"]
+
+def test_tpm_is_reconciled_with_usage():
+    limiter = RateLimiter()
+    limiter.tpm_limits["m"] = 6000
+    permit = limiter.acquire("m", 0, 1000, estimated_tokens=100)
+    assert limiter.in_flight("m", 0) == 1
+    limiter.release(permit, used_tokens=6000)
+    limiter.release(permit, used_tokens=6000)  # a second release is a no-op
+    stats = limiter.stats()["m#0"]
+    assert stats["tokens"] == 6000 and stats["tokens_last_minute"] == 6000
+    assert stats["acquired"] == stats["released"] == 1 and stats["in_flight"] == 0
+    # Actual usage exceeded the estimate, so the next request has to wait
+    assert limiter._limits[("m", 0)].tpm.wait_time(100) > 0.5
+
+def test_process_request_goes_through_shared_limiter(mock_agent):
+    mock_agent.id = "rl_chat"
+    usage = types.GenerateContentResponseUsageMetadata(prompt_token_count=7, candidates_token_count=3)
+    chunk = types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text="ok")]))],
+        usage_metadata=usage)
+    mock_agent.client.models.generate_content_stream.return_value = iter([chunk])
+    mock_agent.messages = [types.Content(role="user", parts=[types.Part(text="hi")])]
+    key = f"{mock_agent.model}#{mock_agent.current_key_index}"
+    before = rate_limiter.stats().get(key, {"acquired": 0, "tokens": 0})
+
+    assert mock_agent._process_request() == "ok"
+    after = rate_limiter.stats()[key]
+    assert after["acquired"] == before["acquired"] + 1
+    assert after["tokens"] == before["tokens"] + 10
+    assert after["in_flight"] == 0
+    assert mock_agent._current_permit is None
+
+def test_configured_tpm_applies_to_existing_buckets():
+    limiter = RateLimiter()
+    limiter.release(limiter.acquire("m", 0, 1000))
+    assert limiter.stats()["m#0"]["tpm_limit"] is None
+    limiter.configure(tpm_limits={"m": 6000, "other": 0})
+    assert limiter.tpm_limits == {"m": 6000}
+    assert limiter.stats()["m#0"]["tpm_limit"] == 6000
+
+def test_rpm_change_keeps_the_current_level():
+    limiter = RateLimiter()
+    for _ in range(3):
+        limiter.release(limiter.acquire("m", 0, 3))
+    # Raising the limit must not hand out a fresh full bucket
+    limiter._limit(("m", 0), 600)
+    assert limiter.available("m", 0) < 1
+
+def test_on_wait_runs_without_the_shared_lock():
+    limiter = RateLimiter()
+    limiter.release(limiter.acquire("m", 0, 30))
+    free = []
+    def on_wait(delay):
+        # Another key can be served while this chat is being notified
+        t = threading.Thread(target=lambda: free.append(limiter.in_flight("x", 0)))
+        t.start()
+        t.join(1)
+        raise RuntimeError("stop")
+    limiter._limits[("m", 0)].rpm.tokens = 0
+    try:
+        limiter.acquire("m", 0, 30, on_wait=on_wait)
+    except RuntimeError:
+        pass
+    assert free == [0]
+    assert not limiter._limits[("m", 0)].queue
@@ -0,0 +1,81 @@
+import os
+import json
+import pytest
+import result_store
+
+@pytest.fixture
+def results_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(result_store, "RESULTS_DIR", str(tmp_path / "tool_results"))
+    return tmp_path / "tool_results"
+
+def _big_page():
+    return "\n".join(f"line {i} " + "x" * 50 for i in range(2000))
+
+def test_large_result_is_offloaded_with_handle(results_dir):
+    page = _big_page()
+    shown = result_store.offload("http", page)
+    assert len(shown) < 8000
+    assert shown.startswith("[Результат http сокращён")
+    assert "line 0 " in shown and "line 1999 " in shown
+
+    handle = shown.split('handle="', 1)[1].split('"', 1)[0]
+    with open(os.path.join(results_dir, f"{handle}.txt"), encoding="utf-8") as f:
+        assert f.read() == page
+    # Identical output is stored once
+    assert result_store.offload("http", page) == shown
+    assert len(os.listdir(results_dir)) == 1
+
+    # Small results, non-string results and image lists pass through
+    assert result_store.offload("http", "short") == "short"
+    assert result_store.offload("x", {"images": ["a"], "text": "t"}) == {"images": ["a"], "text": "t"}
+
+def test_read_line_and_byte_ranges(results_dir):
+    handle = result_store.put(_big_page())
+    lines = result_store.read_range(handle, 10, 12)
+    assert lines.splitlines()[1:] == [f"line {i} " + "x" * 50 for i in (10, 11)]
+    assert result_store.read_range(handle, 0, 4, unit="bytes").endswith("line")
+
+    # Oversized ranges are capped
+    assert len(result_store.read_range(handle)) < result_store.MAX_READ_CHARS + 200
+    assert "не найден" in result_store.read_range("0" * 16)
+    assert "не найден" in result_store.read_range("../../etc/passwd")
+
+def test_tool_response_keeps_history_small(mock_agent, results_dir):
+    part = mock_agent._tool_response_part("shell", _big_page())
+    handle = part.function_response.response["result"].split('handle="', 1)[1].split('"', 1)[0]
+    assert len(part.function_response.response["result"]) < 8000
+
+    # The retrieval tool itself is never offloaded
+    chunk = mock_agent.tool_exec("tool_result", {"handle": handle, "start": 0, "end": 3})
+    assert chunk.splitlines()[1] == "line 0 " + "x" * 50
+    part = mock_agent._tool_response_part("tool_result", result_store.read_range(handle))
+    assert "сокращён" not in part.function_response.response["result"]
+
+def test_json_shell_output_is_offloaded_per_field(results_dir):
+    output = json.dumps({"status": "running", "stdout": _big_page(), "stderr": ""}, indent=2)
+    shown = result_store.offload("shell", output)
+    assert shown["status"] == "running" and shown["stderr"] == ""
+    handle = shown["stdout"].split('handle="', 1)[1].split('"', 1)[0]
+    # Stored as real lines, not as an escaped JSON string
+    assert result_store.read_range(handle, 5, 6).splitlines()[1] == "line 5 " + "x" * 50
+
+def test_offload_works_under_read_only_chat_acl(results_dir):
+    import agent
+    page = _big_page()
+    token = agent.security_context.set({"global": "rl", "paths": {}})
+    try:
+        # The chat itself may not write, but the shared store is the agent's own I/O
+        with pytest.raises(agent.GuardViolation):
+            open(results_dir.parent / "probe.txt", "w")
+        shown = result_store.offload("http", page)
+        handle = shown.split('handle="', 1)[1].split('"', 1)[0]
+        assert result_store.read_range(handle, 0, 1).splitlines()[1] == "line 0 " + "x" * 50
+    finally:
+        agent.security_context.reset(token)
+
+def test_offload_falls_back_to_full_result_on_store_error(results_dir, monkeypatch):
+    def broken_put(text):
+        raise RuntimeError("store unavailable")
+    monkeypatch.setattr(result_store, "put", broken_put)
+    page = _big_page()
+    assert result_store.offload("http", page) == page
@@ -0,0 +1,59 @@
+import time
+import threading
+import plugins.web_interface.server as server
+
+scheduler = server.scheduler
+
+def _wait_idle(sched, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        m = sched.metrics()
+        if m["running"] == 0 and m["queued"] == 0:
+            return m
+        time.sleep(0.01)
+    raise AssertionError("scheduler did not drain")
+
+def test_busy_chat_queues_messages_in_order():
+    sched = scheduler.AgentScheduler(workers=4)
+    gate = threading.Event()
+    order = []
+
+    def turn(i):
+        def run():
+            if i == 0: gate.wait(5)
+            order.append(i)
+        return run
+
+    assert sched.submit("chat", "m", turn(0)) == 0
+    assert sched.submit("chat", "m", turn(1)) == 1
+    assert sched.submit("chat", "m", turn(2)) == 2
+    time.sleep(0.05)
+    m = sched.metrics()
+    assert m["running"] == 1 and m["queued"] == 2
+    assert m["chats"]["chat"]["running"] and m["chats"]["chat"]["queued"] == 2
+    gate.set()
+    m = _wait_idle(sched)
+    assert order == [0, 1, 2]
+    assert m["completed"] == 3 and m["wait_time"]["max"] > 0
+
+def test_model_limit_and_cancel():
+    sched = scheduler.AgentScheduler(workers=4, model_limits={"slow": 1})
+    gate = threading.Event()
+    started = []
+
+    def turn(name):
+        def run():
+            started.append(name)
+            gate.wait(5)
+        return run
+
+    sched.submit("a", "slow", turn("a"))
+    sched.submit("b", "slow", turn("b"))
+    sched.submit("c", "fast", turn("c"))
+    time.sleep(0.05)
+    assert sorted(started) == ["a", "c"]
+    assert sched.metrics()["models"]["slow"] == {"running": 1, "limit": 1}
+    assert sched.cancel("b") == 1
+    gate.set()
+    _wait_idle(sched)
+    assert "b" not in started
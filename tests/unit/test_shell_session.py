@@ -0,0 +1,43 @@
+import os
+import json
+import time
+import pytest
+import agent
+
+pytestmark = pytest.mark.skipif(os.name == "nt", reason="sentinel commands are tested against bash")
+
+@pytest.fixture
+def session():
+    session = agent.ShellSession()
+    yield session
+    session.close()
+
+def test_run_returns_at_command_speed_with_exit_code(session):
+    start = time.monotonic()
+    res = session.run("export V=7; echo hi; ls /nonexistent-dir")
+    assert time.monotonic() - start < 2
+    assert res["done"] and res["exit_code"] == 2
+    assert res["stdout"] == "hi\n" and "nonexistent-dir" in res["stderr"]
+
+    # State persists and output without a trailing newline is kept intact
+    res = session.run("echo $V; printf tail")
+    assert res["stdout"] == "7\ntail" and res["exit_code"] == 0
+
+def test_unfinished_command_reports_exit_code_on_later_read(session):
+    res = session.run("sleep 1; false", timeout=0.2)
+    assert not res["done"] and res["exit_code"] is None
+    late = session.read_idle(5)
+    assert late["exit_code"] == 1 and "__AGENT_DONE_" not in late["stdout"]
+
+def test_read_idle_returns_when_output_stops(session):
+    session.write("echo fast")
+    start = time.monotonic()
+    assert session.read_idle(5)["stdout"] == "fast\n"
+    assert time.monotonic() - start < 2
+
+def test_shell_tool_run_action(mock_agent):
+    try:
+        res = json.loads(mock_agent.shell_tool("run", "echo ok"))
+        assert res == {"status": "done(0)", "stdout": "ok\n", "stderr": ""}
+    finally:
+        mock_agent.shell_tool("reboot")
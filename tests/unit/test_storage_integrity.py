@@ -1,6 +1,7 @@
 import pytest
 import os
 import shutil
+import json
 import plugins.web_interface.storage as storage
 import plugins.web_interface.serialization as serialization
 from google.genai import types
@@ -105,7 +106,234 @@ def test_serialization_cycle(mock_agent):
     assert loaded_msg._web_thoughts == "I like cats"
     assert loaded_msg._web_tools[0]["title"] == "vision"
     
-    # Verify image integrity
+    # Verify image integrity (images are lazy references until a request is sent)
     img_parts = [p for p in loaded_msg.parts if p.inline_data]
     assert len(img_parts) == 1
-    assert img_parts[0].inline_data.data == b"cat_image_data"
+    sent = loaded_chat._materialize_contents([loaded_msg])[0]
+    assert [p.inline_data.data for p in sent.parts if p.inline_data] == [b"cat_image_data"]
+
+def _text_message(role, text):
+    return types.Content(role=role, parts=[types.Part(text=text)])
+
+def test_append_only_log_writes_only_new_messages(mock_agent):
+    """Per-turn saves append to the .jsonl log and leave the .json/.pkl checkpoint untouched."""
+    chat = mock_agent
+    chat.id = "log_test"
+    chat.messages = [_text_message("user", "first")]
+    storage.save_chat_state(chat)
+
+    json_path = os.path.join(storage.CHATS_DIR, "log_test.json")
+    log_path = os.path.join(storage.CHATS_DIR, "log_test.jsonl")
+    checkpoint_mtime = os.path.getmtime(json_path)
+    log_size = os.path.getsize(log_path)
+
+    chat.messages.append(_text_message("model", "second"))
+    chat.messages.append(_text_message("user", "third"))
+    storage.save_chat_state(chat)
+
+    assert os.path.getmtime(json_path) == checkpoint_mtime
+    assert os.path.getsize(log_path) > log_size
+    with open(log_path, encoding="utf-8") as f:
+        ops = [json.loads(line)["op"] for line in f if line.strip()]
+    assert ops.count("append") == 2
+
+    loaded, _ = storage.load_chat_state("log_test", lambda: mock_agent)
+    assert [m.parts[0].text for m in loaded.messages] == ["first", "second", "third"]
+
+def test_append_only_log_replays_edits_and_truncation(mock_agent):
+    chat = mock_agent
+    chat.id = "log_edit"
+    chat.messages = [_text_message("user", "a"), _text_message("model", "b"), _text_message("user", "c")]
+    storage.save_chat_state(chat)
+
+    chat.messages = chat.messages[:2]
+    chat.messages[1].parts[0].text = "b2"
+    chat.name = "Renamed"
+    storage.save_chat_state(chat)
+
+    # JSON fallback path must replay the log too
+    os.remove(os.path.join(storage.CHATS_DIR, "log_edit.state"))
+    loaded, _ = storage.load_chat_state("log_edit", lambda: mock_agent)
+    assert [m.parts[0].text for m in loaded.messages] == ["a", "b2"]
+    assert loaded.name == "Renamed"
+
+def test_append_only_log_keeps_changes_to_older_messages(mock_agent):
+    chat = mock_agent
+    chat.id = "log_old"
+    chat.messages = [_text_message("user", str(i)) for i in range(10)]
+    storage.save_chat_state(chat)
+
+    # Replaced object and an in-place change reported by the chat, both outside the rechecked tail
+    chat.messages[1] = _text_message("user", "replaced")
+    chat.messages[2]._metrics = {"compacted_tokens": 5}
+    chat._mark_message_changed(chat.messages[2])
+    storage.save_chat_state(chat)
+
+    loaded, _ = storage.load_chat_state("log_old", lambda: mock_agent)
+    assert loaded.messages[1].parts[0].text == "replaced"
+    assert loaded.messages[2]._metrics == {"compacted_tokens": 5}
+
+def test_delete_chat_removes_leftover_tmp_files(mock_agent):
+    chat = mock_agent
+    chat.id = "tmp_left"
+    chat.messages = [_text_message("user", "x")]
+    storage.save_chat_state(chat)
+    for ext in (".jsonl.tmp", ".meta.json.tmp"):
+        open(os.path.join(storage.CHATS_DIR, "tmp_left" + ext), "w").close()
+
+    assert storage.delete_chat("tmp_left")
+    assert not [f for f in os.listdir(storage.CHATS_DIR) if f.startswith("tmp_left")]
+
+def test_append_only_log_compaction(mock_agent, monkeypatch):
+    monkeypatch.setattr(storage, "LOG_COMPACT_RECORDS", 3)
+    chat = mock_agent
+    chat.id = "log_compact"
+    chat.messages = []
+    storage.save_chat_state(chat)
+    for i in range(5):
+        chat.messages.append(_text_message("user", str(i)))
+        storage.save_chat_state(chat)
+
+    with open(os.path.join(storage.CHATS_DIR, "log_compact.json"), encoding="utf-8") as f:
+        checkpoint = json.load(f)
+    assert len(checkpoint["messages"]) >= 3
+
+    loaded, _ = storage.load_chat_state("log_compact", lambda: mock_agent)
+    assert [m.parts[0].text for m in loaded.messages] == ["0", "1", "2", "3", "4"]
+
+def test_index_served_from_memory(mock_agent, monkeypatch):
+    """Saves update the in-memory index; index.json is written behind and reloaded on external change."""
+    monkeypatch.setattr(storage, "INDEX_FLUSH_DELAY", 3600)
+    chat = mock_agent
+    for i, cid in enumerate(["idx_a", "idx_b", "idx_c"]):
+        chat.id = cid
+        chat.name = f"Chat {i}"
+        chat.messages = [_text_message("user", f"hello {i}")]
+        storage.save_chat_state(chat)
+
+    index_path = os.path.join(storage.CHATS_DIR, "index.json")
+    assert [c["id"] for c in storage.list_chats()][:3] == ["idx_c", "idx_b", "idx_a"]
+
+    # Sorting must follow updated_at after a re-save
+    chat.id = "idx_a"
+    storage.save_chat_state(chat)
+    assert storage.list_chats()[0]["id"] == "idx_a"
+
+    storage.flush_index()
+    with open(index_path, encoding="utf-8") as f:
+        assert {c["id"] for c in json.load(f)} >= {"idx_a", "idx_b", "idx_c"}
+
+    with open(index_path, "w", encoding="utf-8") as f:
+        json.dump([{"id": "external", "name": "Ext", "updated_at": "9999", "preview": ""}], f)
+    os.utime(index_path, ns=(1, 1))
+    assert [c["id"] for c in storage.list_chats()] == ["external"]
+
+    storage._remove_from_index("external")
+    assert storage.list_chats() == []
+
+def test_rebuild_index_reads_headers_only(mock_agent, monkeypatch):
+    """Rebuild uses .meta.json sidecars and never parses the full chat file when one exists."""
+    chat = mock_agent
+    chat.id = "hdr_new"
+    chat.name = "With header"
+    chat.messages = [_text_message("user", "from sidecar")]
+    storage.save_chat_state(chat)
+
+    # Legacy chat without a sidecar: rebuilt from the full JSON once, then gets a header
+    with open(os.path.join(storage.CHATS_DIR, "hdr_old.json"), "w", encoding="utf-8") as f:
+        json.dump({"name": "Legacy", "updated_at": "2020", "messages": [{"role": "user", "parts": [{"text": "old text"}]}]}, f)
+
+    seen = []
+    entries = storage._rebuild_index(progress=lambda done, total: seen.append((done, total)))
+    by_id = {e["id"]: e for e in entries}
+    assert by_id["hdr_new"]["preview"] == "from sidecar"
+    assert by_id["hdr_old"]["preview"] == "old text"
+    assert seen[-1] == (2, 2)
+    assert os.path.exists(os.path.join(storage.CHATS_DIR, "hdr_old.meta.json"))
+
+    real_load = json.load
+    def guarded_load(f, *args, **kwargs):
+        assert not f.name.endswith("hdr_new.json"), "full chat file parsed during rebuild"
+        return real_load(f, *args, **kwargs)
+    monkeypatch.setattr(storage.json, "load", guarded_load)
+    storage._rebuild_index()
+
+def test_state_codec_stores_only_deltas(mock_agent):
+    """The .state checkpoint omits static template data and restores it from the template."""
+    state_codec = storage.state_codec
+    chat = mock_agent
+    chat.id = "state_delta"
+    chat.system_prompt = "STATIC " * 20000
+    chat.messages = [_text_message("user", "keep me")]
+    chat.local_env["answer"] = 42
+    chat.local_env["square"] = lambda x: x * x
+    chat.active_modes = ["mode_a"]
+
+    blob = state_codec.encode(chat)
+    assert blob[:4] == state_codec.MAGIC
+    assert len(blob) < 20000
+
+    def fresh_template():
+        clone = type(chat).__new__(type(chat))
+        clone.__dict__.update({"system_prompt": chat.system_prompt, "tools": chat.tools, "local_env": {}, "messages": []})
+        return clone
+
+    restored = state_codec.decode(blob, fresh_template)
+    assert restored.system_prompt == chat.system_prompt
+    assert restored.messages[0].parts[0].text == "keep me"
+    assert restored.local_env["answer"] == 42
+    assert restored.local_env["square"](3) == 9
+    assert restored.active_modes == ["mode_a"]
+
+def test_transient_attrs_never_pickled(mock_agent):
+    """Chat.__getstate__ drops exactly agent.TRANSIENT_ATTRS; the codec shares the same set."""
+    import agent
+    assert storage.state_codec.TRANSIENT_ATTRS is agent.TRANSIENT_ATTRS
+    for attr in agent.TRANSIENT_ATTRS:
+        setattr(mock_agent, attr, object())
+    state = mock_agent.__getstate__()
+    assert not agent.TRANSIENT_ATTRS & set(state)
+    assert "messages" in state
+
+def test_legacy_pkl_migrates_to_state(mock_agent):
+    shutil.copy("tests/data/v1.pkl", os.path.join(storage.CHATS_DIR, "v1.pkl"))
+    shutil.copy("tests/data/v1.json", os.path.join(storage.CHATS_DIR, "v1.json"))
+
+    assert storage.migrate_legacy_states(lambda: mock_agent) == ["v1"]
+    assert not os.path.exists(os.path.join(storage.CHATS_DIR, "v1.pkl"))
+    assert os.path.exists(os.path.join(storage.CHATS_DIR, "v1.state"))
+
+    chat, warning = storage.load_chat_state("v1", lambda: mock_agent)
+    assert warning is None
+    assert chat.name == "Baseline Chat v1"
+    assert len(chat.messages) == 2
+    assert chat.messages[1]._web_thoughts == "Baseline thoughts"
+
+def test_usage_totals_cover_the_whole_history():
+    """Aggregates come from every message, not only the page the UI has loaded."""
+    messages = []
+    for i in range(120):
+        msg = _text_message("user" if i % 2 == 0 else "model", f"m{i}")
+        msg._metrics = {"total_context": 100 + i, "cached_tokens": 1} if i % 2 == 0 else {"output_tokens": 2, "output_time": 0.5}
+        messages.append(msg)
+    totals = serialization.usage_totals(messages)
+    assert totals["total_context"] == 218
+    assert totals["cached_tokens"] == 60
+    assert totals["output_tokens"] == 120 and totals["output_time"] == 30.0
+    assert totals["uncached_tokens"] == 0
+
+def test_history_pages_newest_first():
+    messages = [types.Content(role="user" if i % 2 == 0 else "model", parts=[types.Part(text=f"m{i}")]) for i in range(120)]
+
+    page = serialization.page_history_for_web(messages, chat_id="paged", limit=50)
+    assert page["total"] == 120
+    assert [m["parts"][0]["text"] for m in page["messages"]] == [f"m{i}" for i in range(70, 120)]
+    assert page["cursor"] == 70
+
+    page = serialization.page_history_for_web(messages, chat_id="paged", before=page["cursor"], limit=50)
+    assert page["messages"][0]["parts"][0]["text"] == "m20"
+    assert page["cursor"] == 20
+
+    page = serialization.page_history_for_web(messages, chat_id="paged", before=page["cursor"], limit=50)
+    assert len(page["messages"]) == 20
+    assert page["cursor"] is None
@@ -0,0 +1,102 @@
+from unittest.mock import MagicMock
+from google.genai import types as genai_types
+import token_accounting
+from token_accounting import TokenLedger, estimate_content
+
+def user(text):
+    return genai_types.Content(role="user", parts=[genai_types.Part(text=text)])
+
+def test_estimate_is_cached_until_parts_change(monkeypatch):
+    msg = user("hello world " * 100)
+    first = estimate_content(msg)
+    assert 250 < first < 350
+
+    calls = []
+    monkeypatch.setattr(token_accounting, "estimate_part", lambda p: calls.append(p) or 1)
+    assert estimate_content(msg) == first and calls == []
+    msg.parts.append(genai_types.Part(text="more"))
+    assert estimate_content(msg) == 2
+
+def test_non_ascii_text_costs_more_per_char():
+    assert token_accounting.estimate_text("привет " * 100) > token_accounting.estimate_text("hello! " * 100)
+
+def test_ledger_counts_only_new_messages(monkeypatch):
+    ledger = TokenLedger()
+    messages = [user("a" * 400), user("b" * 400)]
+    total = ledger.sync(messages)
+    assert total == sum(estimate_content(m) for m in messages)
+
+    seen = []
+    real = token_accounting.estimate_content
+    monkeypatch.setattr(token_accounting, "estimate_content", lambda m: seen.append(m) or real(m))
+    messages.append(user("c" * 400))
+    ledger.sync(messages)
+    # Only the previous tail is re-checked (cached) and the new message estimated
+    assert seen == [messages[1], messages[2]]
+    assert ledger.raw_total == sum(real(m) for m in messages)
+
+    # A rewritten history (ai_get cleanup, UI edit) is recounted
+    ledger.sync(messages[:1])
+    assert ledger.raw_total == real(messages[0]) and ledger.stats["recounts"] == 2
+
+def test_in_place_text_append_is_counted():
+    ledger = TokenLedger()
+    messages = [user("a" * 400)]
+    before = ledger.sync(messages)
+    # Chat.add_message extends the last text part in place
+    messages[-1].parts[0].text += "\n" + "b" * 4000
+    assert ledger.sync(messages) > before + 900
+    assert ledger.raw_total == estimate_content(user("a" * 400 + "\n" + "b" * 4000))
+
+def test_invalidated_older_message_is_recounted():
+    ledger = TokenLedger()
+    messages = [user("a" * 400), user("b" * 400)]
+    ledger.sync(messages)
+    messages[0].parts.append(genai_types.Part(text="c" * 4000))
+    ledger.invalidate(messages[0])
+    assert ledger.sync(messages) == sum(estimate_content(m) for m in messages)
+
+def test_chat_marks_changed_message_for_the_ledger(mock_agent):
+    mock_agent.messages = [user("a" * 400), user("b" * 400)]
+    mock_agent.context_tokens()
+    mock_agent.messages[0].parts[0].text += "c" * 4000
+    mock_agent._mark_message_changed(mock_agent.messages[0])
+    ledger = mock_agent._token_ledger()
+    ledger.sync(mock_agent.messages)
+    assert ledger.raw_total == sum(estimate_content(m) for m in mock_agent.messages)
+
+def test_reconcile_calibrates_the_total():
+    ledger = TokenLedger()
+    ledger.sync([user("a" * 4000)])
+    raw = ledger.raw_total
+    ledger.reconcile(raw, raw * 2)
+    assert ledger.total == raw * 2
+    ledger.reconcile(raw, raw)
+    assert raw < ledger.total < raw * 2
+    # Outliers are clamped
+    ledger.reconcile(raw, raw * 1000)
+    assert ledger.ratio <= token_accounting.RATIO_BOUNDS[1]
+
+def test_chat_reconciles_with_usage_metadata(mock_agent):
+    mock_agent.messages = [user("question " * 200)]
+    before = mock_agent.context_tokens()
+    key_index, client, permit, config, contents = mock_agent._prepare_request()
+    sent = mock_agent._token_ledger().last_sent
+    assert mock_agent._estimate_request_tokens() == before
+
+    chunk = MagicMock()
+    chunk.candidates[0].content.parts = [genai_types.Part(text="answer")]
+    chunk.usage_metadata.prompt_token_count = sent * 2
+    chunk.usage_metadata.candidates_token_count = 5
+    chunk.usage_metadata.cached_content_token_count = 0
+    mock_agent._handle_stream(iter([chunk]))
+
+    assert mock_agent._token_ledger().ratio == 2.0
+    assert mock_agent.messages[0]._metrics["total_context"] == sent * 2
+
+    # Next turn: the delta comes from the previous reply without walking the history
+    mock_agent.messages.append(user("follow-up"))
+    mock_agent._prepare_request()
+    chunk.usage_metadata.prompt_token_count = sent * 2 + 5 + 7
+    mock_agent._handle_stream(iter([chunk]))
+    assert mock_agent.messages[2]._metrics["input_tokens"] == 7
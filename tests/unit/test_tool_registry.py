@@ -0,0 +1,41 @@
+import pytest
+from tool_registry import ToolSpec, ToolArgsError
+
+SCHEMA = {"function": {"name": "demo", "parameters": {
+    "type": "OBJECT",
+    "properties": {"items": {"type": "ARRAY"}, "count": {"type": "integer"},
+                   "label": {"type": "string"}, "ratio": {"type": "number"}},
+    "required": ["items", "count"]}}}
+
+def test_spec_binds_and_validates_arguments():
+    spec = ToolSpec(SCHEMA)
+    positional, named = spec.bind({"items": [1, 2], "count": 3.0, "ratio": 2, "unknown": 1})
+    assert positional == [[1, 2], 3] and isinstance(positional[1], int)
+    assert named == {"ratio": 2}
+
+    with pytest.raises(ToolArgsError, match="count"):
+        spec.bind({"items": []})
+    with pytest.raises(ToolArgsError, match="label"):
+        spec.bind({"items": [], "count": 1, "label": 5})
+    with pytest.raises(ToolArgsError, match="bool"):
+        spec.bind({"items": [], "count": True})
+
+def test_registered_tool_is_called_directly(mock_agent):
+    calls = []
+    def demo_tool(chat, items, count, label="x", ratio=1.0):
+        calls.append((chat, items, count, label))
+        return {"n": len(items) * count}
+
+    mock_agent.register_tool(SCHEMA, demo_tool)
+    mock_agent.register_tool(SCHEMA, demo_tool)
+    assert [t["function"]["name"] for t in mock_agent.tools].count("demo") == 1
+
+    mock_agent.local_env["result"] = "untouched"
+    assert mock_agent.tool_exec("demo", {"items": [{"a": 1}, "it's"], "count": 2}) == {"n": 4}
+    assert calls == [(mock_agent, [{"a": 1}, "it's"], 2, "x")]
+    assert mock_agent.local_env["result"] == "untouched"
+
+    assert "неверные аргументы" in mock_agent.tool_exec("demo", {"items": "nope", "count": 1})
+    assert "не найден" in mock_agent.tool_exec("missing", {})
+    # Built-in tools still resolve to <name>_tool methods
+    assert mock_agent.tool_exec("python_str", {"text": "a'b"}) == repr("a'b")
@@ -0,0 +1,144 @@
+import json
+import threading
+
+# Локальный учёт токенов истории.
+# Оценка считается по символам (латиница ~4 символа на токен, кириллица и прочее
+# ~2.5), кешируется на самом сообщении и пересчитывается, только если у него
+# поменялись части или длина их текста (дописывание на месте). TokenLedger держит сумму по истории чата: новые сообщения
+# добавляются к ней по мере появления, так что размер контекста известен до
+# отправки запроса. После ответа оценка сверяется с usage_metadata, и поправочный
+# коэффициент (ratio) подстраивается под реальный токенизатор модели.
+
+ASCII_CHARS_PER_TOKEN = 4.0
+OTHER_CHARS_PER_TOKEN = 2.5
+IMAGE_TOKENS = 258
+PART_OVERHEAD = 4
+CALL_OVERHEAD = 8
+RATIO_SMOOTHING = 0.3     # вес нового замера в скользящем среднем коэффициента
+RATIO_BOUNDS = (0.3, 3.0)
+
+def estimate_text(text):
+    if not text:
+        return 0
+    other = len(text.encode("utf-8", "ignore")) - len(text)   # ~число не-ASCII символов
+    ascii_chars = max(0, len(text) - other)
+    return int(ascii_chars / ASCII_CHARS_PER_TOKEN + other / OTHER_CHARS_PER_TOKEN) + 1
+
+def _estimate_value(value):
+    if isinstance(value, str):
+        return estimate_text(value)
+    try:
+        return estimate_text(json.dumps(value, ensure_ascii=False, default=str))
+    except Exception:
+        return estimate_text(str(value))
+
+def estimate_part(p):
+    total = PART_OVERHEAD
+    if p.text:
+        total += estimate_text(p.text)
+    if p.inline_data is not None:
+        total += IMAGE_TOKENS
+    if p.function_call is not None:
+        total += CALL_OVERHEAD + _estimate_value(p.function_call.args or {})
+    if p.function_response is not None:
+        total += CALL_OVERHEAD + _estimate_value(p.function_response.response or {})
+        total += IMAGE_TOKENS * len(p.function_response.parts or [])
+    return total
+
+def _signature(parts):
+    # Число частей и последняя часть — новые части; сумма длин текста — дописывание
+    # на месте (Chat.add_message, стрим делают part.text += ...)
+    return (len(parts), id(parts[-1]) if parts else None, sum(len(p.text) for p in parts if p.text))
+
+def estimate_content(msg):
+    """Оценка токенов сообщения (без поправки ratio); кешируется в msg._token_estimate."""
+    parts = getattr(msg, "parts", None) or []
+    signature = _signature(parts)
+    cached = getattr(msg, "_token_estimate", None)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    estimate = sum(estimate_part(p) for p in parts)
+    try:
+        msg._token_estimate = (signature, estimate)
+    except (AttributeError, TypeError, ValueError):
+        pass
+    return estimate
+
+class TokenLedger:
+    """Сумма оценок по истории чата с поправкой по фактическим usage_metadata."""
+
+    def __init__(self):
+        self.ratio = 1.0
+        self._lock = threading.Lock()
+        self._messages = None   # список, по которому ведётся сумма
+        self._counted = []      # (сообщение, его оценка) в порядке истории
+        self._raw_total = 0
+        self._stale = False     # после invalidate: при sync перепроверить всю историю, а не только конец
+        self.last_sent = 0      # сырая оценка последнего отправленного запроса (префикс + содержимое)
+        self.last_reply = None  # (ответ модели, prompt + output токенов) — для дельты следующего хода
+        self.stats = {"recounts": 0, "reconciles": 0}
+
+    def sync(self, messages):
+        """Догоняет историю: добавляет новые сообщения; если её переписали — пересчитывает."""
+        with self._lock:
+            counted = self._counted
+            n = len(counted)
+            valid = messages is self._messages and len(messages) >= n
+            if valid and n:
+                valid = messages[n - 1] is counted[-1][0]
+                if valid:
+                    # Последнее сообщение могло дополниться (стрим, add_message); остальные
+                    # перепроверяются только после invalidate
+                    for i in (range(n) if self._stale else (n - 1,)):
+                        msg, old_estimate = counted[i]
+                        estimate = estimate_content(msg)
+                        if estimate != old_estimate:
+                            self._raw_total += estimate - old_estimate
+                            counted[i] = (msg, estimate)
+            self._stale = False
+            if not valid:
+                self._messages = messages
+                self._counted = counted = []
+                self._raw_total = 0
+                n = 0
+                self.stats["recounts"] += 1
+            for msg in messages[n:]:
+                estimate = estimate_content(msg)
+                counted.append((msg, estimate))
+                self._raw_total += estimate
+            return self.total
+
+    def invalidate(self, msg=None):
+        """Сообщение истории изменено на месте: его оценка пересчитается при следующем sync."""
+        if msg is not None:
+            try:
+                msg._token_estimate = None
+            except (AttributeError, TypeError, ValueError):
+                pass
+        with self._lock:
+            self._stale = True
+
+    @property
+    def raw_total(self):
+        return self._raw_total
+
+    @property
+    def total(self):
+        """Оценка токенов истории с поправкой; O(1), актуальна после последнего sync."""
+        return int(self._raw_total * self.ratio)
+
+    def calibrated(self, raw_estimate):
+        return int(raw_estimate * self.ratio)
+
+    def reconcile(self, raw_estimate, actual_tokens):
+        """Сверка: raw_estimate — оценка отправленного запроса, actual_tokens — prompt_token_count ответа."""
+        if not raw_estimate or not actual_tokens:
+            return self.ratio
+        observed = min(max(actual_tokens / raw_estimate, RATIO_BOUNDS[0]), RATIO_BOUNDS[1])
+        with self._lock:
+            if self.stats["reconciles"] == 0:
+                self.ratio = observed
+            else:
+                self.ratio += RATIO_SMOOTHING * (observed - self.ratio)
+            self.stats["reconciles"] += 1
+            return self.ratio
@@ -0,0 +1,56 @@
+# Реестр инструментов: имя -> обработчик + проверка аргументов по JSON-схеме.
+# Вместо сборки строки "result = self.<name>_tool(...)" и exec через python_tool
+# вызов идёт напрямую: обязательные аргументы позиционно (в порядке схемы),
+# необязательные — по имени. Схема разбирается один раз (ToolSpec), типы
+# сверяются и мягко приводятся (целое число, пришедшее как 10.0, -> 10).
+# Плагины регистрируют инструменты через Chat.register_tool(schema, handler).
+
+JSON_TYPES = {
+    "string": (str,),
+    "number": (int, float),
+    "integer": (int,),
+    "boolean": (bool,),
+    "object": (dict,),
+    "array": (list, tuple),
+}
+
+class ToolArgsError(ValueError):
+    pass
+
+class ToolSpec:
+    __slots__ = ("name", "required", "optional", "types")
+
+    def __init__(self, schema):
+        function = schema["function"] if "function" in schema else schema
+        parameters = function.get("parameters") or {}
+        properties = parameters.get("properties") or {}
+        self.name = function["name"]
+        self.required = list(parameters.get("required") or [])
+        self.optional = [p for p in properties if p not in self.required]
+        self.types = {p: JSON_TYPES.get(str(spec.get("type", "")).lower())
+                      for p, spec in properties.items()}
+
+    def _check(self, param, value):
+        expected = self.types.get(param)
+        if expected is None or value is None:
+            return value
+        if bool not in expected and isinstance(value, bool):
+            raise ToolArgsError(f"аргумент '{param}' должен быть {expected[0].__name__}, получен bool")
+        if int in expected and isinstance(value, float):
+            # Gemini присылает числа как float; дробное значение оставляем как есть
+            return int(value) if value.is_integer() else value
+        if not isinstance(value, expected):
+            raise ToolArgsError(f"аргумент '{param}' должен быть {expected[0].__name__}, получен {type(value).__name__}")
+        return value
+
+    def bind(self, args):
+        """(позиционные, именованные) для вызова обработчика; неизвестные аргументы отбрасываются."""
+        missing = [p for p in self.required if p not in args]
+        if missing:
+            raise ToolArgsError(f"не хватает аргументов: {', '.join(missing)}")
+        positional = [self._check(p, args[p]) for p in self.required]
+        named = {p: self._check(p, args[p]) for p in self.optional if p in args}
+        return positional, named
+
+def compile_specs(tools):
+    return {spec.name: spec for spec in map(ToolSpec, tools)}